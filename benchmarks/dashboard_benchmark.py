@@ -0,0 +1,147 @@
+"""
+Dashboard benchmark: how the cost of one Dashboard rerun scales with history size.
+
+For each size, a synthetic fleet history is written as sensor_data.jsonl in a
+scratch directory and the stages of a rerun are timed the way streamlit_app.py
+runs them:
+
+    load     first read of the JSON Lines file (IncrementalJsonlLoader)
+    refresh  picking up 100 appended records (incremental read + clean_tail +
+             Pakistan-time conversion, done once per data change)
+    clean    full clean_and_interpolate_data
+    filter   "Last day" timeframe (binary search) and crop filter
+    stats    "All data" statistics after the append (streaming update of the
+             appended rows + query; the initial build is part of clean)
+    plot     nine downsampled trend traces, serialized to JSON for the browser
+
+It also reports the memory the loaded history takes per million rows: the raw
+frame alone, and together with the cleaned frame (which shares every column
+but the sensor readings with the raw one).
+
+    python benchmarks/dashboard_benchmark.py --rows 10000 100000 1000000
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import timedelta
+
+import pandas as pd
+import plotly.graph_objects as go
+from plotly.subplots import make_subplots
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fleet import synthetic_frame  # noqa: E402
+from sensor_processing import (CLEAN_REWRITE_ROWS, clean_and_interpolate_data, clean_tail,  # noqa: E402
+                               downsample_indices, localize_timestamps, time_slice)
+from sensor_stats import StreamingStats  # noqa: E402
+from sensor_store import SENSOR_COLUMNS, IncrementalJsonlLoader  # noqa: E402
+
+STAGES = ("load", "refresh", "clean", "filter", "stats", "plot")
+APPEND_ROWS = 100
+MAX_CHART_POINTS = 1500  # streamlit_app.MAX_CHART_POINTS
+
+
+def write_history(path, df):
+    with open(path, 'w') as f:
+        df.to_json(f, orient='records', lines=True)
+
+
+def append_history(path, df):
+    with open(path, 'a') as f:
+        df.to_json(f, orient='records', lines=True)
+
+
+def filter_frame(df, window=timedelta(days=1), crop_number=1):
+    """The pandas side of streamlit_app.load_filtered_data for the JSON Lines backend (df in Pakistan time)"""
+    df = time_slice(df, start=pd.Timestamp.now(tz="Asia/Karachi") - window, assume_sorted=True)
+    return df[df["crop_number"] == crop_number]
+
+
+def plot_frame(df, max_points=MAX_CHART_POINTS):
+    """streamlit_app.create_trend_figure plus the JSON serialization Streamlit does"""
+    fig = make_subplots(rows=len(SENSOR_COLUMNS), cols=1, shared_xaxes=True, vertical_spacing=0.02)
+    for row, column in enumerate(SENSOR_COLUMNS, start=1):
+        idx = downsample_indices(df['timestamp'], df[column], max_points)
+        fig.add_trace(go.Scatter(x=df['timestamp'].iloc[idx], y=df[column].iloc[idx], name=column), row=row, col=1)
+    return fig.to_json()
+
+
+def memory_per_million(raw, cleaned):
+    """MB per million rows for the raw frame, and for raw plus cleaned without the shared columns"""
+    raw_bytes = raw.memory_usage(deep=True, index=False).sum()
+    cleaned_bytes = cleaned[SENSOR_COLUMNS].memory_usage(deep=True, index=False).sum()
+    scale = 1e6 / len(raw) / 1e6
+    return raw_bytes * scale, (raw_bytes + cleaned_bytes) * scale
+
+
+def run(rows, workdir, devices, crops):
+    """Time each stage for a history of `rows` records. Returns: ({stage: seconds}, (raw MB, total MB) per 1M rows)"""
+    path = os.path.join(workdir, "sensor_data.jsonl")
+    history = synthetic_frame(rows + APPEND_ROWS, devices=devices, crops=crops)
+    write_history(path, history.iloc[:rows])
+    timings = {}
+
+    start = time.perf_counter()
+    loader = IncrementalJsonlLoader(path)
+    loader.refresh()
+    raw = loader.frame
+    timings["load"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    cleaned = clean_and_interpolate_data(raw)
+    stats = StreamingStats(settle_rows=CLEAN_REWRITE_ROWS)
+    stats.update(cleaned)
+    timings["clean"] = time.perf_counter() - start
+    memory = memory_per_million(raw, cleaned)
+
+    append_history(path, history.iloc[rows:])
+    start = time.perf_counter()
+    loader.refresh()
+    cleaned = clean_tail(loader.frame, cleaned, len(raw))
+    local = localize_timestamps(cleaned, "Asia/Karachi")
+    timings["refresh"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    filtered = filter_frame(local)
+    timings["filter"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    stats.update(cleaned)
+    moments = stats.query(local)
+    moments.describe(), moments.corr()
+    timings["stats"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    plot_frame(filtered)
+    timings["plot"] = time.perf_counter() - start
+    return timings, memory
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--devices", type=int, default=20)
+    parser.add_argument("--crops", type=int, default=5)
+    args = parser.parse_args()
+
+    warm_up = synthetic_frame(1000).assign(timestamp=lambda df: pd.to_datetime(df['timestamp'], unit='s'))
+    plot_frame(filter_frame(localize_timestamps(warm_up, "Asia/Karachi")))  # Warm up plotly
+    workdir = tempfile.mkdtemp(prefix="dashboard-benchmark-")
+    try:
+        print(f"{'rows':>10}" + "".join(f"{stage:>10}" for stage in STAGES)
+              + f"{'raw MB':>10}{'+clean MB':>11}   (seconds; MB per 1M rows)")
+        for rows in args.rows:
+            timings, (raw_mb, total_mb) = run(rows, workdir, args.devices, args.crops)
+            print(f"{rows:>10,}" + "".join(f"{timings[stage]:>10.3f}" for stage in STAGES)
+                  + f"{raw_mb:>10.0f}{total_mb:>11.0f}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+Micro-benchmark for the listener's decode/validate path.
+
+Compares the original per-message implementation (reproduced below as
+legacy_process_message) with mqtt_listener.process_message on the same
+payloads and prints messages/sec for both. Logging goes to a null stream at
+INFO level so the cost of formatting log lines is included but nothing is
+printed.
+
+    python benchmarks/decode_benchmark.py [--messages 50000] [--repeat 3]
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mqtt_listener  # noqa: E402
+
+
+def make_payloads(n, seed=0):
+    """Payloads shaped like the field devices' messages (upper-case keys, string numbers)"""
+    rng = random.Random(seed)
+    macs = [":".join(f"{rng.randrange(256):02X}" for _ in range(6)) for _ in range(20)]
+    payloads = []
+    for i in range(n):
+        message = {
+            "MAC_ADDRESS": rng.choice(macs),
+            "CROP_NUMBER": str(rng.randrange(1, 6)),
+            "DATE": "2025-06-01",
+            "TIME": f"{i // 3600 % 24:02d}:{i // 60 % 60:02d}:{i % 60:02d}",
+            "SOIL_MOISTURE": round(rng.uniform(20, 60), 1),
+            "SOIL_NITROGEN": rng.randrange(10, 80),
+            "SOIL_PHOSPHORUS": rng.randrange(10, 80),
+            "SOIL_POTASSIUM": rng.randrange(50, 300),
+            "SOIL_TEMPERATURE": round(rng.uniform(15, 35), 1),
+            "SOIL_CONDUCTIVITY": round(rng.uniform(0, 50), 1),
+            "SOIL_PH": str(round(rng.uniform(5.5, 8.0), 2)),
+            "AIR_TEMPERATURE": round(rng.uniform(15, 45), 1),
+            "AIR_HUMIDITY": round(rng.uniform(20, 90), 1),
+        }
+        payload = json.dumps(message)
+        if i % 50 == 0:
+            payload = json.dumps(payload)  # Some firmware double-encodes
+        payloads.append(payload.encode("utf-8"))
+    return payloads
+
+
+# The decode/validate path before the fast-path rewrite, kept here as the baseline
+
+def legacy_validate_value(field_name, value, ranges=mqtt_listener.VALIDATION_RANGES):
+    if field_name not in ranges:
+        return True, value, None
+    if value is None or value == "":
+        return True, None, None
+    try:
+        range_config = ranges[field_name]
+        if range_config["type"] == "int":
+            value = int(float(value))
+        else:
+            value = float(value)
+        if value < range_config["min"] or value > range_config["max"]:
+            return False, None, f"{field_name} value {value} out of range [{range_config['min']}, {range_config['max']}] {range_config['unit']}"
+        return True, value, None
+    except (ValueError, TypeError):
+        return False, None, f"{field_name} has invalid type: {value} ({type(value).__name__})"
+
+
+def legacy_validate_sensor_data(data):
+    validated_data = {}
+    errors = []
+    mac_address = data.get("mac_address")
+    if mac_address is None or mac_address == "":
+        validated_data["mac_address"] = None
+    elif re.match(r'^([0-9A-Fa-f]{2}:){5}[0-9A-Fa-f]{2}$', str(mac_address)):
+        validated_data["mac_address"] = mac_address.upper()
+    else:
+        return False, None, [f"Invalid MAC address format: {mac_address}"]
+    for field_name in mqtt_listener.VALIDATION_RANGES.keys():
+        is_valid, validated_value, error = legacy_validate_value(field_name, data.get(field_name))
+        if not is_valid:
+            errors.append(error)
+        else:
+            validated_data[field_name] = validated_value
+    validated_data["timestamp"] = data.get("timestamp")
+    validated_data["date"] = data.get("date")
+    validated_data["time"] = data.get("time")
+    return (False, validated_data, errors) if errors else (True, validated_data, [])
+
+
+def legacy_process_message(payload, received_at):
+    payload_str = payload.decode('utf-8').strip()
+    logging.info(f"Received message: {payload_str}")
+    import ast
+    try:
+        data = json.loads(payload_str)
+        logging.info("JSON parsed successfully (single decode)")
+    except json.JSONDecodeError:
+        try:
+            data = json.loads(json.loads(payload_str))
+        except Exception:
+            try:
+                data = json.loads(ast.literal_eval(f"'{payload_str}'"))
+            except Exception:
+                return None
+    if isinstance(data, str):
+        data = json.loads(data)  # The original only got here via an exception; unwrap so both paths do the same work
+    normalized_data = {}
+    for key, value in data.items():
+        normalized_data[key.lower()] = value
+    if "timestamp" not in normalized_data:
+        normalized_data["timestamp"] = received_at
+    is_valid, validated_data, errors = legacy_validate_sensor_data(normalized_data)
+    if not is_valid:
+        logging.error(f"❌ DATA VALIDATION FAILED - Data rejected and NOT saved!")
+        return None
+    logging.info("✓ Data validation passed")
+    for field in mqtt_listener.fieldnames:
+        if field not in validated_data:
+            validated_data[field] = None
+    return validated_data
+
+
+def measure(process, payloads, repeat):
+    """Best of `repeat` runs. Returns: messages/sec"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for payload in payloads:
+            process(payload, 0.0)
+        best = min(best, time.perf_counter() - start)
+    return len(payloads) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    # Keep the listener's INFO level but send the output nowhere
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(logging.StreamHandler(open(os.devnull, "w")))
+    root.setLevel(logging.INFO)
+
+    payloads = make_payloads(args.messages)
+    assert legacy_process_message(payloads[0], 0.0) == mqtt_listener.process_message(payloads[0], 0.0)
+
+    parser_name = "orjson" if mqtt_listener.orjson is not None else "json"
+    before = measure(legacy_process_message, payloads, args.repeat)
+    after = measure(mqtt_listener.process_message, payloads, args.repeat)
+    print(f"{len(payloads)} messages, best of {args.repeat}")
+    print(f"  before:            {before:12,.0f} msg/s")
+    print(f"  after ({parser_name:>6}):   {after:12,.0f} msg/s  ({after / before:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+Synthetic sensor fleets for the benchmarks: records shaped like the listener's
+(one row per reading, every field in mqtt_listener.fieldnames), with a few
+zeros and out-of-range values mixed in so cleaning has work to do.
+"""
+import time
+
+import numpy as np
+import pandas as pd
+
+# (mean, spread) of each sensor's readings
+SENSOR_PROFILES = {
+    "soil_moisture": (40.0, 10.0),
+    "soil_nitrogen": (40.0, 15.0),
+    "soil_phosphorus": (30.0, 10.0),
+    "soil_potassium": (150.0, 50.0),
+    "soil_temperature": (25.0, 5.0),
+    "soil_conductivity": (20.0, 8.0),
+    "soil_ph": (6.8, 0.5),
+    "air_temperature": (30.0, 7.0),
+    "air_humidity": (55.0, 15.0),
+}
+
+
+def mac_addresses(devices):
+    return [f"00:14:22:{(i >> 16) & 0xFF:02X}:{(i >> 8) & 0xFF:02X}:{i & 0xFF:02X}" for i in range(devices)]
+
+
+def synthetic_frame(rows, devices=20, crops=5, interval=60.0, end=None, glitch_rate=0.01, seed=0):
+    """
+    rows readings from `devices` devices reporting round-robin every `interval`
+    seconds (per device), ending at `end` (epoch seconds, default now).
+    Returns: DataFrame in time order with a float epoch-seconds timestamp column
+    """
+    rng = np.random.default_rng(seed)
+    end = time.time() if end is None else end
+    step = interval / devices
+    timestamps = end - step * np.arange(rows)[::-1]
+    device = np.arange(rows) % devices
+    macs = np.array(mac_addresses(devices))
+
+    local = pd.to_datetime(timestamps, unit='s', utc=True).tz_convert("Asia/Karachi")
+    df = pd.DataFrame({
+        "timestamp": timestamps,
+        "mac_address": macs[device],
+        "crop_number": device % crops + 1,
+        "date": local.strftime("%Y-%m-%d"),
+        "time": local.strftime("%H:%M:%S"),
+    })
+    # Slow daily cycle plus noise, rounded like the sensors report
+    phase = np.sin(timestamps / 86400.0 * 2 * np.pi)
+    for column, (mean, spread) in SENSOR_PROFILES.items():
+        values = mean + spread * (0.5 * phase + 0.3 * rng.standard_normal(rows))
+        glitches = rng.random(rows) < glitch_rate
+        values[glitches] = rng.choice([0.0, 9999.0], size=glitches.sum())
+        df[column] = np.round(values, 1)
+    return df
@@ -0,0 +1,209 @@
+"""
+Ingest benchmark for mqtt_listener.py.
+
+Replays sensor_data.csv or a synthetic multi-device fleet through the
+listener's pipeline and reports throughput, end-to-end latency (from publish
+to the batch being written to every sink) and how much the storage files grew.
+
+By default payloads are handed straight to mqtt_listener.on_message; with
+--broker they are published to a real MQTT broker (e.g. a local mosquitto)
+and received by a listener client subscribed to the same topic. Everything
+is written to a scratch directory, never to the project's data files.
+
+    python benchmarks/ingest_benchmark.py --source csv
+    python benchmarks/ingest_benchmark.py --source fleet --devices 200 --messages 100000 --sqlite
+    python benchmarks/ingest_benchmark.py --source fleet --rate 500 --broker localhost:1883
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import paho.mqtt.client as mqtt  # noqa: E402
+
+import mqtt_listener  # noqa: E402
+from fleet import synthetic_frame  # noqa: E402
+
+STORAGE_FILES = ("csv_file", "jsonl_file", "sqlite_file", "rollup_file")
+
+
+def csv_payload_bodies(path, limit):
+    """Payload bodies (everything after the opening brace) for the rows of a listener CSV, repeated up to limit"""
+    with open(path, newline='') as f:
+        rows = [row for row in csv.DictReader(f)]
+    bodies = []
+    for row in rows:
+        row.pop("timestamp", None)  # Stamped with the send time instead
+        bodies.append(json.dumps(row)[1:].encode())
+    if not bodies:
+        raise SystemExit(f"No rows in {path}")
+    return [bodies[i % len(bodies)] for i in range(limit)]
+
+
+def fleet_payload_bodies(messages, devices, crops):
+    df = synthetic_frame(messages, devices=devices, crops=crops, glitch_rate=0.0).drop(columns=["timestamp"])
+    return [json.dumps(record)[1:].encode() for record in df.to_dict(orient="records")]
+
+
+def storage_sizes():
+    """Bytes on disk of each storage file (SQLite files include their -wal file)"""
+    sizes = {}
+    for setting in STORAGE_FILES:
+        path = getattr(mqtt_listener, setting)
+        size = 0
+        for candidate in (path, path + "-wal"):
+            if os.path.exists(candidate):
+                size += os.path.getsize(candidate)
+        sizes[path] = size
+    return sizes
+
+
+class Sender:
+    """Delivers payloads either directly to on_message or through an MQTT broker"""
+
+    def __init__(self, broker):
+        self.publisher = None
+        self.subscriber = None
+        if broker:
+            host, _, port = broker.partition(":")
+            port = int(port or mqtt_listener.port)
+            subscribed = threading.Event()
+            self.subscriber = mqtt.Client()
+            self.subscriber.on_connect = lambda client, userdata, flags, rc: client.subscribe(mqtt_listener.topic)
+            self.subscriber.on_subscribe = lambda *args: subscribed.set()
+            self.subscriber.on_message = mqtt_listener.on_message
+            self.subscriber.connect(host, port, 60)
+            self.subscriber.loop_start()
+            if not subscribed.wait(10):
+                raise SystemExit(f"Could not subscribe to {mqtt_listener.topic} on {broker}")
+            self.publisher = mqtt.Client()
+            self.publisher.connect(host, port, 60)
+            self.publisher.loop_start()
+
+    def send(self, payload):
+        if self.publisher is None:
+            mqtt_listener.on_message(None, None, SimpleNamespace(payload=payload))
+        else:
+            self.publisher.publish(mqtt_listener.topic, payload)
+
+    def close(self):
+        for client in (self.publisher, self.subscriber):
+            if client is not None:
+                client.loop_stop()
+                client.disconnect()
+
+
+def run(bodies, broker=None, rate=None, timeout=120.0):
+    """Send every payload and wait until the writer has handled them all. Returns: results dict"""
+    latencies = []
+
+    def on_flush(batch):
+        now = time.time()
+        latencies.extend(now - record["timestamp"] for record in batch)
+
+    sizes_before = storage_sizes()
+    sinks, _, _ = mqtt_listener.open_sinks()
+    writer = mqtt_listener.IngestWriter(sinks, batch_size=mqtt_listener.batch_size,
+                                        batch_interval=mqtt_listener.batch_interval,
+                                        stats_interval=float('inf'), on_flush=on_flush)
+    writer.start()
+    sender = Sender(broker)
+    stats = mqtt_listener.ingest_stats
+
+    start = time.perf_counter()
+    for i, body in enumerate(bodies):
+        if rate:
+            delay = start + i / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        # The send time goes into the payload, so latency covers the broker as well
+        sender.send(b'{"timestamp": %r, ' % time.time() + body)
+    send_time = time.perf_counter() - start
+
+    deadline = time.monotonic() + timeout
+    while stats.written + stats.rejected + stats.dropped < len(bodies) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    sender.close()
+    writer.stop()
+
+    return {
+        "sent": len(bodies),
+        "send_time": send_time,
+        "elapsed": elapsed,
+        "latencies": np.array(latencies),
+        "stats": stats.as_dict(),
+        "sizes_before": sizes_before,
+        "sizes_after": storage_sizes(),
+    }
+
+
+def report(results):
+    stats = results["stats"]
+    written = stats["written"]
+    print(f"Sent {results['sent']} messages in {results['send_time']:.2f}s "
+          f"({results['sent'] / results['send_time']:,.0f} msg/s offered)")
+    print(f"Written {written}, rejected {stats['rejected']}, dropped {stats['dropped']}, "
+          f"blocked enqueues {stats['blocked']}, max queue depth {stats['max_queue_depth']}, batches {stats['batches']}")
+    if results["sent"] > written + stats["rejected"] + stats["dropped"]:
+        print(f"  Timed out with {results['sent'] - written - stats['rejected'] - stats['dropped']} message(s) outstanding")
+    print(f"Throughput: {written / results['elapsed']:,.0f} records/s written")
+    latencies = results["latencies"]
+    if len(latencies):
+        p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+        print(f"End-to-end latency: p50 {p50:.1f} ms, p99 {p99:.1f} ms, max {latencies.max() * 1000:.1f} ms")
+    print("Storage growth:")
+    for path, after in results["sizes_after"].items():
+        growth = after - results["sizes_before"][path]
+        if after or growth:
+            per_record = f" ({growth / written:.0f} B/record)" if written else ""
+            print(f"  {path:<20} {growth / 1e6:10.2f} MB{per_record}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--source", choices=["csv", "fleet"], default="fleet")
+    parser.add_argument("--csv", default=os.path.join(ROOT, "sensor_data.csv"), help="CSV to replay with --source csv")
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--devices", type=int, default=50, help="Fleet size with --source fleet")
+    parser.add_argument("--crops", type=int, default=5)
+    parser.add_argument("--rate", type=float, default=None, help="Messages/sec to offer (default: as fast as possible)")
+    parser.add_argument("--broker", default=None, help="host[:port] of an MQTT broker to publish through")
+    parser.add_argument("--sqlite", action="store_true", help="Also write to the SQLite store")
+    parser.add_argument("--no-rollups", action="store_true", help="Don't maintain rollups")
+    parser.add_argument("--workdir", default=None, help="Directory for the storage files (default: a temporary directory)")
+    args = parser.parse_args()
+
+    if args.source == "csv":
+        bodies = csv_payload_bodies(args.csv, args.messages)
+    else:
+        bodies = fleet_payload_bodies(args.messages, args.devices, args.crops)
+
+    logging.getLogger().setLevel(logging.WARNING)
+    mqtt_listener.sqlite_enabled = args.sqlite
+    mqtt_listener.rollups_enabled = not args.no_rollups
+    workdir = args.workdir or tempfile.mkdtemp(prefix="ingest-benchmark-")
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    try:
+        report(run(bodies, broker=args.broker, rate=args.rate))
+    finally:
+        if args.workdir is None:
+            os.chdir(ROOT)
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+Opt-in profiling of dashboard script runs: wall-clock time per stage (load, clean,
+timezone, filter, figures, insights, ...) and, optionally, a cProfile dump per run.
+
+A RunProfiler is started at the top of a script run (or of a fragment rerun) and
+made active for the current thread, which is the thread Streamlit runs that
+session's script in. Code anywhere in the run times itself with stage(), which
+does nothing when no profiler is active:
+
+    with stage("clean"):
+        df = clean_and_interpolate_data(df)
+
+Dumps can be inspected with `python -m pstats profiles/<file>.prof` or snakeviz.
+"""
+import cProfile
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+PROFILE_DIR = "profiles"
+PROFILE_KEEP = 50  # Newest dumps kept in PROFILE_DIR
+
+_local = threading.local()
+
+
+def active():
+    """Profiler of the run executing in this thread, or None"""
+    return getattr(_local, "profiler", None)
+
+
+def stop_active():
+    """Stop the profiler a run interrupted by a rerun left behind in this thread, if any"""
+    profiler = active()
+    if profiler is not None:
+        profiler.stop()
+
+
+def stage(name):
+    """Time a block as stage `name` of the active run (no-op when not profiling)"""
+    profiler = active()
+    return profiler.stage(name) if profiler is not None else nullcontext()
+
+
+class RunProfiler:
+    """Stage timings, and optionally a cProfile dump, for one script run"""
+
+    def __init__(self, label="run", cprofile=False, dump_dir=PROFILE_DIR):
+        self.label = label
+        self.cprofile = cprofile
+        self.dump_dir = dump_dir
+        self.stages = {}  # name -> [seconds, calls]; insertion order is the order stages first ran
+        self.total = 0.0
+        self.dump_path = None
+        self.running = False
+        self._depth = 0
+        self._nested = set()  # Stages that ran inside another stage, not counted towards "other"
+        self._profile = None
+        self._start = None
+
+    def start(self):
+        """Make this the active profiler of the thread, replacing one left by an aborted run"""
+        stop_active()
+        _local.profiler = self
+        self.running = True
+        if self.cprofile:
+            self._profile = cProfile.Profile()
+            try:
+                self._profile.enable()
+            except ValueError as e:  # Another session's profiler is running (Python 3.12+)
+                logging.warning(f"cProfile not available for this run: {str(e)}")
+                self._profile = None
+        self._start = time.perf_counter()
+        return self
+
+    def stop(self):
+        """Finish the run and write the cProfile dump. Returns: self"""
+        if not self.running:
+            return self
+        self.total = time.perf_counter() - self._start
+        self.running = False
+        if _local.__dict__.get("profiler") is self:
+            del _local.profiler
+        if self._profile is not None:
+            self._profile.disable()
+            self.dump_path = self._dump()
+            self._profile = None
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    @contextmanager
+    def stage(self, name):
+        self._depth += 1
+        if self._depth > 1:
+            self._nested.add(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self._depth -= 1
+            totals = self.stages.setdefault(name, [0.0, 0])
+            totals[0] += elapsed
+            totals[1] += 1
+
+    def breakdown(self):
+        """
+        Rows of (stage, seconds, calls, share of the run) in the order the stages ran,
+        followed by "other" for the time outside any stage (widgets, layout, sending
+        charts to the browser). Nested stages are listed but not subtracted from "other".
+        """
+        total = self.total if not self.running else time.perf_counter() - self._start
+        rows = [(name, seconds, calls, seconds / total if total else 0.0)
+                for name, (seconds, calls) in self.stages.items()]
+        outside = total - sum(seconds for name, (seconds, _) in self.stages.items() if name not in self._nested)
+        rows.append(("other", max(outside, 0.0), 1, max(outside, 0.0) / total if total else 0.0))
+        return rows
+
+    def _dump(self):
+        try:
+            os.makedirs(self.dump_dir, exist_ok=True)
+            stamp = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+            path = os.path.join(self.dump_dir, f"{self.label.replace(' ', '_')}-{stamp}.prof")
+            self._profile.dump_stats(path)
+            prune_dumps(self.dump_dir)
+            return path
+        except OSError as e:
+            logging.error(f"Could not write profile to {self.dump_dir}: {str(e)}")
+            return None
+
+
+def prune_dumps(dump_dir=PROFILE_DIR, keep=PROFILE_KEEP):
+    """Delete all but the newest `keep` .prof files"""
+    paths = [os.path.join(dump_dir, name) for name in os.listdir(dump_dir) if name.endswith(".prof")]
+    paths.sort(key=os.path.getmtime)
+    for path in paths[:-keep] if keep else paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
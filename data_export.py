@@ -0,0 +1,145 @@
+"""
+Exports for the dashboard's Historical Data page.
+
+The selected rows are written to a file in chunks of EXPORT_CHUNK_ROWS rows
+(CSV or JSON Lines, optionally gzip-compressed, or Parquet), so the serialized
+export never sits in memory as a whole. Files are kept in EXPORT_DIR under a
+name derived from the selection: a selection is exported once, later
+requests are served from the file. The least recently used exports are
+deleted once the directory grows past EXPORT_MAX_BYTES.
+"""
+import gzip
+import hashlib
+import logging
+import os
+import threading
+
+import numpy as np
+
+from sensor_store import PARQUET_AVAILABLE
+
+EXPORT_DIR = "exports"
+EXPORT_MAX_BYTES = 1024 ** 3  # Exports kept on disk for reuse
+EXPORT_CHUNK_ROWS = 20000
+EXPORT_GZIP_LEVEL = 6  # Level 9 takes about twice as long for a few percent
+
+# format -> (label, file extension, MIME type)
+EXPORT_FORMATS = {
+    "csv": ("CSV", ".csv", "text/csv"),
+    "jsonl": ("JSON Lines", ".jsonl", "application/x-ndjson"),
+    "parquet": ("Parquet", ".parquet", "application/vnd.apache.parquet"),
+}
+
+
+def export_formats():
+    """Formats that can be written here (Parquet requires pyarrow)"""
+    return [fmt for fmt in EXPORT_FORMATS if fmt != "parquet" or PARQUET_AVAILABLE]
+
+
+def export_name(fmt, compress=False):
+    """File extension of an export, e.g. ".csv.gz\""""
+    compress = compress and fmt != "parquet"  # Parquet is compressed internally
+    return EXPORT_FORMATS[fmt][1] + (".gz" if compress else "")
+
+
+def export_mime(fmt, compress=False):
+    return "application/gzip" if compress and fmt != "parquet" else EXPORT_FORMATS[fmt][2]
+
+
+def _chunks(df, size=EXPORT_CHUNK_ROWS):
+    """Row slices of df (at least one, so an empty frame still gets a header/schema)"""
+    for start in range(0, max(len(df), 1), size):
+        yield df.iloc[start:start + size]
+
+
+def _decimal_floats(chunk):
+    """float32 columns as the float64 of the decimals the sensors sent (33.9 rather than 33.900002)"""
+    columns = [col for col in chunk.columns if chunk[col].dtype == np.float32]
+    if not columns:
+        return chunk
+    return chunk.assign(**{col: chunk[col].to_numpy().astype(str).astype(np.float64) for col in columns})
+
+
+def write_export(df, path, fmt, compress=False):
+    """Write df to path in fmt, one chunk of rows at a time"""
+    if fmt == "parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        writer = None
+        try:
+            for chunk in _chunks(df):
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(path, table.schema)
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+        return
+
+    if compress:
+        f = gzip.open(path, 'wt', encoding='utf-8', newline='', compresslevel=EXPORT_GZIP_LEVEL)
+    else:
+        f = open(path, 'w', encoding='utf-8', newline='')
+    with f:
+        for i, chunk in enumerate(_chunks(df)):
+            if fmt == "csv":
+                chunk.to_csv(f, header=i == 0, index=False)
+            elif fmt == "jsonl":
+                if len(chunk):
+                    f.write(_decimal_floats(chunk).to_json(orient='records', lines=True, date_format='iso')
+                            .rstrip('\n') + '\n')
+            else:
+                raise ValueError(f"Unknown export format: {fmt}")
+
+
+def export_file(df, key, fmt, compress=False, export_dir=EXPORT_DIR, max_bytes=EXPORT_MAX_BYTES):
+    """
+    Export of df in fmt, written unless the export of the same key already exists.
+    key identifies the selection df holds (filters and data version).
+    Returns: path of the file
+    """
+    compress = compress and fmt != "parquet"
+    digest = hashlib.sha1(repr((key, fmt, compress)).encode('utf-8')).hexdigest()[:20]
+    path = os.path.join(export_dir, f"export-{digest}{export_name(fmt, compress)}")
+    if os.path.exists(path):
+        os.utime(path)  # Most recently used
+        return path
+
+    os.makedirs(export_dir, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"  # Sessions may export the same selection at once
+    try:
+        write_export(df, tmp_path, fmt, compress)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    evict_exports(export_dir, max_bytes, keep=path)
+    return path
+
+
+def evict_exports(export_dir=EXPORT_DIR, max_bytes=EXPORT_MAX_BYTES, keep=None):
+    """Delete the least recently used exports until the rest fit in max_bytes"""
+    entries = []
+    for name in os.listdir(export_dir):
+        path = os.path.join(export_dir, name)
+        if not name.startswith("export-") or name.endswith(".tmp"):
+            continue
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue  # Evicted by another session
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+        except OSError as e:
+            logging.warning(f"Could not delete export {path}: {str(e)}")
@@ -0,0 +1,166 @@
+"""
+Offline deduplication of the sensor history files.
+
+Rewrites CSV, JSON Lines and legacy JSON array files without the records that
+repeat an earlier one (same device, crop, device date/time and readings; see
+sensor_store.DuplicateFilter), applying the same rules as the listener's
+ingest-time dedup with each record's timestamp as its arrival time. The kept
+lines are copied byte for byte. Reports the rows and bytes saved per file.
+
+    python3 dedup_sensor_data.py                       # csv_file and jsonl_file from mqtt_listener.py
+    python3 dedup_sensor_data.py sensor_data.csv --dry-run
+
+Stop the listener first: records it appends while a file is rewritten are lost.
+The original of each rewritten file is kept as <name>_backup_<YYYYmmdd_HHMMSS><ext>.
+"""
+import argparse
+import csv
+import itertools
+import json
+import logging
+import os
+import shutil
+from datetime import datetime
+
+import pandas as pd
+
+import mqtt_listener as listener
+from sensor_store import DuplicateFilter
+
+
+def _timestamp(value):
+    """Epoch seconds of a stored timestamp (epoch number or naive UTC datetime text), None if unparseable"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return pd.Timestamp(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def _is_duplicate(dedup, record):
+    return dedup.is_duplicate({**record, "timestamp": _timestamp(record.get("timestamp"))})
+
+
+def dedup_csv(path, out, dedup):
+    """
+    Copy the CSV file at path to the binary file out without duplicates. A file
+    without a header row is read with the listener's fieldnames.
+    Returns: (rows, rows kept)
+    """
+    rows = kept = 0
+    with open(path, 'rb') as f:
+        first = f.readline()
+        fieldnames = next(csv.reader([first.decode('utf-8')]), [])
+        if "mac_address" in fieldnames:
+            out.write(first)
+            lines = f
+        else:
+            fieldnames = listener.fieldnames
+            lines = itertools.chain([first] if first else [], f)
+        for line in lines:
+            values = next(csv.reader([line.decode('utf-8')]), None)
+            rows += 1
+            if values and _is_duplicate(dedup, dict(zip(fieldnames, values))):
+                continue
+            out.write(line)
+            kept += 1
+    return rows, kept
+
+
+def dedup_jsonl(path, out, dedup):
+    """Copy the JSON Lines file at path to the binary file out without duplicates. Returns: (rows, rows kept)"""
+    rows = kept = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            rows += 1
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None  # Incomplete or corrupt line: kept as it is
+            if isinstance(record, dict) and _is_duplicate(dedup, record):
+                continue
+            out.write(line)
+            kept += 1
+    return rows, kept
+
+
+def dedup_json(path, out, dedup):
+    """Copy the legacy JSON array file at path to the binary file out without duplicates. Returns: (rows, rows kept)"""
+    with open(path, 'rb') as f:
+        records = json.load(f) if os.path.getsize(path) > 0 else []
+    if not isinstance(records, list):
+        records = [records]
+    kept = [record for record in records if not (isinstance(record, dict) and _is_duplicate(dedup, record))]
+    out.write(json.dumps(kept).encode('utf-8'))
+    return len(records), len(kept)
+
+
+DEDUP_FORMATS = {".csv": dedup_csv, ".jsonl": dedup_jsonl, ".json": dedup_json}
+
+
+def backup_path(path):
+    stem, ext = os.path.splitext(path)
+    return f"{stem}_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}{ext}"
+
+
+def dedup_file(path, max_keys=listener.dedup_max_keys, undated_window=listener.dedup_undated_window,
+               dry_run=False, backup=True):
+    """
+    Remove the duplicate records of a CSV, JSON Lines or JSON array file.
+    With dry_run the file is left as it is. Returns: (rows, rows kept, bytes before, bytes after)
+    """
+    dedup_format = DEDUP_FORMATS.get(os.path.splitext(path)[1].lower())
+    if dedup_format is None:
+        raise ValueError(f"Unsupported file type: {path} (expected {', '.join(DEDUP_FORMATS)})")
+
+    tmp_path = path + '.dedup.tmp'
+    try:
+        with open(tmp_path, 'wb') as out:
+            rows, kept = dedup_format(path, out, DuplicateFilter(max_keys=max_keys, undated_window=undated_window))
+            out.flush()
+            os.fsync(out.fileno())
+        size_before, size_after = os.path.getsize(path), os.path.getsize(tmp_path)
+        if not dry_run and kept < rows:
+            if backup:
+                shutil.copy2(path, backup_path(path))
+            os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return rows, kept, size_before, size_after
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("files", nargs="*", default=[listener.csv_file, listener.jsonl_file],
+                        help="CSV, JSON Lines or JSON files (default: the listener's CSV and JSON Lines files)")
+    parser.add_argument("--max-keys", type=int, default=listener.dedup_max_keys,
+                        help="Recent records remembered (default: dedup_max_keys in mqtt_listener.py)")
+    parser.add_argument("--undated-window", type=float, default=listener.dedup_undated_window,
+                        help="Seconds within which identical readings without device date/time are duplicates "
+                             "(default: dedup_undated_window in mqtt_listener.py)")
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would be removed")
+    parser.add_argument("--no-backup", action="store_true", help="Don't keep a copy of the original files")
+    args = parser.parse_args()
+
+    removed = False
+    for path in args.files:
+        if not os.path.exists(path):
+            logging.warning(f"Skipping {path}: not found")
+            continue
+        rows, kept, size_before, size_after = dedup_file(path, args.max_keys, args.undated_window,
+                                                         dry_run=args.dry_run, backup=not args.no_backup)
+        action = "would remove" if args.dry_run else "removed"
+        logging.info(f"{path}: {action} {rows - kept:,} of {rows:,} records, "
+                     f"{size_before - size_after:,} of {size_before:,} bytes")
+        removed = removed or kept < rows
+    if removed and not args.dry_run:
+        logging.info(f"Delete {listener.rollup_file} (and {listener.sqlite_file}, if used) to have the listener "
+                     f"rebuild them from the deduplicated {listener.jsonl_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""
+Insight rules for the dashboard: optimal ranges, trend and correlation thresholds
+per crop, evaluated for every device's latest readings at once.
+
+DEFAULT_RULES apply to every crop; CROP_RULES overrides them per crop number,
+for instance a wetter moisture range and a looser trend threshold for crop 2:
+
+    CROP_RULES = {
+        2: {"ranges": {"soil_moisture": (40, 80)}, "trend_slope": 1.0},
+    }
+
+evaluate_rules() returns one row per alert, ranked by severity: how far a reading
+is outside its range (1 + distance / range width), or how far a trend slope or a
+correlation exceeds its threshold (value / threshold). Every alert scores above 1.
+"""
+import numpy as np
+import pandas as pd
+
+from sensor_processing import GROUP_COLUMNS
+
+DEFAULT_RULES = {
+    # Optimal range of each parameter
+    "ranges": {
+        "soil_moisture": (30, 70),
+        "soil_nitrogen": (5, 15),
+        "soil_phosphorus": (5, 15),
+        "soil_potassium": (15, 30),
+        "soil_temperature": (20, 30),
+        "soil_conductivity": (50, 80),
+        "soil_ph": (6.0, 7.5),
+        "air_temperature": (20, 35),
+        "air_humidity": (50, 85),
+    },
+    "trend_readings": 10,  # Readings of a device the trend slope is fitted over
+    "trend_slope": 0.5,    # |Change per reading| reported as a significant trend
+    "correlation": 0.7,    # |Correlation| over the timeframe reported as strong
+}
+
+CROP_RULES = {}  # crop_number -> overrides of DEFAULT_RULES (ranges are merged per parameter)
+
+CORRELATION_ALERTS = 3  # Strongest correlations reported per crop
+
+ALERT_COLUMNS = ["severity", "kind", "crop_number", "mac_address", "parameter", "value", "message"]
+
+
+def rules_for(crop_number, crop_rules=None):
+    """DEFAULT_RULES with the overrides for crop_number applied"""
+    overrides = (CROP_RULES if crop_rules is None else crop_rules).get(crop_number, {})
+    rules = {**DEFAULT_RULES, **overrides}
+    rules["ranges"] = {**DEFAULT_RULES["ranges"], **overrides.get("ranges", {})}
+    return rules
+
+
+def _title(param):
+    return param.replace('_', ' ').title()
+
+
+def _where(crop, mac):
+    """Where an alert applies, for its message"""
+    if crop is None and mac is None:
+        return ""
+    if mac is None:
+        return f" on crop {crop}"
+    return f" on crop {crop} ({mac})" if crop is not None else f" ({mac})"
+
+
+def _reading(value):
+    """A float32 sensor value as the decimal the sensor sent (6.7 rather than 6.699999809265137)"""
+    return float(str(np.float32(value)))
+
+
+def recent_readings(df, n):
+    """
+    The last n readings of each device/crop in df (sorted by time).
+    Returns: (those rows in time order, group code of each, position of each among them)
+    """
+    columns = [col for col in GROUP_COLUMNS if col in df.columns]
+    if not columns:
+        recent = df.iloc[-n:]
+        return recent, np.zeros(len(recent), dtype=np.int64), np.arange(len(recent))
+
+    # Only group the tail of df that holds the last n readings (or all) of every device
+    keys = np.zeros(len(df), dtype=np.int64)
+    for col in columns:
+        values = df[col]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            col_codes, col_size = values.cat.codes.to_numpy(), len(values.cat.categories)
+        else:
+            col_codes, uniques = pd.factorize(values)
+            col_size = len(uniques)
+        keys = keys * (col_size + 1) + col_codes + 1  # Missing values (code -1) are a group of their own
+    needed = np.minimum(np.bincount(keys), n)
+    size = min(len(df), 4 * int(needed.sum()))
+    while size < len(df) and (np.bincount(keys[-size:], minlength=len(needed)) < needed).any():
+        size = min(len(df), size * 4)
+
+    # Sort that tail by group (time order kept within groups) and keep the last n rows of each
+    tail_keys = keys[-size:]
+    order = np.argsort(tail_keys, kind='stable')
+    sorted_keys = tail_keys[order]
+    starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+    sizes = np.diff(np.r_[starts, len(sorted_keys)])
+    index_in_group = np.arange(len(sorted_keys)) - np.repeat(starts, sizes)
+    position = index_in_group - np.repeat(np.maximum(sizes - n, 0), sizes)
+    codes = np.empty(size, dtype=np.int64)
+    positions = np.empty(size, dtype=np.int64)
+    codes[order] = np.repeat(np.arange(len(starts)), sizes)
+    positions[order] = position
+    keep = np.flatnonzero(positions >= 0)
+    return df.iloc[len(df) - size + keep], codes[keep], positions[keep]
+
+
+def _group_slopes(values, codes, positions, n_groups):
+    """Least-squares slope per reading of each column within each group. Returns: (groups x columns)"""
+    counts = np.bincount(codes, minlength=n_groups).astype(np.float64)
+    x = positions - (counts[codes] - 1) / 2  # Centered reading index
+    x_var = np.bincount(codes, x * x, minlength=n_groups)
+    slopes = np.empty((n_groups, values.shape[1]))
+    for j in range(values.shape[1]):
+        y = values[:, j]
+        y_mean = np.bincount(codes, y, minlength=n_groups) / counts
+        slopes[:, j] = np.bincount(codes, x * (y - y_mean[codes]), minlength=n_groups) / x_var
+    return slopes
+
+
+def evaluate_rules(df, moments_by_crop=None, crop_rules=None):
+    """
+    Range and trend rules for the latest readings of every device in df, and
+    correlation rules for each crop's statistics over the timeframe.
+    moments_by_crop: crop number (None when df has no crop column) -> sensor_stats.Moments
+    Returns: DataFrame with ALERT_COLUMNS, most severe first
+    """
+    params = [param for param in DEFAULT_RULES["ranges"] if param in df.columns]
+    alerts = []
+    if len(df) and params:
+        crops_rules = {}
+        n = max(rules_for(crop, crop_rules)["trend_readings"]
+                for crop in [None, *(CROP_RULES if crop_rules is None else crop_rules)])
+        recent, codes, positions = recent_readings(df, n)
+        n_groups = int(codes.max()) + 1
+        values = recent[params].to_numpy(dtype=np.float64, na_value=np.nan)
+        last = np.zeros(n_groups, dtype=np.int64)
+        last[codes] = np.arange(len(recent))  # Rows are in time order, so the last write wins
+        latest = values[last]
+        counts = np.bincount(codes, minlength=n_groups)
+
+        # Per-device thresholds, from the rules of each device's crop
+        crops = (recent['crop_number'].to_numpy(dtype=object, na_value=None)[last]
+                 if 'crop_number' in recent.columns else np.full(n_groups, None))
+        macs = (recent['mac_address'].to_numpy(dtype=object, na_value=None)[last]
+                if 'mac_address' in recent.columns else np.full(n_groups, None))
+        low, high = np.empty((n_groups, len(params))), np.empty((n_groups, len(params)))
+        slope_limit, readings = np.empty(n_groups), np.empty(n_groups, dtype=np.int64)
+        group_rules = []
+        for g, crop in enumerate(crops):
+            crop = None if crop is None else int(crop)
+            rules = crops_rules.setdefault(crop, rules_for(crop, crop_rules))
+            group_rules.append(rules)
+            low[g], high[g] = np.array([rules["ranges"][param] for param in params], dtype=np.float64).T
+            slope_limit[g], readings[g] = rules["trend_slope"], rules["trend_readings"]
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            width = np.where(high > low, high - low, 1.0)
+            range_score = 1 + np.maximum(low - latest, latest - high) / width
+            range_score[~((latest < low) | (latest > high))] = 0.0
+
+            # Trend over each device's last trend_readings readings (fewer and the device is skipped)
+            in_window = positions >= counts[codes] - readings[codes]
+            slopes = _group_slopes(values[in_window], codes[in_window], positions[in_window]
+                                   - (counts[codes] - readings[codes])[in_window], n_groups)
+            slopes[counts < readings] = np.nan
+            trend_score = np.abs(slopes) / slope_limit[:, None]
+            trend_score[~(trend_score > 1)] = 0.0
+
+        for g, j in zip(*np.nonzero(range_score)):
+            value = _reading(latest[g, j])
+            state = "too low" if latest[g, j] < low[g, j] else "too high"
+            min_val, max_val = group_rules[g]["ranges"][params[j]]
+            alerts.append((range_score[g, j], "range", crops[g], macs[g], params[j], value,
+                           f"⚠️ {_title(params[j])} is {state} ({value}){_where(crops[g], macs[g])}. "
+                           f"Optimal range: {min_val}-{max_val}."))
+        for g, j in zip(*np.nonzero(trend_score)):
+            direction = "increasing" if slopes[g, j] > 0 else "decreasing"
+            alerts.append((trend_score[g, j], "trend", crops[g], macs[g], params[j], slopes[g, j],
+                           f"📈 {_title(params[j])} is {direction} significantly{_where(crops[g], macs[g])}."))
+
+    for crop, moments in (moments_by_crop or {}).items():
+        columns = [param for param in params if param in moments.columns]
+        if len(columns) < 2:
+            continue
+        threshold = rules_for(crop, crop_rules)["correlation"]
+        corr = moments.select(columns).corr().to_numpy()
+        rows, cols = np.triu_indices(len(columns), k=1)  # Each pair once
+        strength = np.abs(corr[rows, cols])
+        for k in [k for k in np.argsort(-strength, kind='stable') if strength[k] > threshold][:CORRELATION_ALERTS]:
+            i, j = rows[k], cols[k]
+            alerts.append((strength[k] / threshold, "correlation", crop, None, f"{columns[i]}/{columns[j]}", corr[i, j],
+                           f"🔗 Strong correlation ({corr[i, j]:.2f}) between {_title(columns[i])} and "
+                           f"{_title(columns[j])}{_where(crop, None)}."))
+
+    result = pd.DataFrame(alerts, columns=ALERT_COLUMNS)
+    return result.sort_values("severity", ascending=False, kind='stable').reset_index(drop=True)
+
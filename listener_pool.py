@@ -0,0 +1,221 @@
+"""
+Scaled-out MQTT listener for large sensor fleets.
+
+A pool of worker processes, each with its own MQTT client, ingest queue and
+batching writer, shares the sensor topic through an MQTT shared subscription
+($share/<group>/<topic>, so the broker hands every message to exactly one
+worker) or takes one topic filter each from worker_topics. Workers only decode
+and validate; their batches go to the main process, which merges them in
+timestamp order and is the only writer of the CSV, JSON Lines, SQLite and
+rollup files, so the dashboard still reads one consistent dataset.
+
+    python3 listener_pool.py              # worker_processes from mqtt_listener.py
+    python3 listener_pool.py --workers 8
+
+Configuration (broker, storage, batching, worker_topics, merge_delay) lives in
+mqtt_listener.py.
+"""
+import argparse
+import heapq
+import itertools
+import logging
+import multiprocessing
+import queue
+import signal
+import time
+
+import paho.mqtt.client as mqtt
+
+import mqtt_listener as listener
+
+RESTART_DELAY = 5.0  # Seconds between restarts of a worker that exited
+
+
+class QueueSink:
+    """Sink of a worker's IngestWriter: hands each batch to the merging writer"""
+
+    def __init__(self, merge_queue, index):
+        self.merge_queue = merge_queue
+        self.path = f"worker {index} merge queue"  # Used in log messages and metric labels
+
+    def write_batch(self, records):
+        if records:
+            self.merge_queue.put(records)  # Blocks while the merger is behind; the worker's sink queue absorbs it
+
+    def close(self):
+        pass
+
+
+def worker_topic_filter(index):
+    if listener.worker_topics:
+        return listener.worker_topics[index]
+    return f"$share/{listener.shared_subscription_group}/{listener.topic}"
+
+
+def run_worker(index, topic_filter, merge_queue, stop_event):
+    """Worker process: receive, decode and validate messages and pass the records to merge_queue"""
+    # The main process stops workers through stop_event, after they've passed on what they hold
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    logging.basicConfig(level=logging.INFO, format=f'%(asctime)s - worker {index} - %(levelname)s - %(message)s',
+                        force=True)
+
+    writer = listener.IngestWriter([QueueSink(merge_queue, index)], batch_size=listener.batch_size,
+                                   batch_interval=listener.batch_interval,
+                                   stats_interval=listener.stats_log_interval)
+    writer.start()
+    listener.serve_metrics(listener.metrics_port + 1 + index)
+
+    listener.topic = topic_filter  # Subscribed to by on_connect
+    client = mqtt.Client()
+    client.on_connect = listener.on_connect
+    client.on_message = listener.on_message
+    try:
+        client.connect(listener.broker_address, listener.port, 60)
+        logging.info(f"Connecting to broker at {listener.broker_address}:{listener.port}, subscribing to {topic_filter}")
+        client.loop_start()
+        stop_event.wait()
+        client.loop_stop()
+        client.disconnect()
+    except Exception as e:
+        logging.error(f"Failed to connect to broker: {str(e)}")
+    finally:
+        writer.stop()
+        logging.info(f"Final ingest stats: {listener.ingest_stats.as_dict()}")
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt  # Stop cleanly on SIGTERM (systemctl stop) as on Ctrl-C
+
+
+def _timestamp_key(record):
+    timestamp = record.get("timestamp")
+    return timestamp if isinstance(timestamp, (int, float)) else 0.0
+
+
+class MergeWriter(listener.IngestWriter):
+    """
+    Writes the workers' batches to the storage sinks. Records are held for
+    merge_delay seconds after their timestamp and released in timestamp order,
+    so rows arriving through different workers are appended in time order
+    (anything later than that is still written, just out of order). Duplicates
+    are dropped here rather than in the workers, since the copies of a resent
+    payload may reach different workers.
+    """
+
+    def __init__(self, sinks, merge_queue, merge_delay=2.0, **kwargs):
+        super().__init__(sinks, **kwargs)
+        self.name = "merge-writer"
+        self.merge_queue = merge_queue
+        self.merge_delay = merge_delay
+        self._pending = []  # Heap of (timestamp, sequence, record)
+        self._sequence = itertools.count()
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def run(self):
+        self.start_sinks()
+        last_flush = time.monotonic()
+        last_stats_log = time.monotonic()
+
+        while True:
+            stopping = self._stop_event.is_set()
+            try:
+                records = self.merge_queue.get(timeout=0.2) if not stopping else self.merge_queue.get_nowait()
+                now = time.time()  # A device clock running ahead must not hold its records back
+                for record in records:
+                    if self.is_duplicate(record):
+                        continue
+                    heapq.heappush(self._pending, (min(_timestamp_key(record), now), next(self._sequence), record))
+            except queue.Empty:
+                if stopping:
+                    self.flush(self._release(float('inf')))
+                    break
+
+            if self._pending and (time.monotonic() - last_flush >= self.batch_interval
+                                  or len(self._pending) >= self.batch_size * 10):
+                last_flush = time.monotonic()
+                self.flush(self._release(time.time() - self.merge_delay))
+
+            if not stopping:
+                self.run_jobs()
+
+            if time.monotonic() - last_stats_log >= self.stats_interval:
+                last_stats_log = time.monotonic()
+                self.log_stats()
+
+        self.close_sinks()
+
+    def _release(self, cutoff):
+        """Pop the held records with a timestamp up to cutoff, oldest first"""
+        batch = []
+        while self._pending and self._pending[0][0] <= cutoff:
+            batch.append(heapq.heappop(self._pending)[2])
+        return batch
+
+    def backlog(self):
+        return (f"{self.merge_queue.qsize()} batch(es) from the workers, {self.pending} record(s) held for ordering; "
+                f"{self.sink_backlog()}")
+
+    def log_stats(self):
+        logging.info(f"Merge stats: written {listener.ingest_stats.written} records in "
+                     f"{listener.ingest_stats.batches} batches, {self.pending} held for ordering")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--workers", type=int, default=listener.worker_processes,
+                        help="Worker processes (default: worker_processes in mqtt_listener.py)")
+    args = parser.parse_args()
+    if listener.worker_topics:
+        args.workers = len(listener.worker_topics)  # One worker per topic filter
+    if args.workers < 1:
+        parser.error("at least one worker is needed")
+    signal.signal(signal.SIGTERM, _interrupt)
+
+    # Workers are spawned before any file, database or thread is opened here
+    context = multiprocessing.get_context("spawn")
+    merge_queue = context.Queue(maxsize=listener.merge_queue_size)
+    stop_event = context.Event()
+    workers = {}  # index -> (process, start time)
+
+    def start_worker(index):
+        process = context.Process(target=run_worker, name=f"listener-worker-{index}", daemon=True,
+                                  args=(index, worker_topic_filter(index), merge_queue, stop_event))
+        process.start()
+        workers[index] = (process, time.monotonic())
+
+    for index in range(args.workers):
+        start_worker(index)
+    logging.info(f"Started {args.workers} worker process(es)")
+
+    sinks, jsonl_writer, sqlite_store = listener.open_sinks()
+    writer = MergeWriter(sinks, merge_queue, merge_delay=listener.merge_delay, batch_size=listener.batch_size,
+                         batch_interval=listener.batch_interval, stats_interval=listener.stats_log_interval,
+                         jobs=listener.maintenance_jobs(jsonl_writer, sqlite_store), dedup=listener.duplicate_filter())
+    writer.start()
+    listener.metrics.gauge_function("agri_listener_merge_pending", "Records held by the merger for ordering",
+                                    lambda: writer.pending)
+    listener.serve_metrics()
+
+    try:
+        while True:
+            for index, (process, started) in list(workers.items()):
+                process.join(timeout=1.0 / len(workers))
+                if not process.is_alive() and time.monotonic() - started >= RESTART_DELAY:
+                    logging.error(f"Worker {index} exited with code {process.exitcode} - restarting it")
+                    start_worker(index)
+    except KeyboardInterrupt:
+        logging.info("Stopping listener")
+    finally:
+        stop_event.set()
+        for process, _ in workers.values():
+            process.join(timeout=15.0)  # The merger keeps draining merge_queue meanwhile
+        writer.stop()
+        logging.info(f"Final ingest stats: {listener.ingest_stats.as_dict()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,25 @@
 import paho.mqtt.client as mqtt
+import ast
 import csv
 import time
 import json
 import logging
+import math
 import re
-import os
-from datetime import datetime
+import queue
+import threading
+import traceback
+
+try:
+    import orjson  # Optional, several times faster than the json module
+    json_loads = orjson.loads
+except ImportError:
+    orjson = None
+    json_loads = json.loads
+
+from listener_metrics import WRITE_BUCKETS, MetricsRegistry, start_metrics_server
+from sensor_store import (PARQUET_AVAILABLE, DuplicateFilter, JsonlWriter, LatestSnapshot, ParquetArchive, RollupStore,
+                          SqliteStore, archive_jsonl, migrate_json_array, truncate_failed_append)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -17,7 +31,55 @@ topic = "agri_sensor/data"
 
 # File Details
 csv_file = "sensor_data.csv"
-json_file = "sensor_data.json"
+json_file = "sensor_data.json"  # Legacy JSON array file, migrated to JSON Lines on startup
+jsonl_file = "sensor_data.jsonl"
+jsonl_fsync_every = 20  # fsync after this many records...
+jsonl_fsync_interval = 5.0  # ...or after this many seconds, whichever comes first
+sqlite_enabled = False  # Also write records to an indexed SQLite database (set STORAGE_BACKEND = "sqlite" in the dashboard)
+sqlite_file = "sensor_data.db"
+rollups_enabled = True  # Maintain hourly/daily rollups used by the dashboard's aggregations and long-range charts
+rollup_file = "sensor_rollups.db"
+latest_enabled = True  # Keep the latest reading of each device in a snapshot file for the dashboard's gauges
+latest_file = "sensor_latest.json"
+
+# Parquet archive (requires pyarrow): records older than archive_after_days are moved
+# out of the JSON Lines/SQLite hot stores into time-partitioned Parquet files
+archive_enabled = False
+archive_dir = "archive"
+archive_partition = "month"  # "month" or "day"
+archive_after_days = 7
+archive_interval = 3600.0  # Seconds between compaction runs
+
+# Ingest pipeline
+ingest_queue_size = 10000  # Messages buffered between the MQTT network thread and the writer thread
+enqueue_timeout = 0.05  # Seconds on_message waits for queue space before dropping a message
+batch_size = 100  # Write a batch once it holds this many records...
+batch_interval = 1.0  # ...or once its oldest record is this many seconds old
+stats_log_interval = 60.0  # Seconds between ingest statistics log lines
+log_rate_interval = 60.0  # Per-message warnings/errors are limited to log_rate_burst of each kind...
+log_rate_burst = 5  # ...per log_rate_interval seconds; the rest are counted and summarized
+sink_queue_size = 1000  # Batches a storage sink may fall behind by before its new batches are dropped
+sink_max_batch = 5000  # A sink that fell behind writes up to this many of its queued records at once
+sink_retries = 3  # Attempts per write before a sink gives up on a batch...
+sink_retry_delay = 0.5  # ...waiting this many seconds after the first failure, doubling after each
+
+# Ingest-time deduplication: a record repeating a recent one (same device, crop, device date/time and readings) is dropped
+dedup_enabled = True
+dedup_max_keys = 50000  # Recent records remembered, least recently seen forgotten first
+dedup_undated_window = 10.0  # Without device date/time, identical readings are only duplicates this many seconds apart
+
+# Prometheus-style metrics endpoint (http://metrics_address:metrics_port/metrics)
+metrics_enabled = True
+metrics_address = "127.0.0.1"  # Use "0.0.0.0" to let a Prometheus server on another host scrape it
+metrics_port = 9108  # listener_pool.py workers serve theirs on metrics_port + 1, + 2, ...
+
+# Scaled-out mode (python3 listener_pool.py): worker processes share the topic and decode and validate
+# in parallel; the main process merges their records and is the only one writing the storage files
+worker_processes = 4
+shared_subscription_group = "agri_listener"  # Workers subscribe to $share/<group>/<topic> (MQTT shared subscription)
+worker_topics = None  # Or one topic filter per worker, e.g. ["agri_sensor/data/0", "agri_sensor/data/1"], to shard by topic
+merge_queue_size = 1000  # Batches buffered between the workers and the merging writer
+merge_delay = 2.0  # Seconds records are held so that batches from different workers are written in timestamp order
 fieldnames = ["timestamp", "mac_address", "crop_number", "date", "time", "soil_moisture", "soil_nitrogen", "soil_phosphorus", 
               "soil_potassium", "soil_temperature", "soil_conductivity", "soil_ph", "air_temperature", "air_humidity"]
 
@@ -35,6 +97,38 @@ VALIDATION_RANGES = {
     "crop_number": {"min": 0, "max": 100, "type": "int", "unit": ""}
 }
 
+# Listener metrics; the queue and ingest counters are registered with the ingest queue below
+metrics = MetricsRegistry()
+decode_paths = metrics.counter("agri_listener_decode_total",
+                               "Payloads by decode path (single, double, stdlib, unescape, failed)", ["path"])
+decode_seconds = metrics.histogram("agri_listener_decode_seconds", "Time spent decoding a payload")
+validate_seconds = metrics.histogram("agri_listener_validate_seconds", "Time spent validating a decoded payload")
+validation_rejections = metrics.counter("agri_listener_validation_rejections_total",
+                                        "Fields that failed validation, by field", ["field"])
+sink_write_seconds = metrics.histogram("agri_listener_sink_write_seconds",
+                                       "Time spent writing a batch to a storage sink", ["sink"], buckets=WRITE_BUCKETS)
+sink_write_errors = metrics.counter("agri_listener_sink_write_errors_total", "Failed batch writes, by sink", ["sink"])
+sink_write_retries = metrics.counter("agri_listener_sink_write_retries_total", "Retried batch writes, by sink", ["sink"])
+sink_dropped_records = metrics.counter("agri_listener_sink_dropped_records_total",
+                                       "Records a sink never stored (queue full or retries exhausted), by sink", ["sink"])
+
+MAC_ADDRESS_PATTERN = re.compile(r'^([0-9A-Fa-f]{2}:){5}[0-9A-Fa-f]{2}$')  # XX:XX:XX:XX:XX:XX where X is hex digit
+
+def _to_int(value):
+    return int(float(value))  # Convert via float first to handle "10.0" strings
+
+def compile_validation_schema(ranges):
+    """
+    Flatten validation ranges into (field, cast, min, max, unit) tuples so that
+    validating a message does not look anything up in the ranges dict.
+    """
+    return tuple(
+        (field_name, _to_int if config["type"] == "int" else float, config["min"], config["max"], config["unit"])
+        for field_name, config in ranges.items()
+    )
+
+VALIDATION_SCHEMA = compile_validation_schema(VALIDATION_RANGES)
+
 def validate_value(field_name, value, ranges=VALIDATION_RANGES):
     """
     Validate sensor value against defined ranges.
@@ -70,14 +164,12 @@ def validate_mac_address(mac_address):
     if mac_address is None or mac_address == "":
         return True, None, None
     
-    # Pattern: XX:XX:XX:XX:XX:XX where X is hex digit
-    pattern = r'^([0-9A-Fa-f]{2}:){5}[0-9A-Fa-f]{2}$'
-    if re.match(pattern, str(mac_address)):
+    if MAC_ADDRESS_PATTERN.match(str(mac_address)):
         return True, mac_address.upper(), None
     else:
         return False, None, f"Invalid MAC address format: {mac_address}"
 
-def validate_sensor_data(data):
+def validate_sensor_data(data, schema=VALIDATION_SCHEMA):
     """
     Validate all sensor data fields.
     Returns: (is_valid, validated_data, errors)
@@ -88,19 +180,28 @@ def validate_sensor_data(data):
     # Validate MAC address
     is_valid, mac_value, error = validate_mac_address(data.get("mac_address"))
     if not is_valid:
+        validation_rejections.inc("mac_address")
         errors.append(error)
         return False, None, errors
     validated_data["mac_address"] = mac_value
     
-    # Validate numeric fields
-    for field_name in VALIDATION_RANGES.keys():
+    # Validate numeric fields (same rules as validate_value, using the compiled schema)
+    for field_name, cast, min_value, max_value, unit in schema:
         value = data.get(field_name)
-        is_valid, validated_value, error = validate_value(field_name, value)
-        
-        if not is_valid:
-            errors.append(error)
+        if value is None or value == "":
+            validated_data[field_name] = None
+            continue
+        try:
+            value = cast(value)
+        except (ValueError, TypeError):
+            validation_rejections.inc(field_name)
+            errors.append(f"{field_name} has invalid type: {value} ({type(value).__name__})")
+            continue
+        if value < min_value or value > max_value:
+            validation_rejections.inc(field_name)
+            errors.append(f"{field_name} value {value} out of range [{min_value}, {max_value}] {unit}")
         else:
-            validated_data[field_name] = validated_value
+            validated_data[field_name] = value
     
     # Copy non-validated fields (timestamp, date, time)
     validated_data["timestamp"] = data.get("timestamp")
@@ -113,119 +214,579 @@ def validate_sensor_data(data):
     else:
         return True, validated_data, []
 
-# Initialize CSV file with header if it doesn't exist
-try:
-    with open(csv_file, 'x', newline='') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-except FileExistsError:
-    pass  # File already exists, continue
+def init_csv_file():
+    """Create the CSV file with a header row if it doesn't exist"""
+    try:
+        with open(csv_file, 'x', newline='') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+            writer.writeheader()
+    except FileExistsError:
+        pass  # File already exists, continue
+
+class CsvWriter:
+    """Appends records to the CSV file, keeping the file handle open between batches"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._writer = None
+
+    def open(self):
+        if self._file is None:
+            self._file = open(self.path, 'a', newline='')
+            self._writer = csv.DictWriter(self._file, fieldnames=fieldnames)
+        return self
+
+    def write_batch(self, records):
+        if not records:
+            return
+        self.open()
+        offset = self._file.tell()
+        try:
+            self._writer.writerows(records)
+            self._file.flush()
+        except Exception:
+            truncate_failed_append(self._file, self.path, offset)
+            self._file = None
+            self._writer = None
+            raise
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._writer = None
+
+class IngestStats:
+    """
+    Counters for the ingest pipeline. Each counter is only incremented by one
+    thread (paho's network thread, the writer thread, or the sink thread that
+    finishes a batch last, under IngestWriter's lock), so no lock is needed.
+    """
+
+    def __init__(self):
+        self.enqueued = 0        # Messages handed to the writer thread
+        self.blocked = 0         # Enqueues that had to wait because the queue was full (back-pressure)
+        self.dropped = 0         # Messages dropped after waiting enqueue_timeout
+        self.processed = 0       # Messages decoded and validated by the writer thread
+        self.rejected = 0        # Messages that failed decoding or validation
+        self.duplicates = 0      # Records dropped as repeats of a recent record
+        self.written = 0         # Records handled by every sink
+        self.batches = 0         # Batches handled by every sink
+        self.max_queue_depth = 0
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+class RateLimitedLog:
+    """
+    Logs at most `burst` messages of each kind per `interval` seconds, so a
+    misbehaving sensor can't flood the log (or slow ingest down with log I/O).
+    The number of suppressed messages is logged when the next interval starts.
+    """
+
+    def __init__(self, interval=60.0, burst=5):
+        self.interval = interval
+        self.burst = burst
+        self._windows = {}  # kind -> [window_start, logged, suppressed]
+
+    def log(self, level, kind, message):
+        now = time.monotonic()
+        window = self._windows.get(kind)
+        if window is None or now - window[0] >= self.interval:
+            if window is not None and window[2]:
+                logging.log(level, f"{window[2]} '{kind}' message(s) suppressed in the last {self.interval:.0f}s")
+            window = self._windows[kind] = [now, 0, 0]
+        if window[1] < self.burst:
+            window[1] += 1
+            logging.log(level, message)
+        else:
+            window[2] += 1
+
+# Ingest queue between paho's network thread and the writer thread
+ingest_queue = queue.Queue(maxsize=ingest_queue_size)
+ingest_stats = IngestStats()
+message_log = RateLimitedLog(log_rate_interval, log_rate_burst)
+
+metrics.gauge_function("agri_listener_queue_depth", "Messages waiting in the ingest queue", ingest_queue.qsize)
+for _metric, _counter, _documentation in [
+    ("agri_listener_messages_enqueued_total", "enqueued", "Messages handed to the writer thread"),
+    ("agri_listener_messages_blocked_total", "blocked", "Enqueues that had to wait for queue space"),
+    ("agri_listener_messages_dropped_total", "dropped", "Messages dropped because the ingest queue stayed full"),
+    ("agri_listener_messages_processed_total", "processed", "Messages decoded and validated"),
+    ("agri_listener_messages_rejected_total", "rejected", "Messages that failed decoding or validation"),
+    ("agri_listener_messages_duplicate_total", "duplicates", "Records dropped as repeats of a recent record"),
+    ("agri_listener_records_written_total", "written", "Records written to storage"),
+    ("agri_listener_batches_total", "batches", "Batches written to storage"),
+]:
+    metrics.counter_function(_metric, _documentation, lambda _counter=_counter: getattr(ingest_stats, _counter))
+metrics.gauge_function("agri_listener_max_queue_depth", "Deepest the ingest queue has been",
+                       lambda: ingest_stats.max_queue_depth)
 
 def on_connect(client, userdata, flags, rc):
     logging.info(f"Connected with result code {rc}")
     client.subscribe(topic)
 
 def on_message(client, userdata, msg):
+    """Hand the raw payload to the writer thread without blocking paho's network thread for long"""
+    item = (msg.payload, time.time())
     try:
-        payload_str = msg.payload.decode('utf-8').strip()
-        logging.info(f"Received message: {payload_str}")
-        
-        import ast
+        ingest_queue.put_nowait(item)
+    except queue.Full:
+        ingest_stats.blocked += 1
         try:
-            # Try to parse the JSON directly
-            data = json.loads(payload_str)
-            logging.info("JSON parsed successfully (single decode)")
-        except json.JSONDecodeError as e:
-            logging.warning(f"First JSON decode failed: {str(e)}. Attempting second decode (double-encoded payload)...")
+            ingest_queue.put(item, timeout=enqueue_timeout)
+        except queue.Full:
+            ingest_stats.dropped += 1
+            if ingest_stats.dropped % 100 == 1:
+                logging.warning(f"Ingest queue full - {ingest_stats.dropped} message(s) dropped so far")
+            return
+    ingest_stats.enqueued += 1
+
+def _decode_fallback(payload):
+    """Slow path for payloads the fast parser rejects. Returns: decoded object or None"""
+    try:
+        payload_str = payload.decode('utf-8').strip()
+        if orjson is not None:
             try:
-                data = json.loads(json.loads(payload_str))
-                logging.info("JSON parsed successfully (double decode)")
-            except Exception as e2:
-                logging.warning(f"Double-decoding also failed: {str(e2)}. Attempting to unescape and decode...")
-                try:
-                    unescaped = ast.literal_eval(f"'{payload_str}'")
-                    data = json.loads(unescaped)
-                    logging.info("JSON parsed successfully (after unescape)")
-                except Exception as e3:
-                    logging.error(f"Unescape and decode also failed: {str(e3)}")
-                    logging.error(f"Raw payload bytes: {msg.payload}")
-                    return
-        
+                data = json.loads(payload_str)  # json accepts NaN/Infinity, orjson doesn't
+                decode_paths.inc("stdlib")
+                return data
+            except ValueError:
+                pass
+        # Escaped JSON, e.g. {\"soil_ph\": 6.5}
+        data = json_loads(ast.literal_eval(f"'{payload_str}'"))
+        decode_paths.inc("unescape")
+        return data
+    except Exception as e:
+        decode_paths.inc("failed")
+        message_log.log(logging.ERROR, "decode", f"Could not decode payload ({str(e)}): {payload[:200]!r}")
+        return None
+
+def decode_payload(payload):
+    """
+    Decode an MQTT payload, accepting plain, double-encoded and escaped JSON.
+    Plain JSON is parsed straight from the payload bytes; the slower fallbacks
+    only run when that fails.
+    Returns: decoded object or None
+    """
+    if logging.root.isEnabledFor(logging.DEBUG):
+        logging.debug(f"Received message: {payload!r}")
+
+    try:
+        data = json_loads(payload)  # orjson and json both raise ValueError subclasses
+        if not isinstance(data, str):
+            decode_paths.inc("single")
+    except ValueError:
+        data = _decode_fallback(payload)
+
+    if isinstance(data, str):
+        # Double-encoded payload: the first decode returned the JSON text
+        try:
+            data = json_loads(data)
+            decode_paths.inc("double")
+        except ValueError as e:
+            decode_paths.inc("failed")
+            message_log.log(logging.ERROR, "decode", f"Double-encoded payload could not be decoded ({str(e)}): {payload[:200]!r}")
+            return None
+    return data
+
+def record_timestamp(value, received_at):
+    """
+    Epoch seconds to store for a message's timestamp field: the value itself if it
+    is a finite number (numeric text is converted), otherwise the arrival time.
+    Every store needs a timestamp; SQLite rejects a whole batch over a null one.
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value if math.isfinite(value) else received_at
+    if isinstance(value, str):
+        try:
+            number = float(value)
+        except ValueError:
+            return received_at
+        return number if math.isfinite(number) else received_at
+    return received_at
+
+def process_message(payload, received_at):
+    """
+    Decode, normalize and validate one payload.
+    Returns: record ready to be stored, or None if it was rejected
+    """
+    try:
+        start = time.perf_counter()
+        data = decode_payload(payload)
+        decode_seconds.observe(time.perf_counter() - start)
+        if data is None:
+            return None
+
         # Create a normalized data dictionary with lowercase keys
-        normalized_data = {}
-        for key, value in data.items():
-            normalized_key = key.lower()
-            normalized_data[normalized_key] = value
-        
-        # Add timestamp if not present
-        if "timestamp" not in normalized_data:
-            normalized_data["timestamp"] = time.time()
-        
+        normalized_data = {key.lower(): value for key, value in data.items()}
+
+        # Use the time the message arrived (not when it was processed) when it has no usable timestamp
+        normalized_data["timestamp"] = record_timestamp(normalized_data.get("timestamp"), received_at)
+
         # Validate sensor data
+        start = time.perf_counter()
         is_valid, validated_data, errors = validate_sensor_data(normalized_data)
-        
+        validate_seconds.observe(time.perf_counter() - start)
+
         if not is_valid:
-            logging.error(f"❌ DATA VALIDATION FAILED - Data rejected and NOT saved!")
-            for error in errors:
-                logging.error(f"  - {error}")
-            logging.error(f"  Rejected data: {normalized_data}")
-            return  # Do not save invalid data
-        
-        logging.info("✓ Data validation passed")
-        
-        # Ensure all fields are present in the validated data
-        for field in fieldnames:
-            if field not in validated_data:
-                validated_data[field] = None
-        
-        # Write to CSV file
-        with open(csv_file, 'a', newline='') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writerow(validated_data)
-        
-        # Save to JSON file
-        save_to_json(validated_data)
-        
-        logging.info(f"Data saved to CSV and JSON: {validated_data}")
+            message_log.log(logging.ERROR, "validation",
+                            f"❌ DATA VALIDATION FAILED - Data rejected and NOT saved! {'; '.join(errors)} - Rejected data: {normalized_data}")
+            return None  # Do not save invalid data
+
+        # validate_sensor_data returns every field in fieldnames
+        return validated_data
     except Exception as e:
-        logging.error(f"Error processing message: {str(e)}")
-        import traceback
-        logging.error(traceback.format_exc())
+        message_log.log(logging.ERROR, "processing", f"Error processing message: {str(e)}\n{traceback.format_exc()}")
+        return None
 
-def save_to_json(data_entry):
-    """Save data to a JSON file, appending to an array or creating new file if needed"""
-    try:
-        # Load existing data if file exists
-        if os.path.exists(json_file) and os.path.getsize(json_file) > 0:
-            with open(json_file, 'r') as f:
+class SinkWorker(threading.Thread):
+    """
+    Writes batches to one sink on its own thread, so a slow or failing sink holds
+    up neither the other sinks nor the ingest queue. Batches that queue up while
+    a write is in progress are combined into one write of up to max_batch records.
+    A failed write is retried with exponential backoff (the CSV and JSON Lines
+    writers first cut off whatever part of the batch reached the file); when the
+    retries are used up, or the sink is queue_size batches behind, its records
+    are dropped for that sink only (and counted).
+
+    Each batch is submitted with a callback that is called once the sink is done
+    with it, whether it was stored or not. The sink itself is only used from
+    this thread while it runs, and only under `lock` (see IngestWriter.run_jobs).
+    """
+
+    def __init__(self, sink, queue_size=1000, max_batch=5000, retries=3, retry_delay=0.5):
+        super().__init__(name=f"sink-writer {sink.path}", daemon=True)
+        self.sink = sink
+        self.max_batch = max_batch
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop_event = threading.Event()
+        self._writing = 0  # Records of the write in progress
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    @property
+    def queued_records(self):
+        """Records queued or being written"""
+        with self._queue.mutex:
+            return self._writing + sum(len(batch) for batch, _ in self._queue.queue)
+
+    def submit(self, batch, done):
+        """Queue a batch without blocking. Returns: False if it was dropped"""
+        try:
+            self._queue.put_nowait((batch, done))
+            return True
+        except queue.Full:
+            sink_dropped_records.inc(self.sink.path, amount=len(batch))
+            message_log.log(logging.ERROR, f"sink full {self.sink.path}",
+                            f"{self.sink.path} is {self._queue.maxsize} batches behind - dropping a batch of {len(batch)} records")
+            done()
+            return False
+
+    def stop(self, timeout=10.0):
+        """Write whatever is queued, close the sink and stop the thread"""
+        self._stop_event.set()
+        self.join(timeout)
+
+    def run(self):
+        while True:
+            try:
+                batch, done = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                if self._stop_event.is_set():
+                    break
+                continue
+            # Catch up on whatever queued up during the previous write in one go
+            records, callbacks = list(batch), [done]
+            while len(records) < self.max_batch:
                 try:
-                    all_data = json.load(f)
-                    if not isinstance(all_data, list):
-                        all_data = [all_data]  # Convert to list if not already
-                except json.JSONDecodeError:
-                    logging.warning(f"Could not decode existing JSON file. Creating new file.")
-                    all_data = []
+                    batch, done = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                records.extend(batch)
+                callbacks.append(done)
+            self._writing = len(records)
+            self.write(records)
+            self._writing = 0
+            for done in callbacks:
+                done()
+
+        with self.lock:
+            self.sink.close()
+
+    def write(self, records):
+        """Write records to the sink, retrying failed writes. Returns: whether they were stored"""
+        delay = self.retry_delay
+        for attempt in range(1, self.retries + 1):
+            start = time.perf_counter()
+            try:
+                with self.lock:
+                    self.sink.write_batch(records)
+                sink_write_seconds.observe(time.perf_counter() - start, self.sink.path)
+                return True
+            except Exception as e:
+                sink_write_errors.inc(self.sink.path)
+                if attempt == self.retries:
+                    sink_dropped_records.inc(self.sink.path, amount=len(records))
+                    logging.error(f"Error writing batch of {len(records)} records to {self.sink.path}, "
+                                  f"giving up after {attempt} attempt(s): {str(e)}")
+                    return False
+                sink_write_retries.inc(self.sink.path)
+                logging.warning(f"Error writing batch of {len(records)} records to {self.sink.path} "
+                                f"(attempt {attempt}), retrying in {delay:.1f}s: {str(e)}")
+                self._stop_event.wait(delay)  # No waiting once the listener is stopping
+                delay *= 2
+
+class IngestWriter(threading.Thread):
+    """
+    Drains the ingest queue, processes messages and hands them to every sink in
+    batches. A batch is flushed when it reaches batch_size records or when
+    batch_interval seconds have passed since its first record. Each sink writes
+    on its own SinkWorker thread, so the sinks store a batch concurrently.
+
+    jobs is a list of (name, interval_seconds, function) maintenance tasks run
+    between batches (first run right after start) while every sink is paused, so
+    they never race with the sinks' writes. on_flush, if given, is called with
+    each batch once every sink is done with it (from that sink's thread).
+    dedup, if given, is a DuplicateFilter; records it recognizes are dropped.
+    """
+
+    def __init__(self, sinks, batch_size=100, batch_interval=1.0, stats_interval=60.0, jobs=(), on_flush=None,
+                 dedup=None):
+        super().__init__(name="ingest-writer", daemon=True)
+        self.sinks = sinks
+        self.dedup = dedup
+        self.sink_workers = [SinkWorker(sink, queue_size=sink_queue_size, max_batch=sink_max_batch,
+                                        retries=sink_retries, retry_delay=sink_retry_delay) for sink in sinks]
+        self.on_flush = on_flush
+        self.jobs = [[name, interval, function, float('-inf')] for name, interval, function in jobs]
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.stats_interval = stats_interval
+        self._stop_event = threading.Event()
+        self._done_lock = threading.Lock()
+
+    def stop(self, timeout=10.0):
+        """
+        Flush whatever is queued, wait for the sinks to store it and stop the thread.
+        The threads are daemons: whatever is still queued when the wait times out is
+        lost when the process exits, so it is logged.
+        """
+        self._stop_event.set()
+        self.join(timeout)
+        if self.is_alive() or any(worker.is_alive() for worker in self.sink_workers):
+            logging.error(f"Stopped before everything was stored, still queued: {self.backlog()}")
+
+    def backlog(self):
+        """What has not been stored yet, for log messages"""
+        return f"{ingest_queue.qsize()} message(s) in the ingest queue; {self.sink_backlog()}"
+
+    def sink_backlog(self):
+        queued = ", ".join(f"{worker.sink.path}: {worker.queued_records}" for worker in self.sink_workers)
+        return f"records queued per sink {queued}"
+
+    def start_sinks(self):
+        for worker in self.sink_workers:
+            worker.start()
+
+    def close_sinks(self):
+        """Let every sink write what it has queued, then close it"""
+        for worker in self.sink_workers:
+            worker.stop()
+
+    def run(self):
+        self.start_sinks()
+        batch = []
+        batch_started = None
+        last_stats_log = time.monotonic()
+
+        while True:
+            stopping = self._stop_event.is_set()
+            if batch_started is None:
+                timeout = 0.5
+            else:
+                timeout = max(0.0, batch_started + self.batch_interval - time.monotonic())
+
+            try:
+                payload, received_at = ingest_queue.get(timeout=timeout) if not stopping else ingest_queue.get_nowait()
+                ingest_stats.max_queue_depth = max(ingest_stats.max_queue_depth, ingest_queue.qsize() + 1)
+                ingest_stats.processed += 1
+                record = process_message(payload, received_at)
+                if record is None:
+                    ingest_stats.rejected += 1
+                elif not self.is_duplicate(record):
+                    batch.append(record)
+                    if batch_started is None:
+                        batch_started = time.monotonic()
+            except queue.Empty:
+                if stopping:
+                    self.flush(batch)
+                    break
+
+            if batch and (len(batch) >= self.batch_size
+                          or time.monotonic() - batch_started >= self.batch_interval):
+                self.flush(batch)
+                batch = []
+                batch_started = None
+
+            if not stopping:
+                self.run_jobs()
+
+            if time.monotonic() - last_stats_log >= self.stats_interval:
+                last_stats_log = time.monotonic()
+                self.log_stats()
+
+        self.close_sinks()
+
+    def is_duplicate(self, record):
+        """Whether dedup drops record (counted in ingest_stats)"""
+        if self.dedup is None or not self.dedup.is_duplicate(record):
+            return False
+        ingest_stats.duplicates += 1
+        return True
+
+    def run_jobs(self):
+        """Run the maintenance jobs that are due, with every sink paused between writes"""
+        for job in self.jobs:
+            name, interval, function, last_run = job
+            if time.monotonic() - last_run >= interval:
+                job[3] = time.monotonic()
+                locks = [worker.lock for worker in self.sink_workers]
+                for lock in locks:
+                    lock.acquire()
+                try:
+                    function()
+                except Exception as e:
+                    logging.error(f"Maintenance job '{name}' failed: {str(e)}")
+                finally:
+                    for lock in locks:
+                        lock.release()
+
+    def log_stats(self):
+        backlog = ", ".join(f"{worker.sink.path}: {worker.queue_depth}" for worker in self.sink_workers)
+        logging.info(f"Ingest stats: {ingest_stats.as_dict()} (queue depth {ingest_queue.qsize()}; "
+                     f"batches queued per sink {backlog})")
+
+    def flush(self, batch):
+        """Hand a batch to every sink"""
+        if not batch:
+            return
+        remaining = [len(self.sink_workers)]
+
+        def done():
+            with self._done_lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+                ingest_stats.written += len(batch)
+                ingest_stats.batches += 1
+            logging.info(f"Saved batch of {len(batch)} records to {len(self.sink_workers)} sink(s)")
+            if self.on_flush is not None:
+                self.on_flush(batch)
+
+        for worker in self.sink_workers:
+            worker.submit(batch, done)
+
+def compact_hot_store(jsonl_writer, sqlite_store, archive):
+    """Roll records older than archive_after_days out of the hot stores into the Parquet archive"""
+    cutoff = time.time() - archive_after_days * 86400
+    jsonl_writer.close()  # archive_jsonl replaces the file
+    try:
+        archive_jsonl(jsonl_file, archive, cutoff)
+    finally:
+        jsonl_writer.open()
+    if sqlite_store is not None:
+        deleted = sqlite_store.delete_before(cutoff)
+        if deleted:
+            logging.info(f"Deleted {deleted} archived records from {sqlite_file}")
+
+def open_sinks():
+    """
+    Open every configured storage sink.
+    Returns: (sinks, jsonl_writer, sqlite_store or None)
+    """
+    init_csv_file()
+
+    # Migrate the legacy JSON array (if any) and open the append-only JSON Lines store
+    migrate_json_array(json_file, jsonl_file)
+    jsonl_writer = JsonlWriter(jsonl_file, fsync_every=jsonl_fsync_every, fsync_interval=jsonl_fsync_interval).open()
+    sinks = [CsvWriter(csv_file).open(), jsonl_writer]
+    sqlite_store = None
+    if sqlite_enabled:
+        sqlite_store = SqliteStore(sqlite_file).open()
+        if sqlite_store.count() == 0:
+            sqlite_store.import_jsonl(jsonl_file)  # Seed a new database with the existing history
+        sinks.append(sqlite_store)
+    if rollups_enabled:
+        rollup_store = RollupStore(rollup_file).open()
+        if rollup_store.is_empty():
+            rollup_store.import_jsonl(jsonl_file)  # Seed rollups with the existing history
+        sinks.append(rollup_store)
+    if latest_enabled:
+        latest_snapshot = LatestSnapshot(latest_file).open()
+        if latest_snapshot.is_empty():
+            latest_snapshot.import_jsonl(jsonl_file)  # Seed the snapshot with the existing history
+        sinks.append(latest_snapshot)
+    return sinks, jsonl_writer, sqlite_store
+
+def maintenance_jobs(jsonl_writer, sqlite_store):
+    """Maintenance jobs for the writer thread that owns the storage sinks"""
+    jobs = []
+    if archive_enabled:
+        if PARQUET_AVAILABLE:
+            archive = ParquetArchive(archive_dir, partition=archive_partition)
+            jobs.append(("archive compaction", archive_interval, lambda: compact_hot_store(jsonl_writer, sqlite_store, archive)))
         else:
-            all_data = []
-        
-        # Append new data
-        all_data.append(data_entry)
-        
-        # Write back to file
-        with open(json_file, 'w') as f:
-            json.dump(all_data, f, indent=2)
-        
-    except Exception as e:
-        logging.error(f"Error saving to JSON: {str(e)}")
+            logging.error("archive_enabled is set but pyarrow is not installed - archiving disabled")
+    return jobs
 
-# Connect to MQTT broker
-client = mqtt.Client()
-client.on_connect = on_connect
-client.on_message = on_message
+def duplicate_filter():
+    """DuplicateFilter for the writer thread, or None if dedup is disabled"""
+    if not dedup_enabled:
+        return None
+    return DuplicateFilter(max_keys=dedup_max_keys, undated_window=dedup_undated_window)
 
-try:
-    client.connect(broker_address, port, 60)
-    logging.info(f"Connecting to broker at {broker_address}:{port}")
-    client.loop_forever()
-except Exception as e:
-    logging.error(f"Failed to connect to broker: {str(e)}")
+def serve_metrics(port=None):
+    """Start the metrics endpoint if it is enabled (on metrics_port unless port is given)"""
+    port = metrics_port if port is None else port
+    if metrics_enabled:
+        try:
+            start_metrics_server(metrics, metrics_address, port)
+        except OSError as e:
+            logging.error(f"Could not start metrics endpoint on {metrics_address}:{port}: {str(e)}")
+
+def main():
+    sinks, jsonl_writer, sqlite_store = open_sinks()
+
+    writer = IngestWriter(sinks, batch_size=batch_size, batch_interval=batch_interval,
+                          stats_interval=stats_log_interval, jobs=maintenance_jobs(jsonl_writer, sqlite_store),
+                          dedup=duplicate_filter())
+    writer.start()
+
+    serve_metrics()
+
+    # Connect to MQTT broker
+    client = mqtt.Client()
+    client.on_connect = on_connect
+    client.on_message = on_message
+
+    try:
+        client.connect(broker_address, port, 60)
+        logging.info(f"Connecting to broker at {broker_address}:{port}")
+        client.loop_forever()
+    except KeyboardInterrupt:
+        logging.info("Stopping listener")
+    except Exception as e:
+        logging.error(f"Failed to connect to broker: {str(e)}")
+    finally:
+        writer.stop()
+        logging.info(f"Final ingest stats: {ingest_stats.as_dict()}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,398 @@
+"""Data processing for the dashboard: cleaning and interpolation of sensor frames,
+downsampling for charts, and the shared in-process copy of the sensor history.
+
+Frames are expected to be sorted by timestamp. Cleaning works on a NumPy matrix
+of all sensor columns at once and never interpolates across devices or crops.
+"""
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from sensor_store import OUTLIER_RANGES, SENSOR_COLUMNS, IncrementalJsonlLoader, concat_frames, epoch_ns
+from sensor_stats import StreamingStats
+
+GROUP_COLUMNS = ('mac_address', 'crop_number')
+
+# Interpolate up to 10 consecutive missing values (reasonable for short sensor glitches),
+# then forward/backward fill up to 5 more
+INTERPOLATION_LIMIT = 10
+FILL_LIMIT = 5
+
+# Streaming cleaning: rows of each device that are recomputed when new rows arrive (an
+# interpolated gap reaches back INTERPOLATION_LIMIT + FILL_LIMIT rows), and rows of
+# context cleaned along with them. This approximates a full-history clean: when the
+# value closing a gap longer than CLEAN_REWRITE_ROWS arrives, only the last
+# CLEAN_REWRITE_ROWS rows of the gap are redone, and its earlier rows keep what was
+# filled in while the gap was still open
+CLEAN_REWRITE_ROWS = 20
+CLEAN_CONTEXT_ROWS = 40
+# How far back clean_tail looks for that context before falling back to a full clean
+CLEAN_TAIL_SCAN_ROWS = 5000
+
+
+def _group_codes(df):
+    columns = [col for col in GROUP_COLUMNS if col in df.columns]
+    if not columns:
+        return np.zeros(len(df), dtype=np.int64)
+    return df.groupby(columns, sort=False, dropna=False, observed=True).ngroup().to_numpy()
+
+
+def _fill_gaps(block):
+    """Interpolate and fill the NaN gaps of one device's (rows x sensors) matrix"""
+    filled = (pd.DataFrame(block)
+              .interpolate(method='linear', limit=INTERPOLATION_LIMIT, limit_direction='both')
+              .ffill(limit=FILL_LIMIT)
+              .bfill(limit=FILL_LIMIT))
+    return filled.to_numpy()
+
+
+def clean_and_interpolate_data(df, copy=True):
+    """
+    Clean data by replacing zeros and outliers with values interpolated within each device/crop.
+    Sensor columns come back as float32; with copy, the other columns are shared with df
+    rather than copied (only the sensor columns are replaced).
+    """
+    if df is None or len(df) == 0:
+        return df
+
+    columns = [col for col in SENSOR_COLUMNS if col in df.columns]
+    if not columns:
+        return df
+
+    values = df[columns].to_numpy(dtype=np.float64, copy=True)
+    low = np.array([OUTLIER_RANGES[col][0] for col in columns])
+    high = np.array([OUTLIER_RANGES[col][1] for col in columns])
+
+    # Exact zeros are sensor errors; outliers fall outside physical limits
+    with np.errstate(invalid='ignore'):
+        values[(values == 0) | (values < low) | (values > high)] = np.nan
+
+    # Group rows by device/crop (stable, so each group stays in time order) and fill each group's gaps
+    codes = _group_codes(df)
+    order = np.argsort(codes, kind='stable')
+    sorted_codes = codes[order]
+    boundaries = np.flatnonzero(np.diff(sorted_codes)) + 1
+    starts = np.concatenate(([0], boundaries))
+    ends = np.concatenate((boundaries, [len(order)]))
+
+    for start, end in zip(starts, ends):
+        rows = order[start:end]
+        block = values[rows]
+        if np.isnan(block).any():
+            values[rows] = _fill_gaps(block)
+
+    df_clean = df.copy(deep=False) if copy else df
+    df_clean[columns] = values.astype(np.float32)
+    return df_clean
+
+
+def clean_tail(raw, cleaned, n_previous):
+    """
+    Extend a cleaned frame with the rows appended to raw since it was cleaned.
+
+    raw is the full raw frame (RangeIndex, time order) whose first n_previous rows
+    were cleaned into cleaned. Only the new rows and the last CLEAN_REWRITE_ROWS
+    rows of each device that reported new data are recomputed, using
+    CLEAN_CONTEXT_ROWS rows of that device's history as context. Rows further back are
+    kept as they were, so the result can differ from clean_and_interpolate_data(raw)
+    inside gaps longer than CLEAN_REWRITE_ROWS (see above).
+    Returns: cleaned frame for all rows of raw
+    """
+    if cleaned is None or n_previous == 0 or len(cleaned) != n_previous or len(raw) < n_previous:
+        return clean_and_interpolate_data(raw)
+    if len(raw) == n_previous:
+        return cleaned
+
+    scan_start = max(0, n_previous - CLEAN_TAIL_SCAN_ROWS)
+    region = raw.iloc[scan_start:]
+    codes = _group_codes(region)
+    split = n_previous - scan_start
+
+    window_positions = []
+    rewrite_positions = []
+    for code in np.unique(codes[split:]):
+        positions = np.flatnonzero(codes == code)
+        k = np.searchsorted(positions, split)
+        if k < CLEAN_CONTEXT_ROWS and scan_start > 0:
+            # Not enough of this device's history in the scanned region; the
+            # device may have been silent for a long time, so clean everything
+            return clean_and_interpolate_data(raw)
+        window_positions.append(positions[max(0, k - CLEAN_CONTEXT_ROWS):])
+        rewrite_positions.append(positions[max(0, k - CLEAN_REWRITE_ROWS):])
+
+    window_positions = np.sort(np.concatenate(window_positions)) + scan_start
+    rewrite_positions = np.sort(np.concatenate(rewrite_positions)) + scan_start
+
+    window_clean = clean_and_interpolate_data(raw.iloc[window_positions])
+    rewrite_mask = np.isin(window_positions, rewrite_positions)
+
+    columns = [col for col in SENSOR_COLUMNS if col in raw.columns]
+    result = concat_frames([cleaned, raw.iloc[n_previous:]])
+    column_idx = [result.columns.get_loc(col) for col in columns]
+    result.iloc[rewrite_positions, column_idx] = window_clean[columns].to_numpy()[rewrite_mask]
+    return result
+
+
+def localize_timestamps(df, tz):
+    """
+    Frame with its timestamp column (naive UTC, or timezone-aware) in timezone tz.
+    Only the timestamp column is replaced; the other columns are shared with df.
+    """
+    timestamps = df['timestamp']
+    if not pd.api.types.is_datetime64_any_dtype(timestamps):
+        timestamps = pd.to_datetime(timestamps, utc=True)
+    elif timestamps.dt.tz is None:
+        timestamps = timestamps.dt.tz_localize('UTC')
+    elif str(timestamps.dt.tz) == str(tz):
+        return df
+    localized = df.copy(deep=False)
+    localized['timestamp'] = timestamps.dt.tz_convert(tz)
+    return localized
+
+
+def time_slice(df, start=None, end=None, assume_sorted=False):
+    """
+    Rows with start <= timestamp < end (either bound may be None). Frames sorted by
+    timestamp are sliced with a binary search instead of a mask over every row.
+    Checking that the frame is sorted takes a pass over every row, so callers whose
+    frames are always in time order (all frames the dashboard loads) pass assume_sorted.
+    """
+    timestamps = df['timestamp']
+    if not assume_sorted and not timestamps.is_monotonic_increasing:
+        mask = np.ones(len(df), dtype=bool)
+        if start is not None:
+            mask &= (timestamps >= start).to_numpy()
+        if end is not None:
+            mask &= (timestamps < end).to_numpy()
+        return df[mask]
+    first = 0 if start is None else timestamps.searchsorted(start, side='left')
+    last = len(df) if end is None else timestamps.searchsorted(end, side='left')
+    return df.iloc[first:last]
+
+
+def _filter_mask(df, filters):
+    """Rows of df passing filters: {column: value} (equality) or {column: (low, high)} (inclusive range)"""
+    mask = np.ones(len(df), dtype=bool)
+    for column, condition in (filters or {}).items():
+        values = df[column]
+        if isinstance(condition, tuple):
+            low, high = condition
+            if low is not None:
+                mask &= (values >= low).to_numpy(dtype=bool, na_value=False)
+            if high is not None:
+                mask &= (values <= high).to_numpy(dtype=bool, na_value=False)
+        else:
+            mask &= (values == condition).to_numpy(dtype=bool, na_value=False)
+    return mask
+
+
+def frame_page(df, limit, after=None, descending=False, start=None, end=None, filters=None):
+    """
+    Keyset pagination over a frame sorted by timestamp: the first `limit` rows after
+    the cursor `after`, oldest first (newest first with descending), with
+    start <= timestamp < end and passing filters (see _filter_mask).
+
+    A cursor is (epoch nanoseconds, position) of a row. The range is found by binary
+    search and filters are applied to growing blocks of rows from the cursor on, so
+    a page costs about the same on any size of history.
+    Returns: (page, cursor of its first row, cursor of its last row); cursors are None for an empty page
+    """
+    timestamps = epoch_ns(df['timestamp'])
+    lo = 0 if start is None else int(np.searchsorted(timestamps, pd.Timestamp(start).value, side='left'))
+    hi = len(df) if end is None else int(np.searchsorted(timestamps, pd.Timestamp(end).value, side='left'))
+    if after is not None:
+        ts, position = after
+        if not (0 <= position < len(df) and timestamps[position] == ts):
+            # The frame was reloaded since the cursor was taken: find its timestamp instead
+            position = int(np.searchsorted(timestamps, ts, side='left' if descending else 'right'))
+            position = position if descending else position - 1
+        if descending:
+            hi = min(hi, position)
+        else:
+            lo = max(lo, position + 1)
+
+    found = []
+    block = max(limit * 4, 64)
+    while lo < hi and sum(len(positions) for positions in found) < limit:
+        first, last = (max(lo, hi - block), hi) if descending else (lo, min(hi, lo + block))
+        positions = first + np.flatnonzero(_filter_mask(df.iloc[first:last], filters))
+        found.append(positions[::-1] if descending else positions)
+        if descending:
+            hi = first
+        else:
+            lo = last
+        block *= 2  # Selective filters: scan further each round
+
+    positions = np.concatenate(found)[:limit] if found else np.empty(0, dtype=np.int64)
+    if len(positions) == 0:
+        return df.iloc[0:0], None, None
+    cursors = [(int(timestamps[p]), int(p)) for p in (positions[0], positions[-1])]
+    return df.iloc[positions], cursors[0], cursors[1]
+
+
+def _lttb(x, y, n_out):
+    """Largest-Triangle-Three-Buckets: indices of n_out points that keep the shape of the series"""
+    n = len(x)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    ends = np.append(edges[1:], n)
+
+    # Mean of every bucket, used as the third triangle vertex for the preceding bucket
+    counts = np.diff(np.append(edges, n))
+    mean_x = np.add.reduceat(x, edges) / counts
+    mean_y = np.add.reduceat(y, edges) / counts
+
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        area = np.abs((x[a] - mean_x[i + 1]) * (y[start:end] - y[a])
+                      - (x[a] - x[start:end]) * (mean_y[i + 1] - y[a]))
+        a = start + int(np.argmax(area))
+        selected[i + 1] = a
+    return selected
+
+
+def _minmax(y, n_out):
+    """Min/max envelope: indices of the lowest and highest point of n_out/2 buckets"""
+    n = len(y)
+    n_buckets = max(1, (n_out - 2) // 2)  # Two points per bucket plus both end points
+    size = int(np.ceil(n / n_buckets))
+    padded = np.full(n_buckets * size, np.nan)
+    padded[:n] = y
+    blocks = padded.reshape(n_buckets, size)
+    valid = ~np.isnan(blocks).all(axis=1)
+    offsets = np.arange(n_buckets)[valid] * size
+    low = np.nanargmin(blocks[valid], axis=1) + offsets
+    high = np.nanargmax(blocks[valid], axis=1) + offsets
+    return np.unique(np.concatenate(([0, n - 1], low, high)))
+
+
+def downsample_indices(x, y, n_out, method="lttb"):
+    """
+    Pick at most n_out points of a series for plotting. "lttb" keeps the visual shape
+    (spikes form large triangles and are kept); "minmax" keeps every bucket's extremes.
+    NaN points are dropped when the series is downsampled.
+    Returns: sorted positional indices into x/y
+    """
+    y = np.asarray(y, dtype=np.float64)
+    n = len(y)
+    if n <= n_out or n_out < 3:
+        return np.arange(n)
+
+    valid = np.flatnonzero(~np.isnan(y))
+    if len(valid) <= n_out:
+        return valid
+
+    if method == "minmax":
+        return valid[_minmax(y[valid], n_out)]
+    if method != "lttb":
+        raise ValueError(f"Unknown downsampling method: {method}")
+
+    if pd.api.types.is_datetime64_any_dtype(x):
+        x = pd.DatetimeIndex(x).asi8
+    x = np.asarray(x, dtype=np.float64)
+    return valid[_lttb(x[valid], y[valid], n_out)]
+
+
+class SharedSensorData:
+    """
+    Process-wide, thread-safe copy of the sensor history, shared by every dashboard
+    session. The JSON Lines file is checked with a stat call at most once per
+    check_interval; when it changed, one thread reads the appended records and
+    extends the raw and cleaned frames while other sessions wait for the result.
+
+    Sessions get shallow copies: with pandas copy-on-write enabled, anything a
+    session does to its frame leaves the shared data untouched.
+
+    With tz set, frames are handed out with their timestamps already converted to
+    that timezone. The conversion runs once per data change, not once per session
+    rerun, and the frames stay sorted, so time ranges can be cut with time_slice.
+    Converting from UTC only relabels the column (the values stay UTC nanoseconds),
+    so its cost is a copy of the timestamps; like the appends themselves (see
+    IncrementalJsonlLoader.refresh), each data change is still O(rows).
+    """
+
+    def __init__(self, path, check_interval=1.0, tz=None):
+        self.path = path
+        self.check_interval = check_interval
+        self.tz = tz
+        self.version = 0  # Incremented whenever the data changes
+        self._loader = IncrementalJsonlLoader(path)
+        self._lock = threading.Lock()
+        self._last_check = float('-inf')
+        self._file_state = None
+        self._raw = None
+        self._cleaned = None
+        self._cleaned_generation = None
+        self._localized = {}  # cleaned -> (source frame, frame with timestamps in tz)
+        self._stats = {True: StreamingStats(settle_rows=CLEAN_REWRITE_ROWS), False: StreamingStats()}
+
+    def refresh(self):
+        """Pick up new records if the file changed. Returns: data version"""
+        if time.monotonic() - self._last_check < self.check_interval:
+            return self.version
+        with self._lock:
+            if time.monotonic() - self._last_check < self.check_interval:
+                return self.version  # Another session refreshed while we waited
+            stat = os.stat(self.path)
+            file_state = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            if file_state != self._file_state:
+                generation = self._loader.generation
+                if self._loader.refresh() or self._loader.generation != generation:
+                    self._raw = self._loader.frame
+                    self.version += 1
+                self._file_state = file_state
+            self._last_check = time.monotonic()
+        return self.version
+
+    def _cleaned_frame(self):
+        with self._lock:
+            raw = self._raw
+            if raw is None:
+                return None
+            cleaned = self._cleaned
+            if self._cleaned_generation != self._loader.generation:
+                cleaned = None  # Rows were reloaded or reordered, clean from scratch
+            if cleaned is None or len(cleaned) != len(raw):
+                cleaned = clean_tail(raw, cleaned, 0 if cleaned is None else len(cleaned))
+                self._cleaned = cleaned
+                self._cleaned_generation = self._loader.generation
+            return cleaned
+
+    def _localized_frame(self, frame, cleaned):
+        with self._lock:
+            source, localized = self._localized.get(cleaned, (None, None))
+            if source is not frame:
+                localized = localize_timestamps(frame, self.tz)
+                self._localized[cleaned] = (frame, localized)
+            return localized
+
+    def get(self, cleaned=True):
+        """Current raw or cleaned frame as a view for one session (None if no records yet)"""
+        self.refresh()
+        frame = self._cleaned_frame() if cleaned else self._raw
+        if frame is None:
+            return None
+        if self.tz is not None:
+            frame = self._localized_frame(frame, cleaned)
+        return frame.copy(deep=False)
+
+    def moments(self, cleaned=True, start=None, end=None, crop_number=None, mac_address=None):
+        """
+        Statistics of the raw or cleaned sensor columns for start <= timestamp < end,
+        one crop and/or one device, kept up to date incrementally (see sensor_stats).
+        Returns: Moments, or None if no records yet
+        """
+        self.refresh()
+        frame = self._cleaned_frame() if cleaned else self._raw
+        if frame is None:
+            return None
+        with self._lock:
+            stats = self._stats[cleaned]
+            stats.update(frame, self._loader.generation)
+            return stats.query(frame, start, end, crop_number, mac_address)
@@ -0,0 +1,298 @@
+"""Streaming statistics for the dashboard: mergeable moments of the sensor columns,
+kept per device/crop and day as records arrive, so the Insights and Detailed
+Analysis statistics don't rescan the whole history on every refresh.
+
+Moments holds counts, means, min/max and Welford sums of squared deviations per
+sensor, plus the co-moment matrix over rows where every sensor has a value.
+Moments of separate chunks combine exactly (Chan et al.'s parallel form of
+Welford's update), which is what lets StreamingStats answer a time window by
+combining whole-day accumulators with the few rows at the window's edges.
+"""
+import numpy as np
+import pandas as pd
+
+from sensor_store import ROLLUP_UTC_OFFSET, SENSOR_COLUMNS, epoch_ns
+
+NS_PER_DAY = 86400 * 10**9
+DAY_OFFSET_NS = ROLLUP_UTC_OFFSET * 10**9  # Days start at midnight Pakistan time, like the rollups
+
+
+class Moments:
+    """
+    Count, mean, min, max and variance of each column, and the covariance of the
+    columns over complete rows (rows without NaN). Combine chunks with combine().
+    """
+
+    def __init__(self, columns, n, mean, m2, low, high, complete_n, complete_mean, comoment):
+        self.columns = list(columns)
+        self.n = n                      # (k,) non-NaN values per column
+        self.mean = mean                # (k,)
+        self.m2 = m2                    # (k,) sum of squared deviations from the mean
+        self.low = low                  # (k,) +inf where n == 0
+        self.high = high                # (k,) -inf where n == 0
+        self.complete_n = complete_n    # rows without NaN in any column
+        self.complete_mean = complete_mean  # (k,) column means over those rows
+        self.comoment = comoment        # (k, k) sum of products of their deviations
+
+    @classmethod
+    def empty(cls, columns):
+        k = len(columns)
+        return cls(columns, np.zeros(k), np.zeros(k), np.zeros(k), np.full(k, np.inf), np.full(k, -np.inf),
+                   0.0, np.zeros(k), np.zeros((k, k)))
+
+    @classmethod
+    def from_values(cls, values, columns):
+        """Moments of a (rows x columns) array with NaN for missing values"""
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) == 0:
+            return cls.empty(columns)
+        valid = ~np.isnan(values)
+        n = valid.sum(axis=0).astype(np.float64)
+        filled = np.where(valid, values, 0.0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(n > 0, filled.sum(axis=0) / n, 0.0)
+        m2 = (np.where(valid, values - mean, 0.0) ** 2).sum(axis=0)
+        low = np.where(valid, values, np.inf).min(axis=0)
+        high = np.where(valid, values, -np.inf).max(axis=0)
+
+        complete = values[valid.all(axis=1)]
+        complete_n = float(len(complete))
+        complete_mean = complete.mean(axis=0) if len(complete) else np.zeros(len(columns))
+        deviations = complete - complete_mean
+        return cls(columns, n, mean, m2, low, high, complete_n, complete_mean, deviations.T @ deviations)
+
+    @classmethod
+    def from_frame(cls, df, columns=None):
+        """Moments of the sensor columns (or `columns`) present in df"""
+        columns = [col for col in (columns or SENSOR_COLUMNS) if col in df.columns]
+        return cls.from_values(df[columns].to_numpy(dtype=np.float64, na_value=np.nan), columns)
+
+    @classmethod
+    def combine(cls, parts, columns):
+        """Exact moments of the union of chunks, from their (stacked) moments"""
+        parts = [part for part in parts if part is not None]
+        if not parts:
+            return cls.empty(columns)
+        return cls(columns, *combine_arrays(
+            np.stack([p.n for p in parts]), np.stack([p.mean for p in parts]), np.stack([p.m2 for p in parts]),
+            np.stack([p.low for p in parts]), np.stack([p.high for p in parts]),
+            np.array([p.complete_n for p in parts]), np.stack([p.complete_mean for p in parts]),
+            np.stack([p.comoment for p in parts])))
+
+    def select(self, columns):
+        """Moments of a subset of the columns"""
+        idx = [self.columns.index(col) for col in columns]
+        return Moments(columns, self.n[idx], self.mean[idx], self.m2[idx], self.low[idx], self.high[idx],
+                       self.complete_n, self.complete_mean[idx], self.comoment[np.ix_(idx, idx)])
+
+    def describe(self):
+        """count, mean, std (ddof=1), min and max per column, like DataFrame.describe()"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            std = np.where(self.n > 1, np.sqrt(self.m2 / (self.n - 1)), np.nan)
+        return pd.DataFrame({
+            "count": self.n,
+            "mean": np.where(self.n > 0, self.mean, np.nan),
+            "std": std,
+            "min": np.where(self.n > 0, self.low, np.nan),
+            "max": np.where(self.n > 0, self.high, np.nan),
+        }, index=self.columns).T
+
+    def corr(self):
+        """Pearson correlation matrix over complete rows"""
+        diagonal = np.sqrt(np.diag(self.comoment))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            corr = self.comoment / np.outer(diagonal, diagonal)
+        if self.complete_n < 2:
+            corr[:] = np.nan
+        return pd.DataFrame(corr, index=self.columns, columns=self.columns)
+
+
+def combine_arrays(n, mean, m2, low, high, complete_n, complete_mean, comoment):
+    """Combine moments stacked along the first axis. Returns: the combined arrays"""
+    total = n.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        combined_mean = np.where(total > 0, (n * mean).sum(axis=0) / total, 0.0)
+    combined_m2 = m2.sum(axis=0) + (n * (mean - combined_mean) ** 2).sum(axis=0)
+
+    complete_total = complete_n.sum()
+    if complete_total > 0:
+        combined_complete_mean = (complete_n[:, None] * complete_mean).sum(axis=0) / complete_total
+    else:
+        combined_complete_mean = np.zeros(complete_mean.shape[1:])
+    deviations = complete_mean - combined_complete_mean
+    combined_comoment = comoment.sum(axis=0) + np.einsum('b,bi,bj->ij', complete_n, deviations, deviations)
+    return (total, combined_mean, combined_m2, low.min(axis=0), high.max(axis=0),
+            complete_total, combined_complete_mean, combined_comoment)
+
+
+class _DayArrays:
+    """Per-day moments of one device/crop, as arrays indexed by day - first_day"""
+
+    def __init__(self, first_day, k):
+        self.first_day = first_day
+        self.k = k
+        self.days = 0
+        self.arrays = None
+        self._grow(8)
+
+    def _grow(self, capacity):
+        k = self.k
+        fresh = [np.zeros((capacity, k)), np.zeros((capacity, k)), np.zeros((capacity, k)),
+                 np.full((capacity, k), np.inf), np.full((capacity, k), -np.inf),
+                 np.zeros(capacity), np.zeros((capacity, k)), np.zeros((capacity, k, k))]
+        if self.arrays is not None:
+            for new, old in zip(fresh, self.arrays):
+                new[:len(old)] = old
+        self.arrays = fresh
+
+    def add(self, day, moments):
+        i = day - self.first_day
+        if i >= len(self.arrays[0]):
+            self._grow(max(i + 1, 2 * len(self.arrays[0])))
+        self.days = max(self.days, i + 1)
+        current = [array[i:i + 1] for array in self.arrays]
+        new = [moments.n, moments.mean, moments.m2, moments.low, moments.high,
+               np.array(moments.complete_n), moments.complete_mean, moments.comoment]
+        for array, combined in zip(self.arrays, combine_arrays(
+                *[np.concatenate([cur, value[None]]) for cur, value in zip(current, new)])):
+            array[i] = combined
+
+    def range(self, first, last):
+        """Stacked day moments for days first <= day < last (None for unbounded)"""
+        lo = 0 if first is None else max(0, first - self.first_day)
+        hi = self.days if last is None else min(self.days, last - self.first_day)
+        if hi <= lo:
+            return None
+        return [array[lo:hi] for array in self.arrays]
+
+
+class StreamingStats:
+    """
+    Moments of a growing frame (sorted by time, rows only ever appended) per
+    device/crop and day. update() absorbs only the rows added since the previous
+    update; query() combines the whole days inside a window with the rows at its
+    edges, so its cost depends on the number of days and devices, not rows.
+
+    The last settle_rows rows of each device are kept out of the day moments
+    until newer rows arrive, because incremental cleaning may still rewrite them
+    (see sensor_processing.CLEAN_REWRITE_ROWS); queries read them from the frame.
+    A new generation (rows reloaded or reordered) starts over.
+    """
+
+    def __init__(self, columns=SENSOR_COLUMNS, settle_rows=0):
+        self.columns = list(columns)
+        self.settle_rows = settle_rows
+        self.reset()
+
+    def reset(self, generation=None):
+        self.generation = generation
+        self.rows = 0
+        self._group_ids = {}     # (mac_address, crop_number) -> group id
+        self._group_keys = []
+        self._days = []          # group id -> _DayArrays
+        self._pending = []       # group id -> positions of rows not yet in the day moments
+        self._row_groups = np.empty(0, dtype=np.int32)
+
+    def _assign_groups(self, df):
+        macs = df['mac_address'].astype(object).to_numpy() if 'mac_address' in df.columns else [None] * len(df)
+        crops = df['crop_number'].astype(object).to_numpy() if 'crop_number' in df.columns else [None] * len(df)
+        keys = pd.MultiIndex.from_arrays([pd.Index(macs, dtype=object), pd.Index(crops, dtype=object)])
+        codes, uniques = keys.factorize()
+        mapping = np.empty(len(uniques), dtype=np.int32)
+        for i, (mac, crop) in enumerate(uniques):
+            key = (None if pd.isna(mac) else mac, None if pd.isna(crop) else int(crop))
+            if key not in self._group_ids:
+                self._group_ids[key] = len(self._group_keys)
+                self._group_keys.append(key)
+                self._days.append(None)
+                self._pending.append(np.empty(0, dtype=np.int64))
+            mapping[i] = self._group_ids[key]
+        return mapping[codes]
+
+    def update(self, frame, generation=None):
+        """Absorb the rows appended to frame since the last update"""
+        if generation != self.generation or len(frame) < self.rows:
+            self.reset(generation)
+        if len(frame) == self.rows:
+            return
+        new_groups = self._assign_groups(frame.iloc[self.rows:])
+        self._row_groups = np.concatenate([self._row_groups, new_groups])
+        positions = np.arange(self.rows, len(frame))
+        timestamps = epoch_ns(frame['timestamp'])
+        values = None
+        for gid in np.unique(new_groups):
+            pending = np.concatenate([self._pending[gid], positions[new_groups == gid]])
+            settled = pending[:max(0, len(pending) - self.settle_rows)]
+            self._pending[gid] = pending[len(settled):]
+            if len(settled) == 0:
+                continue
+            if values is None:
+                values = frame[self.columns]
+            block = values.iloc[settled].to_numpy(dtype=np.float64, na_value=np.nan)
+            days = (timestamps[settled] + DAY_OFFSET_NS) // NS_PER_DAY
+            if self._days[gid] is None:
+                self._days[gid] = _DayArrays(int(days[0]), len(self.columns))
+            boundaries = np.flatnonzero(np.diff(days)) + 1
+            for start, end in zip(np.concatenate(([0], boundaries)), np.concatenate((boundaries, [len(days)]))):
+                self._days[gid].add(int(days[start]), Moments.from_values(block[start:end], self.columns))
+        self.rows = len(frame)
+
+    def groups(self, crop_number=None, mac_address=None):
+        """Ids of the device/crop groups matching the filters"""
+        return [gid for gid, (mac, crop) in enumerate(self._group_keys)
+                if (crop_number is None or crop == int(crop_number))
+                and (mac_address is None or mac == mac_address)]
+
+    def query(self, frame, start=None, end=None, crop_number=None, mac_address=None):
+        """
+        Moments of the rows of frame (the frame last passed to update, or a view of it
+        with the same rows) with start <= timestamp < end, filtered by crop/device.
+        Returns: Moments
+        """
+        gids = self.groups(crop_number, mac_address)
+        timestamps = epoch_ns(frame['timestamp'])
+        start_ns = None if start is None else pd.Timestamp(start).value
+        end_ns = None if end is None else pd.Timestamp(end).value
+
+        # Whole days inside [start, end) come from the day moments, the rest from the frame
+        first_day = None if start_ns is None else -((DAY_OFFSET_NS + start_ns) // -NS_PER_DAY)
+        last_day = None if end_ns is None else (end_ns + DAY_OFFSET_NS) // NS_PER_DAY
+        inner_start = None if first_day is None else first_day * NS_PER_DAY - DAY_OFFSET_NS
+        inner_end = None if last_day is None else last_day * NS_PER_DAY - DAY_OFFSET_NS
+        if first_day is not None and last_day is not None and last_day <= first_day:
+            inner_start = inner_end = start_ns  # Less than a day: everything comes from the frame
+
+        parts = []
+        stacked = [self._days[gid].range(first_day, last_day) for gid in gids if self._days[gid] is not None]
+        stacked = [arrays for arrays in stacked if arrays is not None]
+        if stacked:
+            parts.append(Moments(self.columns, *combine_arrays(
+                *[np.concatenate(arrays) for arrays in zip(*stacked)])))
+
+        group_mask = np.zeros(len(self._group_keys), dtype=bool)
+        group_mask[gids] = True
+        edges = []
+        if start_ns is not None:
+            edges.append((np.searchsorted(timestamps, start_ns), np.searchsorted(timestamps, inner_start)))
+        if end_ns is not None:
+            edges.append((np.searchsorted(timestamps, max(inner_end, start_ns or inner_end)),
+                          np.searchsorted(timestamps, end_ns)))
+        positions = [np.arange(lo, hi)[group_mask[self._row_groups[lo:hi]]] for lo, hi in edges if hi > lo]
+
+        # Unsettled rows that fall on the whole days
+        for gid in gids:
+            pending = self._pending[gid]
+            pending_ts = timestamps[pending]
+            keep = np.ones(len(pending), dtype=bool)
+            if inner_start is not None:
+                keep &= pending_ts >= inner_start
+            if inner_end is not None:
+                keep &= pending_ts < inner_end
+            positions.append(pending[keep])
+
+        positions = np.concatenate(positions) if positions else np.empty(0, dtype=np.int64)
+        if len(positions):
+            block = frame[self.columns].iloc[positions].to_numpy(dtype=np.float64, na_value=np.nan)
+            parts.append(Moments.from_values(block, self.columns))
+        return Moments.combine(parts, self.columns)
+
@@ -0,0 +1,1049 @@
+"""Storage helpers shared by the MQTT listener and the Streamlit dashboard.
+
+Sensor records are stored as JSON Lines (one JSON object per line) so the
+listener can append a record in O(1) instead of rewriting the whole file.
+An optional SQLite store keeps the same records indexed by device, crop and
+time so the dashboard can push its filters down into SQL. Older records can be
+rolled out of these hot stores into a time-partitioned Parquet archive, and the
+latest reading of each device is kept in a small snapshot file.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from io import BytesIO
+
+import pandas as pd
+
+try:
+    import pyarrow  # noqa: F401 - required by pandas for Parquet I/O
+    PARQUET_AVAILABLE = True
+except ImportError:
+    PARQUET_AVAILABLE = False
+
+SENSOR_COLUMNS = ['soil_moisture', 'soil_nitrogen', 'soil_phosphorus', 'soil_potassium',
+                  'soil_temperature', 'soil_conductivity', 'soil_ph',
+                  'air_temperature', 'air_humidity']
+
+# Reasonable outlier thresholds based on physical limits. Values outside these ranges
+# (and exact zeros) are treated as sensor errors by the dashboard's data cleaning.
+OUTLIER_RANGES = {
+    'soil_moisture': (0.1, 100),
+    'soil_nitrogen': (0.1, 200),
+    'soil_phosphorus': (0.1, 150),
+    'soil_potassium': (0.1, 500),
+    'soil_temperature': (-10, 60),
+    'soil_conductivity': (0.1, 2000),
+    'soil_ph': (3.0, 10.0),
+    'air_temperature': (-40, 60),
+    'air_humidity': (0.1, 100)
+}
+
+# Rollup bucket sizes in seconds. Buckets are aligned to Pakistan time (UTC+5, no DST)
+# so daily rollups start at local midnight.
+ROLLUP_GRANULARITIES = {"hour": 3600, "day": 86400}
+ROLLUP_UTC_OFFSET = 5 * 3600
+
+
+def recover_jsonl_tail(path):
+    """
+    Drop a partially written last line left behind by a crash or power loss.
+    Returns: number of bytes truncated from the end of the file
+    """
+    if not os.path.exists(path):
+        return 0
+
+    with open(path, 'rb+') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size == 0:
+            return 0
+
+        f.seek(size - 1)
+        if f.read(1) == b'\n':
+            return 0  # Clean tail, nothing to recover
+
+        # Scan backwards in blocks for the last complete line
+        block_size = 4096
+        pos = size
+        keep = 0
+        while pos > 0:
+            read_size = min(block_size, pos)
+            pos -= read_size
+            f.seek(pos)
+            chunk = f.read(read_size)
+            idx = chunk.rfind(b'\n')
+            if idx != -1:
+                keep = pos + idx + 1
+                break
+
+        f.truncate(keep)
+        f.flush()
+        os.fsync(f.fileno())
+
+    dropped = size - keep
+    logging.warning(f"Recovered {path}: truncated {dropped} bytes of incomplete trailing record")
+    return dropped
+
+
+def truncate_failed_append(file, path, offset):
+    """
+    Close a file opened for appending after a failed write and cut it back to offset,
+    its size before the write, so a retry of the whole batch doesn't store the records
+    that made it to disk twice. The caller reopens the file.
+    """
+    try:
+        file.close()
+    except OSError:
+        pass  # Flushing the rest of the failed write failed again; the file is closed anyway
+    os.truncate(path, offset)
+
+
+class JsonlWriter:
+    """Append-only JSON Lines writer with batched fsync"""
+
+    def __init__(self, path, fsync_every=20, fsync_interval=5.0):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self._file = None
+        self._pending = 0
+        self._last_fsync = time.monotonic()
+
+    def open(self):
+        if self._file is None:
+            recover_jsonl_tail(self.path)
+            self._file = open(self.path, 'ab')
+            self._last_fsync = time.monotonic()
+        return self
+
+    def write(self, record):
+        """Append one record. The line is flushed to the OS immediately; fsync is batched."""
+        self.write_batch([record])
+
+    def write_batch(self, records):
+        if not records:
+            return
+        self.open()
+        payload = b''.join(
+            json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n'
+            for record in records
+        )
+        offset = self._file.tell()
+        try:
+            self._file.write(payload)
+            self._file.flush()
+            self._pending += len(records)
+
+            if (self._pending >= self.fsync_every
+                    or time.monotonic() - self._last_fsync >= self.fsync_interval):
+                self.sync()
+        except Exception:
+            truncate_failed_append(self._file, self.path, offset)
+            self._file = None
+            raise
+
+    def sync(self):
+        if self._file is not None and self._pending:
+            os.fsync(self._file.fileno())
+        self._pending = 0
+        self._last_fsync = time.monotonic()
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+
+def migrate_json_array(json_path, jsonl_path):
+    """
+    One-shot migration of a legacy JSON array file to JSON Lines.
+    The legacy file is kept as <json_path>.migrated. Returns number of records migrated.
+    """
+    if not os.path.exists(json_path) or os.path.exists(jsonl_path):
+        return 0
+
+    try:
+        with open(json_path, 'r') as f:
+            records = json.load(f) if os.path.getsize(json_path) > 0 else []
+    except json.JSONDecodeError as e:
+        logging.error(f"Cannot migrate {json_path}: invalid JSON ({str(e)})")
+        return 0
+    if not isinstance(records, list):
+        records = [records]
+
+    # Write to a temporary file first so a crash never leaves a half-migrated store
+    tmp_path = jsonl_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        for record in records:
+            f.write(json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, jsonl_path)
+    os.replace(json_path, json_path + '.migrated')
+
+    logging.info(f"Migrated {len(records)} records from {json_path} to {jsonl_path}")
+    return len(records)
+
+
+def read_jsonl_bytes(path, offset=0):
+    """
+    Read complete lines from a JSON Lines file starting at a byte offset.
+    A trailing line that is still being written is left for the next read.
+    Returns: (data_bytes, end_offset)
+    """
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read()
+    end = data.rfind(b'\n') + 1
+    return data[:end], offset + end
+
+
+def iter_jsonl_batches(path, batch_size=5000):
+    """Yield lists of decoded records from a JSON Lines file, skipping an incomplete last line"""
+    batch = []
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            batch.append(json.loads(line))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def compact_frame(df):
+    """
+    Convert sensor records to the compact in-memory schema, in place: float32
+    sensor columns, categorical mac_address and nullable Int16 crop_number. A naive
+    datetime64 timestamp column is stored as datetime64[ns] (int64 epoch nanoseconds
+    underneath), whatever resolution pd.to_datetime picked for it.
+    Returns: df
+    """
+    if 'timestamp' in df.columns and pd.api.types.is_datetime64_dtype(df['timestamp']) \
+            and df['timestamp'].dtype != 'datetime64[ns]':
+        df['timestamp'] = df['timestamp'].astype('datetime64[ns]')
+    for col in SENSOR_COLUMNS:
+        if col in df.columns and df[col].dtype != 'float32':
+            df[col] = pd.to_numeric(df[col], errors='coerce').astype('float32')
+    if 'mac_address' in df.columns and not isinstance(df['mac_address'].dtype, pd.CategoricalDtype):
+        df['mac_address'] = df['mac_address'].astype('category')
+    if 'crop_number' in df.columns and df['crop_number'].dtype != 'Int16':
+        df['crop_number'] = pd.to_numeric(df['crop_number'], errors='coerce').astype('Int16')
+    return df
+
+
+def epoch_ns(timestamps):
+    """
+    Epoch nanoseconds of a datetime Series (naive or timezone-aware) as int64. pandas 2+
+    keeps second/millisecond resolutions (pd.to_datetime of integer epochs gives
+    datetime64[s]), so the values are converted to nanoseconds first.
+    """
+    if hasattr(timestamps.dt, 'as_unit'):
+        timestamps = timestamps.dt.as_unit('ns')
+    return timestamps.array.asi8
+
+
+def concat_frames(frames):
+    """
+    pd.concat(frames, ignore_index=True) that keeps categorical columns categorical
+    when the frames' categories differ (plain concat falls back to object columns).
+    Categories are merged in order of appearance, so the first frame's codes stay valid.
+    """
+    frames = [frame for frame in frames if frame is not None]
+    for col in frames[0].columns:
+        if not isinstance(frames[0][col].dtype, pd.CategoricalDtype):
+            continue
+        categories = frames[0][col].cat.categories
+        for frame in frames[1:]:
+            if col in frame.columns and isinstance(frame[col].dtype, pd.CategoricalDtype):
+                categories = categories.append(frame[col].cat.categories.difference(categories))
+        frames = [frame.assign(**{col: frame[col].cat.set_categories(categories)})
+                  if col in frame.columns and isinstance(frame[col].dtype, pd.CategoricalDtype)
+                  and not frame[col].cat.categories.equals(categories) else frame
+                  for frame in frames]
+    return pd.concat(frames, ignore_index=True)
+
+
+def parse_jsonl_records(data):
+    """Parse JSON Lines bytes into a compact DataFrame with a datetime timestamp column"""
+    df = pd.read_json(BytesIO(data), lines=True, convert_dates=False)
+    if 'timestamp' in df.columns:
+        df['timestamp'] = pd.to_datetime(df['timestamp'], unit='s')
+    return compact_frame(df)
+
+
+# What parse_jsonl_records raises for a line it cannot convert
+_PARSE_ERRORS = (ValueError, TypeError, OverflowError)
+
+
+def _parses(line):
+    try:
+        parse_jsonl_records(line)
+        return True
+    except _PARSE_ERRORS:
+        return False
+
+
+def parse_jsonl_records_skipping_bad(data):
+    """
+    Parse JSON Lines bytes like parse_jsonl_records, dropping the lines that are not
+    a JSON object or that fail to convert (e.g. an unparseable timestamp).
+    Returns: (DataFrame, number of lines dropped)
+    """
+    lines = [line for line in data.splitlines(keepends=True) if line.strip()]
+    good = []
+    for line in lines:
+        try:
+            if isinstance(json.loads(line), dict):
+                good.append(line)
+        except ValueError:
+            pass
+    try:
+        df = parse_jsonl_records(b''.join(good))
+    except _PARSE_ERRORS:
+        # Valid JSON with a value that cannot be converted: find it line by line
+        good = [line for line in good if _parses(line)]
+        df = parse_jsonl_records(b''.join(good))
+    return df, len(lines) - len(good)
+
+
+class IncrementalJsonlLoader:
+    """
+    Keeps a DataFrame of a JSON Lines file and, on each refresh, parses only the
+    records appended since the previous refresh. A truncated or replaced file
+    (rotation, compaction, migration) triggers a full reload. Complete lines that
+    fail to parse are dropped with a warning (at most one per warning_interval
+    seconds); bad_lines counts them.
+
+    generation changes whenever existing rows move (reload or out-of-order
+    records); as long as it stays the same, refreshes only append rows.
+    """
+
+    def __init__(self, path, warning_interval=60.0):
+        self.path = path
+        self.warning_interval = warning_interval
+        self.frame = None
+        self.offset = 0
+        self.generation = 0
+        self.bad_lines = 0
+        self._file_id = None
+        self._unreported = 0
+        self._last_warning = float('-inf')
+
+    def reset(self):
+        self.frame = None
+        self.offset = 0
+        self.generation += 1
+        self._file_id = None
+
+    def refresh(self):
+        """
+        Read newly appended records into the cached frame. Only the new bytes are
+        parsed, but appending them copies the cached frame (pandas has no in-place
+        append), so a refresh still costs O(rows) in memory bandwidth.
+        Returns: number of new rows
+        """
+        stat = os.stat(self.path)  # Raises FileNotFoundError like a full read would
+        file_id = (stat.st_dev, stat.st_ino)
+        if file_id != self._file_id or stat.st_size < self.offset:
+            self.reset()
+            self._file_id = file_id
+
+        if stat.st_size == self.offset:
+            return 0
+
+        data, offset = read_jsonl_bytes(self.path, self.offset)
+        if not data:
+            return 0
+
+        try:
+            new_df = parse_jsonl_records(data)
+        except _PARSE_ERRORS:
+            new_df, dropped = parse_jsonl_records_skipping_bad(data)
+            self._report_bad_lines(dropped)
+        self.offset = offset
+        if len(new_df) == 0 or 'timestamp' not in new_df.columns:
+            return 0
+        if self.frame is None or len(self.frame) == 0:
+            self.frame = new_df.sort_values('timestamp', kind='stable').reset_index(drop=True)
+        else:
+            in_order = new_df['timestamp'].is_monotonic_increasing and \
+                new_df['timestamp'].iloc[0] >= self.frame['timestamp'].iloc[-1]
+            self.frame = concat_frames([self.frame, new_df])
+            if not in_order:
+                self.frame = self.frame.sort_values('timestamp', kind='stable').reset_index(drop=True)
+                self.generation += 1
+        return len(new_df)
+
+    def _report_bad_lines(self, count):
+        self.bad_lines += count
+        self._unreported += count
+        now = time.monotonic()
+        if self._unreported and now - self._last_warning >= self.warning_interval:
+            logging.warning(f"Skipped {self._unreported} unparseable line(s) in {self.path}")
+            self._unreported = 0
+            self._last_warning = now
+
+
+class SqliteStore:
+    """
+    SQLite (WAL mode) time-series store. One connection is shared behind a lock,
+    so a store object can be used from the listener's writer thread as well as
+    from concurrent dashboard sessions.
+    """
+
+    record_columns = ['timestamp', 'mac_address', 'crop_number', 'date', 'time'] + SENSOR_COLUMNS
+
+    def __init__(self, path, timeout=30.0):
+        self.path = path
+        self.timeout = timeout
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def open(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")  # Durable at checkpoints, safe with WAL
+            self._create_schema()
+        return self
+
+    def _create_schema(self):
+        sensor_defs = ", ".join(f"{col} REAL" for col in SENSOR_COLUMNS)
+        with self._conn:
+            self._conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS readings (
+                    id INTEGER PRIMARY KEY,
+                    timestamp REAL NOT NULL,
+                    mac_address TEXT,
+                    crop_number INTEGER,
+                    date TEXT,
+                    time TEXT,
+                    {sensor_defs}
+                )""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_readings_time ON readings (timestamp)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_readings_crop_time ON readings (crop_number, timestamp)")
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_readings_device ON readings (mac_address, crop_number, timestamp)")
+
+    def write_batch(self, records):
+        if not records:
+            return
+        self.open()
+        placeholders = ", ".join("?" for _ in self.record_columns)
+        rows = [tuple(record.get(col) for col in self.record_columns) for record in records]
+        if any(row[0] is None for row in rows):
+            # timestamp is NOT NULL: one such row would make SQLite reject the whole batch
+            rows = [row for row in rows if row[0] is not None]
+            logging.warning(f"Skipped {len(records) - len(rows)} record(s) without a timestamp in {self.path}")
+        with self._lock, self._conn:
+            self._conn.executemany(
+                f"INSERT INTO readings ({', '.join(self.record_columns)}) VALUES ({placeholders})", rows)
+
+    def count(self):
+        self.open()
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM readings").fetchone()[0]
+
+    def import_jsonl(self, jsonl_path, batch_size=5000):
+        """Copy an existing JSON Lines history into the store. Returns number of records imported."""
+        if not os.path.exists(jsonl_path):
+            return 0
+        imported = 0
+        for batch in iter_jsonl_batches(jsonl_path, batch_size):
+            self.write_batch(batch)
+            imported += len(batch)
+        logging.info(f"Imported {imported} records from {jsonl_path} into {self.path}")
+        return imported
+
+    def crop_numbers(self):
+        """Distinct crop numbers, answered from the crop index"""
+        self.open()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT DISTINCT crop_number FROM readings WHERE crop_number IS NOT NULL ORDER BY crop_number"
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def query(self, start=None, end=None, crop_number=None, mac_address=None, columns=None):
+        """
+        Fetch readings ordered by time with filters evaluated in SQL.
+        start/end are epoch seconds; columns limits the sensor columns returned.
+        Returns: DataFrame with a datetime64 timestamp column
+        """
+        self.open()
+        selected = ['timestamp'] + list(columns if columns is not None
+                                        else [c for c in self.record_columns if c != 'timestamp'])
+        conditions = []
+        params = []
+        if start is not None:
+            conditions.append("timestamp > ?")
+            params.append(start)
+        if end is not None:
+            conditions.append("timestamp <= ?")
+            params.append(end)
+        if crop_number is not None:
+            conditions.append("crop_number = ?")
+            params.append(int(crop_number))
+        if mac_address is not None:
+            conditions.append("mac_address = ?")
+            params.append(mac_address)
+
+        sql = f"SELECT {', '.join(selected)} FROM readings"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY timestamp, id"
+
+        with self._lock:
+            df = pd.read_sql_query(sql, self._conn, params=params)
+        df['timestamp'] = pd.to_datetime(df['timestamp'], unit='s')
+        return compact_frame(df)
+
+    def page(self, limit, after=None, descending=False, start=None, end=None, filters=None):
+        """
+        Keyset pagination: the first `limit` readings after the cursor `after`, oldest first
+        (newest first with descending), with start <= timestamp < end (epoch seconds) and
+        passing filters ({column: value} for equality, {column: (low, high)} for an
+        inclusive range). The time index is walked from the cursor, so a page costs
+        about the same at any table size. A cursor is (timestamp, id) of a row.
+        Returns: (DataFrame like query(), cursor of its first row, cursor of its last row)
+        """
+        self.open()
+        conditions = []
+        params = []
+        if start is not None:
+            conditions.append("timestamp >= ?")
+            params.append(start)
+        if end is not None:
+            conditions.append("timestamp < ?")
+            params.append(end)
+        for column, condition in (filters or {}).items():
+            if column not in self.record_columns:
+                raise ValueError(f"Unknown column: {column}")
+            if isinstance(condition, tuple):
+                low, high = condition
+                if low is not None:
+                    conditions.append(f"{column} >= ?")
+                    params.append(low)
+                if high is not None:
+                    conditions.append(f"{column} <= ?")
+                    params.append(high)
+            else:
+                conditions.append(f"{column} = ?")
+                params.append(condition)
+        if after is not None:
+            conditions.append(f"(timestamp, id) {'<' if descending else '>'} (?, ?)")
+            params.extend(after)
+
+        order = " DESC" if descending else ""
+        sql = f"SELECT id, {', '.join(self.record_columns)} FROM readings"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += f" ORDER BY timestamp{order}, id{order} LIMIT ?"
+        params.append(int(limit))
+
+        with self._lock:
+            df = pd.read_sql_query(sql, self._conn, params=params)
+        if len(df) == 0:
+            first = last = None
+        else:
+            first = (float(df['timestamp'].iloc[0]), int(df['id'].iloc[0]))
+            last = (float(df['timestamp'].iloc[-1]), int(df['id'].iloc[-1]))
+        df = df.drop(columns=['id'])
+        df['timestamp'] = pd.to_datetime(df['timestamp'], unit='s')
+        return compact_frame(df), first, last
+
+    def delete_before(self, cutoff):
+        """Delete readings older than cutoff (epoch seconds). Returns number of rows deleted."""
+        self.open()
+        with self._lock, self._conn:
+            return self._conn.execute("DELETE FROM readings WHERE timestamp < ?", (cutoff,)).rowcount
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class RollupStore:
+    """
+    Incremental hourly/daily rollups (count, sum, min, max, sum of squares) per
+    sensor, device and crop, kept in SQLite. Each batch of records is aggregated
+    in memory and merged into the stored buckets with a single upsert, so the
+    dashboard can aggregate long ranges without touching raw records.
+
+    Only values the dashboard's cleaning would keep are rolled up: exact zeros and
+    values outside OUTLIER_RANGES are skipped.
+    """
+
+    def __init__(self, path, timeout=30.0):
+        self.path = path
+        self.timeout = timeout
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def open(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            with self._conn:
+                # mac_address '' and crop_number -1 stand for missing values, since NULLs never conflict
+                self._conn.execute("""
+                    CREATE TABLE IF NOT EXISTS rollups (
+                        granularity TEXT NOT NULL,
+                        bucket INTEGER NOT NULL,
+                        mac_address TEXT NOT NULL,
+                        crop_number INTEGER NOT NULL,
+                        sensor TEXT NOT NULL,
+                        count INTEGER NOT NULL,
+                        sum REAL NOT NULL,
+                        min REAL NOT NULL,
+                        max REAL NOT NULL,
+                        sumsq REAL NOT NULL,
+                        PRIMARY KEY (granularity, bucket, mac_address, crop_number, sensor)
+                    ) WITHOUT ROWID""")
+        return self
+
+    @staticmethod
+    def bucket_start(ts, size):
+        return int((ts + ROLLUP_UTC_OFFSET) // size * size - ROLLUP_UTC_OFFSET)
+
+    def aggregate(self, records):
+        """Aggregate records into {(granularity, bucket, mac, crop, sensor): [count, sum, min, max, sumsq]}"""
+        buckets = {}
+        for record in records:
+            try:
+                ts = float(record.get('timestamp'))
+            except (TypeError, ValueError):
+                continue
+            mac = record.get('mac_address') or ''
+            crop = record.get('crop_number')
+            crop = -1 if crop is None else int(crop)
+            for sensor in SENSOR_COLUMNS:
+                value = record.get(sensor)
+                if value is None or value == 0:
+                    continue
+                low, high = OUTLIER_RANGES[sensor]
+                if not low <= value <= high:
+                    continue  # Outlier (or NaN)
+                for granularity, size in ROLLUP_GRANULARITIES.items():
+                    key = (granularity, self.bucket_start(ts, size), mac, crop, sensor)
+                    agg = buckets.get(key)
+                    if agg is None:
+                        buckets[key] = [1, value, value, value, value * value]
+                    else:
+                        agg[0] += 1
+                        agg[1] += value
+                        agg[2] = min(agg[2], value)
+                        agg[3] = max(agg[3], value)
+                        agg[4] += value * value
+        return buckets
+
+    def write_batch(self, records):
+        buckets = self.aggregate(records)
+        if not buckets:
+            return
+        self.open()
+        rows = [key + tuple(agg) for key, agg in buckets.items()]
+        with self._lock, self._conn:
+            self._conn.executemany("""
+                INSERT INTO rollups (granularity, bucket, mac_address, crop_number, sensor, count, sum, min, max, sumsq)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (granularity, bucket, mac_address, crop_number, sensor) DO UPDATE SET
+                    count = count + excluded.count,
+                    sum = sum + excluded.sum,
+                    min = MIN(min, excluded.min),
+                    max = MAX(max, excluded.max),
+                    sumsq = sumsq + excluded.sumsq""", rows)
+
+    def is_empty(self):
+        self.open()
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM rollups LIMIT 1").fetchone() is None
+
+    def import_jsonl(self, jsonl_path, batch_size=5000):
+        """Build rollups from an existing JSON Lines history. Returns number of records rolled up."""
+        if not os.path.exists(jsonl_path):
+            return 0
+        imported = 0
+        for batch in iter_jsonl_batches(jsonl_path, batch_size):
+            self.write_batch(batch)
+            imported += len(batch)
+        logging.info(f"Built rollups for {imported} records from {jsonl_path} in {self.path}")
+        return imported
+
+    def query(self, granularity, start=None, end=None, crop_number=None, sensors=None):
+        """
+        Rollups combined over devices, one row per (bucket, sensor).
+        start/end are epoch seconds; buckets starting in [start's bucket, end) are returned.
+        Returns: DataFrame with timestamp (naive UTC bucket start), sensor, count, sum, min, max, sumsq
+        """
+        self.open()
+        conditions = ["granularity = ?"]
+        params = [granularity]
+        if start is not None:
+            conditions.append("bucket >= ?")
+            params.append(self.bucket_start(start, ROLLUP_GRANULARITIES[granularity]))
+        if end is not None:
+            conditions.append("bucket < ?")
+            params.append(end)
+        if crop_number is not None:
+            conditions.append("crop_number = ?")
+            params.append(int(crop_number))
+        if sensors is not None:
+            conditions.append(f"sensor IN ({', '.join('?' for _ in sensors)})")
+            params.extend(sensors)
+
+        sql = f"""
+            SELECT bucket, sensor, SUM(count) AS count, SUM(sum) AS sum, MIN(min) AS min,
+                   MAX(max) AS max, SUM(sumsq) AS sumsq
+            FROM rollups WHERE {' AND '.join(conditions)}
+            GROUP BY bucket, sensor ORDER BY bucket"""
+        with self._lock:
+            df = pd.read_sql_query(sql, self._conn, params=params)
+        df['timestamp'] = pd.to_datetime(df.pop('bucket'), unit='s').astype('datetime64[ns]')
+        return df
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def rollup_means(rollups):
+    """Pivot rollups (as returned by RollupStore.query) into one mean column per sensor"""
+    if len(rollups) == 0:
+        return pd.DataFrame(columns=['timestamp'])
+    means = rollups.assign(mean=rollups['sum'] / rollups['count'])
+    wide = means.pivot(index='timestamp', columns='sensor', values='mean')
+    wide.columns.name = None
+    return wide.reset_index()
+
+
+class LatestSnapshot:
+    """
+    The latest reading of every device/crop, kept in a small JSON file so the
+    dashboard's gauges don't need the history. The file is rewritten after each
+    batch through a temporary file and os.replace, so readers never see a
+    partial snapshot.
+
+    Besides the reading itself, each entry holds the last value of each sensor
+    that the dashboard's cleaning would keep (no exact zero, inside
+    OUTLIER_RANGES), which stands in for the cleaned latest value.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = None  # (mac_address, crop_number) -> entry
+
+    def open(self):
+        if self._entries is None:
+            self._entries = {}
+            try:
+                with open(self.path, 'rb') as f:
+                    snapshot = json.load(f)
+                for entry in snapshot.get("readings", []):
+                    self._entries[(entry.get("mac_address"), entry.get("crop_number"))] = entry
+            except FileNotFoundError:
+                pass
+            except (ValueError, AttributeError) as e:
+                logging.warning(f"Ignoring unreadable snapshot {self.path}: {str(e)}")
+        return self
+
+    def is_empty(self):
+        return not self.open()._entries
+
+    def update(self, records):
+        """Take newer readings from records into the snapshot. Returns: whether anything changed"""
+        self.open()
+        changed = False
+        for record in records:
+            try:
+                ts = float(record.get('timestamp'))
+            except (TypeError, ValueError):
+                continue
+            key = (record.get('mac_address'), record.get('crop_number'))
+            entry = self._entries.get(key)
+            if entry is not None and entry['timestamp'] > ts:
+                continue  # Late record
+            valid = dict(entry['valid']) if entry is not None else {}
+            for sensor in SENSOR_COLUMNS:
+                value = record.get(sensor)
+                low, high = OUTLIER_RANGES[sensor]
+                if isinstance(value, (int, float)) and value != 0 and low <= value <= high:
+                    valid[sensor] = value
+            entry = {col: record.get(col) for col in ('mac_address', 'crop_number', 'date', 'time', *SENSOR_COLUMNS)}
+            entry['timestamp'] = ts
+            entry['valid'] = valid
+            self._entries[key] = entry
+            changed = True
+        return changed
+
+    def write_batch(self, records):
+        if self.update(records):
+            self.save()
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({"updated": time.time(), "readings": list(self._entries.values())}, f, separators=(',', ':'))
+        os.replace(tmp_path, self.path)
+
+    def import_jsonl(self, jsonl_path, batch_size=5000):
+        """Build the snapshot from an existing JSON Lines history. Returns number of devices in it."""
+        if not os.path.exists(jsonl_path):
+            return 0
+        for batch in iter_jsonl_batches(jsonl_path, batch_size):
+            self.update(batch)
+        self.save()
+        logging.info(f"Built latest readings of {len(self._entries)} device(s) from {jsonl_path} in {self.path}")
+        return len(self._entries)
+
+    def close(self):
+        pass
+
+
+def read_latest_snapshot(path, cleaned=False):
+    """
+    Readings of a LatestSnapshot file as a compact frame, one row per device/crop
+    in time order. With cleaned, each sensor holds its last value the cleaning keeps.
+    Raises FileNotFoundError if the listener hasn't written one.
+    """
+    with open(path, 'rb') as f:
+        readings = json.load(f).get("readings", [])
+    df = pd.DataFrame(readings, columns=['timestamp', 'mac_address', 'crop_number', 'date', 'time', *SENSOR_COLUMNS])
+    if cleaned:
+        valid = pd.DataFrame([entry.get('valid', {}) for entry in readings], columns=SENSOR_COLUMNS, dtype='float64')
+        df[SENSOR_COLUMNS] = valid.to_numpy()
+    df['timestamp'] = pd.to_datetime(df['timestamp'], unit='s')
+    return compact_frame(df.sort_values('timestamp', kind='stable').reset_index(drop=True))
+
+
+def _key_value(value, cast=float):
+    """value as cast, None when missing or unparseable (so "10", 10 and 10.0 give the same key)"""
+    if value is None or value == "":
+        return None
+    try:
+        number = float(value)
+        return None if number != number else cast(number)  # NaN (pandas' missing value) is missing
+    except (TypeError, ValueError, OverflowError):
+        return str(value)
+
+
+def _key_text(value):
+    return None if value is None or value == "" or value != value else str(value)
+
+
+def duplicate_key(record):
+    """Hash of what identifies a reading: device, crop, device date/time and sensor values (not the arrival time)"""
+    mac = _key_text(record.get('mac_address'))
+    return hash((mac.upper() if mac else None, _key_value(record.get('crop_number'), int),
+                 _key_text(record.get('date')), _key_text(record.get('time')),
+                 tuple(_key_value(record.get(sensor)) for sensor in SENSOR_COLUMNS)))
+
+
+class DuplicateFilter:
+    """
+    Recognizes repeated sensor payloads (resent messages, devices repeating a
+    reading) by duplicate_key. The keys of the last max_keys kept records are
+    remembered, least recently seen forgotten first.
+
+    A record with the device's date and time is a duplicate while its key is
+    remembered. Without them, identical readings a few minutes apart are
+    usually genuine, so such a record only counts as a duplicate within
+    undated_window seconds of the kept one.
+    """
+
+    def __init__(self, max_keys=50000, undated_window=10.0):
+        self.max_keys = max_keys
+        self.undated_window = undated_window
+        self._seen = OrderedDict()  # key -> timestamp of the kept record
+
+    def is_duplicate(self, record):
+        """Whether record repeats a recently kept one; if not, it is remembered as kept"""
+        try:
+            ts = float(record.get('timestamp'))
+        except (TypeError, ValueError):
+            ts = time.time()
+        key = duplicate_key(record)
+        kept_at = self._seen.get(key)
+        if kept_at is not None:
+            dated = _key_text(record.get('date')) is not None and _key_text(record.get('time')) is not None
+            if dated or abs(ts - kept_at) <= self.undated_window:
+                self._seen.move_to_end(key)
+                return True
+        self._seen[key] = ts
+        self._seen.move_to_end(key)
+        if len(self._seen) > self.max_keys:
+            self._seen.popitem(last=False)
+        return False
+
+
+class ParquetArchive:
+    """
+    Time-partitioned Parquet archive of older records, laid out as
+    <root>/year=YYYY/month=MM[/day=DD]/part-<cutoff>.parquet.
+
+    Each compaction run writes files named after its cutoff and then records that
+    cutoff in <root>/_watermark.json. Files named after a cutoff beyond the
+    watermark belong to a run that crashed before committing, so readers ignore
+    them and the next compaction deletes them.
+    """
+
+    def __init__(self, root, partition="month"):
+        if partition not in ("month", "day"):
+            raise ValueError(f"Unsupported archive partitioning: {partition}")
+        self.root = root
+        self.partition = partition
+
+    @property
+    def watermark_path(self):
+        return os.path.join(self.root, "_watermark.json")
+
+    def watermark(self):
+        """Epoch seconds before which records live in the archive (0 if nothing archived)"""
+        try:
+            with open(self.watermark_path, 'r') as f:
+                return float(json.load(f)["archived_before"])
+        except (FileNotFoundError, ValueError, KeyError):
+            return 0.0
+
+    def commit(self, cutoff):
+        """Make part files written for cutoff visible to readers"""
+        tmp_path = self.watermark_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({"archived_before": cutoff}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.watermark_path)
+
+    def _partition_dir(self, ts):
+        parts = [f"year={ts.year:04d}", f"month={ts.month:02d}"]
+        if self.partition == "day":
+            parts.append(f"day={ts.day:02d}")
+        return os.path.join(self.root, *parts)
+
+    def _partitions(self):
+        """Yield (directory, start, end) for every partition, with [start, end) as naive UTC timestamps.
+        Month and day partitions are both recognized, whatever this archive writes."""
+        if not os.path.isdir(self.root):
+            return
+        for year_entry in os.scandir(self.root):
+            if not (year_entry.is_dir() and year_entry.name.startswith("year=")):
+                continue
+            year = int(year_entry.name[5:])
+            for month_entry in os.scandir(year_entry.path):
+                if not (month_entry.is_dir() and month_entry.name.startswith("month=")):
+                    continue
+                month_start = pd.Timestamp(year=year, month=int(month_entry.name[6:]), day=1)
+                yield month_entry.path, month_start, month_start + pd.DateOffset(months=1)
+                for day_entry in os.scandir(month_entry.path):
+                    if day_entry.is_dir() and day_entry.name.startswith("day="):
+                        day_start = month_start.replace(day=int(day_entry.name[4:]))
+                        yield day_entry.path, day_start, day_start + pd.Timedelta(days=1)
+
+    def _part_files(self, directory, watermark):
+        """Committed part files of a partition and orphans left behind by a crashed run"""
+        committed, orphans = [], []
+        for entry in os.scandir(directory):
+            if entry.is_file() and entry.name.startswith("part-") and entry.name.endswith(".parquet"):
+                cutoff = float(entry.name[5:-8])
+                (committed if cutoff <= watermark else orphans).append(entry.path)
+        return committed, orphans
+
+    def write(self, df, cutoff):
+        """Write records (timestamp as naive UTC datetime) into their partitions, typed compactly"""
+        df = compact_frame(df.copy(deep=False))
+
+        keys = df['timestamp'].dt.strftime("%Y-%m-%d" if self.partition == "day" else "%Y-%m")
+        for _, part in df.groupby(keys, sort=False):
+            directory = self._partition_dir(part['timestamp'].iloc[0])
+            os.makedirs(directory, exist_ok=True)
+            part.sort_values('timestamp').to_parquet(
+                os.path.join(directory, f"part-{int(cutoff)}.parquet"), index=False)
+
+    def read(self, start=None, end=None, columns=None):
+        """
+        Read archived records in [start, end) (naive UTC timestamps or None), opening only
+        the partitions that overlap the range and only the requested columns.
+        Returns: DataFrame sorted by timestamp (empty if nothing matches)
+        """
+        watermark = self.watermark()
+        read_columns = None if columns is None else ['timestamp'] + [c for c in columns if c != 'timestamp']
+        frames = []
+        for directory, part_start, part_end in self._partitions():
+            if (start is not None and part_end <= start) or (end is not None and part_start >= end):
+                continue  # Partition pruned by the date range
+            for path in self._part_files(directory, watermark)[0]:
+                frames.append(pd.read_parquet(path, columns=read_columns))
+
+        if not frames:
+            return pd.DataFrame(columns=read_columns or [])
+        df = concat_frames(frames)
+        if start is not None:
+            df = df[df['timestamp'] >= start]
+        if end is not None:
+            df = df[df['timestamp'] < end]
+        return df.sort_values('timestamp', kind='stable').reset_index(drop=True)
+
+    def remove_orphans(self):
+        watermark = self.watermark()
+        for directory, _, _ in self._partitions():
+            for path in self._part_files(directory, watermark)[1]:
+                logging.warning(f"Removing incomplete archive file {path}")
+                os.remove(path)
+
+
+def archive_jsonl(jsonl_path, archive, cutoff):
+    """
+    Move records older than cutoff (epoch seconds) from a JSON Lines file into the
+    Parquet archive. Recent lines are copied verbatim into a new file that atomically
+    replaces the old one. Must not run while a JsonlWriter has the file open.
+    Returns: number of records archived
+    """
+    cutoff = int(cutoff)  # Part files are named after the cutoff
+    archive.remove_orphans()
+    if not os.path.exists(jsonl_path):
+        return 0
+    data, _ = read_jsonl_bytes(jsonl_path)
+    if not data:
+        return 0
+
+    lines = data.split(b'\n')[:-1]
+    df = pd.read_json(BytesIO(data), lines=True, convert_dates=False)
+    old = (pd.to_numeric(df['timestamp'], errors='coerce') < cutoff).to_numpy()
+    if not old.any():
+        return 0
+
+    archived = df[old].copy()
+    archived['timestamp'] = pd.to_datetime(archived['timestamp'], unit='s').astype('datetime64[ns]')
+    archive.write(archived, cutoff)
+
+    # Commit the archive files before dropping the records from the hot store: a crash
+    # in between leaves duplicates rather than losing data
+    archive.commit(max(cutoff, archive.watermark()))
+
+    tmp_path = jsonl_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        for line, is_old in zip(lines, old):
+            if not is_old:
+                f.write(line + b'\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, jsonl_path)
+
+    logging.info(f"Archived {int(old.sum())} records older than {cutoff} from {jsonl_path} to {archive.root}")
+    return int(old.sum())
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    migrate_json_array("sensor_data.json", "sensor_data.jsonl")
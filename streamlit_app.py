@@ -9,6 +9,20 @@ import time
 import os
 import pytz
 
+from dashboard_profiler import PROFILE_DIR, RunProfiler, stage as profile_stage, stop_active
+from data_export import EXPORT_FORMATS, export_file, export_formats, export_mime, export_name
+from insight_rules import evaluate_rules, recent_readings
+from sensor_processing import (SharedSensorData, clean_and_interpolate_data, downsample_indices, frame_page,
+                               localize_timestamps, time_slice)
+from sensor_stats import Moments
+from sensor_store import (PARQUET_AVAILABLE, SENSOR_COLUMNS, ParquetArchive, RollupStore, SqliteStore, compact_frame,
+                          concat_frames, read_latest_snapshot, rollup_means)
+
+
+# Sessions share one copy of the sensor data; copy-on-write keeps their changes private
+# (always on from pandas 3, where the option is deprecated)
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
 
 pk_tz = pytz.timezone("Asia/Karachi")
 
@@ -49,97 +63,394 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # Constants
-JSON_FILE = "sensor_data.json"
+JSONL_FILE = "sensor_data.jsonl"
+LEGACY_JSON_FILE = "sensor_data.json"  # Read only until the listener has migrated it
 REFRESH_INTERVAL = 5  # seconds
+STORAGE_BACKEND = "jsonl"  # "jsonl" or "sqlite" (requires sqlite_enabled in mqtt_listener.py)
+SQLITE_FILE = "sensor_data.db"
+ARCHIVE_DIR = "archive"  # Parquet archive written by the listener's compaction job (requires pyarrow)
+ROLLUP_FILE = "sensor_rollups.db"  # Hourly/daily rollups maintained by the listener
+LATEST_FILE = "sensor_latest.json"  # Latest reading of each device, maintained by the listener
+MAX_CHART_POINTS = 1500  # Default point budget per trend chart trace
+INSIGHTS_SHOWN = 10  # Alerts listed under Insights; the rest are in a table below them
+# Detailed Analysis: above this many rows, the distribution and scatter matrix are drawn from
+# data binned on the server instead of sending every reading to the browser
+ANALYSIS_MAX_ROWS = 20000
+ANALYSIS_BINS = 40  # Bins per axis of the binned scatter matrix
+FIGURE_CACHE_ENTRIES = 32  # Detailed Analysis figures kept for reruns with the same data and settings
+RAW_PAGE_SIZE = 20  # Rows per page of the Historical Data page's raw data table
+DOWNSAMPLE_METHOD = "lttb"  # "lttb" (keeps the shape) or "minmax" (keeps every bucket's extremes)
+# Default of the sidebar's profiling toggles: "1" times each stage, "cprofile" also dumps cProfile output
+PROFILE_MODE = os.environ.get("AGRI_DASHBOARD_PROFILE", "")
+
+# Selectable timeframes and how far back each reaches (None = all data)
+TIMEFRAMES = {
+    "Live (Last 5 min)": timedelta(minutes=5),
+    "Last hour": timedelta(hours=1),
+    "Last 6 hours": timedelta(hours=6),
+    "Last day": timedelta(days=1),
+    "Last week": timedelta(weeks=1),
+    "Last month": timedelta(days=30),
+    "Last quarter": timedelta(days=90),
+    "Last 6 months": timedelta(days=182),
+    "Last year": timedelta(days=365),
+    "All data": None,
+}
+
+# Long timeframes plot rollup averages instead of raw readings
+ROLLUP_TREND_GRANULARITY = {
+    "Last month": "hour",
+    "Last quarter": "hour",
+    "Last 6 months": "day",
+    "Last year": "day",
+    "All data": "day",
+}
+
+# Trend chart rows: (column, subplot title, trace name, color)
+TREND_TRACES = [
+    ("soil_moisture", "Soil Moisture", "Soil Moisture", "blue"),
+    ("soil_temperature", "Soil Temperature", "Soil Temperature", "red"),
+    ("soil_conductivity", "Soil Conductivity", "Soil Conductivity", "purple"),
+    ("soil_nitrogen", "Soil Nitrogen", "Nitrogen", "green"),
+    ("soil_phosphorus", "Soil Phosphorus", "Phosphorus", "orange"),
+    ("soil_potassium", "Soil Potassium", "Potassium", "brown"),
+    ("soil_ph", "Soil pH", "Soil pH", "darkgreen"),
+    ("air_temperature", "Air Temperature", "Air Temperature", "crimson"),
+    ("air_humidity", "Air Humidity", "Air Humidity", "skyblue"),
+]
 
 # Helper functions
-def clean_and_interpolate_data(df):
-    """Clean data by replacing zeros and outliers with interpolated values"""
-    if df is None or len(df) == 0:
-        return df
-    
-    # Define sensor columns to clean
-    sensor_columns = ['soil_moisture', 'soil_nitrogen', 'soil_phosphorus', 'soil_potassium',
-                      'soil_temperature', 'soil_conductivity', 'soil_ph', 
-                      'air_temperature', 'air_humidity']
-    
-    # Define reasonable outlier thresholds based on physical limits
-    outlier_ranges = {
-        'soil_moisture': (0.1, 100),
-        'soil_nitrogen': (0.1, 200),
-        'soil_phosphorus': (0.1, 150),
-        'soil_potassium': (0.1, 500),
-        'soil_temperature': (-10, 60),
-        'soil_conductivity': (0.1, 2000),
-        'soil_ph': (3.0, 10.0),
-        'air_temperature': (-40, 60),
-        'air_humidity': (0.1, 100)
-    }
-    
-    df_clean = df.copy()
-    
-    for col in sensor_columns:
-        if col in df_clean.columns:
-            # Replace exact zeros with NaN (assuming zeros are sensor errors)
-            df_clean.loc[df_clean[col] == 0, col] = np.nan
-            
-            # Replace outliers with NaN
-            if col in outlier_ranges:
-                min_val, max_val = outlier_ranges[col]
-                df_clean.loc[(df_clean[col] < min_val) | (df_clean[col] > max_val), col] = np.nan
-            
-            # Interpolate missing values with a limit to avoid long gaps
-            # Only interpolate up to 10 consecutive missing values (reasonable for short sensor glitches)
-            df_clean[col] = df_clean[col].interpolate(method='linear', limit=10, limit_direction='both')
-            
-            # For remaining NaN (large gaps), use forward fill but limit to 5 values
-            df_clean[col] = df_clean[col].fillna(method='ffill', limit=5)
-            
-            # If still NaN at the beginning, use backward fill with limit
-            df_clean[col] = df_clean[col].fillna(method='bfill', limit=5)
-    
-    return df_clean
-
-def load_data(apply_interpolation=True, refresh_interval=REFRESH_INTERVAL):
-    """Load sensor data with optional cleaning. Uses a dynamic cache key based on time bucket.
-    The cache invalidates automatically each refresh_interval seconds."""
-    @st.cache_data(show_spinner=False)
-    def _load(interpolate, cache_bucket):
-        try:
-            df = pd.read_json(JSON_FILE)
+@st.cache_resource
+def get_shared_data():
+    """One shared, incrementally refreshed copy of the sensor history for all sessions,
+    with timestamps already in Pakistan time"""
+    return SharedSensorData(JSONL_FILE, tz=pk_tz)
+
+def load_data(apply_interpolation=True):
+    """Load sensor data with optional cleaning from the process-wide shared copy, which
+    is refreshed once per change of the data file rather than once per session."""
+    try:
+        if not os.path.exists(JSONL_FILE) and os.path.exists(LEGACY_JSON_FILE):
+            df = pd.read_json(LEGACY_JSON_FILE)
             df['timestamp'] = pd.to_datetime(df['timestamp'], unit='s')
-            df = df.sort_values('timestamp')
-
-            if interpolate:
-                df = clean_and_interpolate_data(df)
-            return df
-        except FileNotFoundError:
-            st.error("Sensor data file not found. Please ensure the MQTT listener is running.")
-            return None
-        except ValueError:
-            st.warning("Sensor data file is empty or invalid. Please wait for data to be collected.")
-            return None
-        except Exception as e:
-            st.error(f"An error occurred: {e}")
-            return None
-
-    # Derive a bucket that changes every refresh_interval seconds
-    bucket = int(time.time() // max(refresh_interval, 1))
-    return _load(apply_interpolation, bucket)
-
-def get_optimal_ranges():
-    # Define optimal ranges for each parameter
-    return {
-        "soil_moisture": (30, 70),
-        "soil_nitrogen": (5, 15),
-        "soil_phosphorus": (5, 15),
-        "soil_potassium": (15, 30),
-        "soil_temperature": (20, 30),
-        "soil_conductivity": (50, 80),
-        "soil_ph": (6.0, 7.5),
-        "air_temperature": (20, 35),
-        "air_humidity": (50, 85)
-    }
+            df = compact_frame(df.sort_values('timestamp'))
+            return clean_and_interpolate_data(df) if apply_interpolation else df
+
+        shared = get_shared_data()
+        with profile_stage("load"):
+            shared.refresh()
+        with profile_stage("clean" if apply_interpolation else "load"):
+            df = shared.get(cleaned=apply_interpolation)
+        if df is None or len(df) == 0:
+            raise ValueError("No records in sensor data file")
+        return df
+    except FileNotFoundError:
+        st.error("Sensor data file not found. Please ensure the MQTT listener is running.")
+        return None
+    except ValueError:
+        st.warning("Sensor data file is empty or invalid. Please wait for data to be collected.")
+        return None
+    except Exception as e:
+        st.error(f"An error occurred: {e}")
+        return None
+
+@st.cache_resource
+def get_sqlite_store():
+    return SqliteStore(SQLITE_FILE).open()
+
+@st.cache_data(show_spinner=False, max_entries=16, ttl=REFRESH_INTERVAL)
+def query_sqlite(start, crop, columns, apply_interpolation):
+    """Rows of the SQLite store since start (epoch seconds, None for all), cleaned if
+    requested. Cached for REFRESH_INTERVAL so reruns and live fragment ticks within
+    it share one query."""
+    with profile_stage("load"):
+        df = get_sqlite_store().query(start=start, crop_number=crop, columns=columns)
+    if len(df) == 0 or not apply_interpolation:
+        return df
+    with profile_stage("clean"):
+        return clean_and_interpolate_data(df)
+
+def load_data_sqlite(start=None, crop=None, columns=None, apply_interpolation=True):
+    """Load sensor data from SQLite with the timeframe, crop and sensor filters evaluated
+    in SQL, so only the matching rows are read."""
+    try:
+        if not os.path.exists(SQLITE_FILE):
+            raise FileNotFoundError(SQLITE_FILE)
+        if start is None:
+            return query_sqlite(None, crop, columns, apply_interpolation)
+        # Round the start down so consecutive reruns hit the cache, then cut the extra rows off
+        df = query_sqlite(start - start % REFRESH_INTERVAL, crop, columns, apply_interpolation)
+        return time_slice(df, start=pd.Timestamp(start, unit='s'), assume_sorted=True)
+    except FileNotFoundError:
+        st.error("Sensor database not found. Please ensure the MQTT listener is running with sqlite_enabled.")
+        return None
+    except Exception as e:
+        st.error(f"An error occurred: {e}")
+        return None
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def load_archive(start, crop, columns, apply_interpolation, watermark):
+    """Load archived records since start (naive UTC, None for all), reading only the
+    partitions in range and the requested columns, with timestamps in Pakistan time.
+    The archive only changes when a compaction moves the watermark, which is part of
+    the cache key."""
+    read_columns = None if columns is None else ['crop_number'] + list(columns)
+    df = ParquetArchive(ARCHIVE_DIR).read(start=start, columns=read_columns)
+    if len(df) == 0:
+        return None
+    if crop is not None:
+        df = df[df['crop_number'] == int(crop)]
+    if columns is not None:
+        df = df[['timestamp'] + list(columns)]
+    if apply_interpolation:
+        df = clean_and_interpolate_data(df)
+    return localize_timestamps(df, pk_tz)
+
+@st.cache_resource
+def get_rollup_store():
+    return RollupStore(ROLLUP_FILE).open()
+
+def rollups_available():
+    return os.path.exists(ROLLUP_FILE)
+
+def load_rollup_means(granularity, start=None, end=None, crop=None):
+    """Mean of each sensor per hour, day or week, served from the listener's rollups
+    (epoch seconds for start/end). Weeks are combined from daily rollups and labelled
+    by their last day, like resample('W'). Timestamps are returned in Pakistan time."""
+    store = get_rollup_store()
+    if granularity == "week":
+        rollups = store.query("day", start=start, end=end, crop_number=crop)
+        rollups['timestamp'] = rollups['timestamp'].dt.tz_localize('UTC').dt.tz_convert(pk_tz)
+        rollups = (rollups.groupby([pd.Grouper(key='timestamp', freq='W'), 'sensor'])[['count', 'sum']]
+                   .sum().reset_index())
+        rollups = rollups[rollups['count'] > 0]
+        return rollup_means(rollups)
+
+    means = rollup_means(store.query(granularity, start=start, end=end, crop_number=crop))
+    means['timestamp'] = pd.to_datetime(means['timestamp']).dt.tz_localize('UTC').dt.tz_convert(pk_tz)
+    return means
+
+def archive_watermark(start_ts):
+    """Watermark of the Parquet archive if a timeframe starting at start_ts reaches into it, else None"""
+    if PARQUET_AVAILABLE and os.path.isdir(ARCHIVE_DIR):
+        watermark = ParquetArchive(ARCHIVE_DIR).watermark()
+        if watermark and (start_ts is None or start_ts < watermark):
+            return watermark
+    return None
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def read_latest(mtime, apply_interpolation):
+    """The listener's latest-reading snapshot in Pakistan time (mtime keys the cache to the file's version)"""
+    return localize_timestamps(read_latest_snapshot(LATEST_FILE, cleaned=apply_interpolation), pk_tz)
+
+def device_readings(timeframe, crop_number, apply_interpolation):
+    """Latest reading of every device/crop in the sidebar selection, in time order, read from
+    the listener's snapshot rather than the history. Returns: None if there is no snapshot"""
+    try:
+        latest = read_latest(os.stat(LATEST_FILE).st_mtime_ns, apply_interpolation)
+    except (FileNotFoundError, ValueError):
+        return None  # Listener without the snapshot (or an unreadable one): fall back to the history
+    window = TIMEFRAMES[timeframe]
+    if window is not None:
+        latest = time_slice(latest, start=pd.Timestamp.now(tz=pk_tz) - window, assume_sorted=True)
+    if crop_number != "All":
+        latest = latest[latest["crop_number"] == int(crop_number)]
+    return latest
+
+def load_filtered_data(timeframe, crop_number, sensor_type, apply_interpolation):
+    """Sensor data for the sidebar selection, with timestamps in Pakistan time"""
+    window = TIMEFRAMES[timeframe]
+    start_ts = time.time() - window.total_seconds() if window is not None else None
+
+    if STORAGE_BACKEND == "sqlite":
+        # Timeframe, crop and sensor filters are pushed down into the SQL query
+        df = load_data_sqlite(
+            start=start_ts,
+            crop=None if crop_number == "All" else crop_number,
+            columns=None if sensor_type == "All" else [sensor_type],
+            apply_interpolation=apply_interpolation,
+        )
+        filters_applied = True
+    else:
+        df = load_data(apply_interpolation=apply_interpolation)
+        filters_applied = False
+
+    # Convert timestamps to Pakistan time (the shared JSON Lines data already is)
+    if df is not None and 'timestamp' in df.columns:
+        with profile_stage("timezone"):
+            df = localize_timestamps(df, pk_tz)
+
+    # Filter data based on selected timeframe (already done in SQL for the sqlite backend).
+    # Archived records are filtered by load_archive, so only the hot store's rows are filtered here
+    if not filters_applied and df is not None and len(df) > 0:
+        with profile_stage("filter"):
+            # Timeframe filter: the data is sorted by time, so this is a binary search
+            if window is not None:
+                df = time_slice(df, start=pd.Timestamp.now(tz=pk_tz) - window, assume_sorted=True)
+
+            # Crop number filter
+            if crop_number != "All":
+                df = df[df["crop_number"] == int(crop_number)]
+
+            # Sensor type filter
+            if sensor_type != "All":
+                df = df[["timestamp", sensor_type]]
+
+    # Add archived records when the timeframe reaches back past the hot store
+    watermark = archive_watermark(start_ts)
+    if watermark:
+        # Round the start down to the hour so consecutive reruns share the cached archive read
+        archive_start = None if start_ts is None else pd.Timestamp(start_ts, unit='s').floor('h')
+        with profile_stage("archive"):
+            archived = load_archive(
+                archive_start,
+                None if crop_number == "All" else crop_number,
+                None if sensor_type == "All" else [sensor_type],
+                apply_interpolation,
+                watermark,
+            )
+        if archived is not None and len(archived) > 0:
+            if start_ts is not None:
+                archived = time_slice(archived, start=pd.Timestamp(start_ts, unit='s', tz='UTC'), assume_sorted=True)
+            df = concat_frames([archived, df]) if df is not None else archived.copy(deep=False)
+            if not df['timestamp'].is_monotonic_increasing:
+                df = df.sort_values('timestamp', kind='stable').reset_index(drop=True)
+    return df
+
+def window_moments(df, timeframe, crop_number, apply_interpolation):
+    """
+    Statistics of the sensor columns of df, the frame load_filtered_data returned for the
+    selection, or of one crop's rows in it. When df is a slice of the shared JSON Lines data they come from its
+    streaming statistics, which are kept up to date as records arrive, instead of a
+    pass over every row of the timeframe on each rerun.
+    Returns: Moments
+    """
+    columns = [col for col in SENSOR_COLUMNS if col in df.columns]
+    window = TIMEFRAMES[timeframe]
+    start_ts = time.time() - window.total_seconds() if window is not None else None
+    if (STORAGE_BACKEND == "jsonl" and os.path.exists(JSONL_FILE) and len(df) > 0
+            and archive_watermark(start_ts) is None):
+        # df holds every row of the selection from its first timestamp to its last
+        moments = get_shared_data().moments(
+            cleaned=apply_interpolation,
+            start=df['timestamp'].iloc[0],
+            end=df['timestamp'].iloc[-1] + pd.Timedelta(1, unit='ns'),
+            crop_number=None if crop_number == "All" else int(crop_number),
+        )
+        if moments is not None:
+            return moments.select(columns)
+    if crop_number != "All" and 'crop_number' in df.columns:
+        df = df[df['crop_number'] == int(crop_number)]
+    return Moments.from_frame(df, columns)
+
+def live_fragment(run_every):
+    """Decorator for the parts of a page that refresh on their own: with st.fragment
+    only the decorated function reruns every run_every seconds, not the whole script.
+    On Streamlit versions without fragments the function runs as part of the page."""
+    fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None)
+    if fragment is None:
+        return lambda func: func
+    return fragment(run_every=run_every)
+
+FRAGMENTS_AVAILABLE = hasattr(st, "fragment") or hasattr(st, "experimental_fragment")
+
+def fetch_raw_page(df, anchor, newest_first, start, end, filters, from_store):
+    """
+    One page of the raw data table. anchor: None (first page), ("after", cursor) or
+    ("before", cursor) relative to the previous page, or ("last", None).
+    Returns: (page in display order, cursor of its first row, cursor of its last row)
+    """
+    kind, cursor = anchor or ("after", None)
+    # Pages before the cursor (and the last page) are read in the opposite order and flipped
+    descending = newest_first if kind == "after" else not newest_first
+    after = cursor if kind != "last" else None
+    if from_store:
+        page, first, last = get_sqlite_store().page(RAW_PAGE_SIZE, after=after, descending=descending,
+                                                    start=start.timestamp(), end=end.timestamp(), filters=filters)
+        page = localize_timestamps(page, pk_tz)[[col for col in df.columns if col in page.columns]]
+    else:
+        page, first, last = frame_page(df, RAW_PAGE_SIZE, after=after, descending=descending,
+                                       start=start, end=end, filters=filters)
+    if kind != "after":
+        return page.iloc[::-1], last, first
+    return page, first, last
+
+@live_fragment(run_every=None)
+def raw_data_table(df, start, end, crop_number, apply_interpolation):
+    """
+    Raw Data section of the Historical Data page: readings with start <= timestamp < end,
+    a page at a time. Pages are fetched by keyset pagination on the timestamp - from the
+    SQLite store's time index when it holds the rows as shown, otherwise from the loaded
+    frame by binary search - and turning a page reruns only this section.
+    """
+    col1, col2, col3, col4, col5 = st.columns(5)
+    with col1:
+        newest_first = st.checkbox("Newest first", key="raw_newest_first")
+    with col2:
+        devices = sorted(df['mac_address'].dropna().unique()) if 'mac_address' in df.columns else []
+        device = st.selectbox("Device", ["All"] + devices, key="raw_device")
+    with col3:
+        value_column = st.selectbox("Filter by value", ["None"] + [col for col in SENSOR_COLUMNS if col in df.columns],
+                                    key="raw_value_column")
+    low = high = None
+    if value_column != "None":
+        with col4:
+            low = st.number_input("Min", value=None, key="raw_value_min")
+        with col5:
+            high = st.number_input("Max", value=None, key="raw_value_max")
+
+    filters = {}
+    if device != "All":
+        filters['mac_address'] = device
+    if value_column != "None" and (low is not None or high is not None):
+        filters[value_column] = (low, high)
+
+    from_store = (STORAGE_BACKEND == "sqlite" and not apply_interpolation and os.path.exists(SQLITE_FILE)
+                  and archive_watermark(start.timestamp()) is None)
+    store_filters = dict(filters, crop_number=int(crop_number)) if from_store and crop_number != "All" else filters
+
+    # A new query starts at its first page
+    query = (start, end, crop_number, apply_interpolation, newest_first, tuple(sorted(filters.items())))
+    if st.session_state.get("raw_query") != query:
+        st.session_state["raw_query"] = query
+        st.session_state["raw_anchor"] = None
+
+    with profile_stage("raw data page"):
+        anchor = st.session_state.get("raw_anchor")
+        page, first, last = fetch_raw_page(df, anchor, newest_first, start, end, store_filters, from_store)
+        if len(page) == 0 and anchor is not None:
+            # Moved past either end: show the first or last page instead
+            anchor = ("last", None) if anchor[0] == "after" else None
+            page, first, last = fetch_raw_page(df, anchor, newest_first, start, end, store_filters, from_store)
+            st.session_state["raw_anchor"] = anchor
+
+    def go_to(new_anchor):
+        st.session_state["raw_anchor"] = new_anchor
+
+    nav = st.columns(4)
+    nav[0].button("⏮ First", on_click=go_to, args=(None,), key="raw_first")
+    nav[1].button("◀ Previous", on_click=go_to, args=(("before", first),), disabled=first is None, key="raw_previous")
+    nav[2].button("Next ▶", on_click=go_to, args=(("after", last),), disabled=last is None, key="raw_next")
+    nav[3].button("Last ⏭", on_click=go_to, args=(("last", None),), key="raw_last")
+
+    if len(page) == 0:
+        st.info("No readings match these filters.")
+        return
+    if not filters:
+        st.write(f"Showing {len(page)} of {len(df)} readings, {page['timestamp'].iloc[0]} to {page['timestamp'].iloc[-1]}")
+    else:
+        st.write(f"Showing {len(page)} matching readings, {page['timestamp'].iloc[0]} to {page['timestamp'].iloc[-1]}")
+    st.dataframe(page.reset_index(drop=True))
+
+def show_profile(profiler):
+    """Stage breakdown of a profiled run (and where its cProfile output was saved)"""
+    breakdown = pd.DataFrame(profiler.breakdown(), columns=["Stage", "Seconds", "Calls", "Share (%)"])
+    breakdown["Seconds"] = breakdown["Seconds"].round(4)
+    breakdown["Share (%)"] = (breakdown["Share (%)"] * 100).round(1)
+    with st.expander(f"⏱️ Profile of this {profiler.label} ({profiler.total:.3f} s)"):
+        st.dataframe(breakdown, hide_index=True, use_container_width=True)
+        if profiler.dump_path:
+            st.caption(f"cProfile output: `{profiler.dump_path}` (inspect with `python -m pstats {profiler.dump_path}`)")
 
 def create_gauge(value, title, min_val, max_val, optimal_min, optimal_max):
     fig = go.Figure(go.Indicator(
@@ -164,43 +475,129 @@ def create_gauge(value, title, min_val, max_val, optimal_min, optimal_max):
     fig.update_layout(height=250, margin=dict(l=20, r=20, t=30, b=20))
     return fig
 
-def generate_insights(df):
-    if df is None or len(df) < 10:
-        return "Not enough data to generate insights."
-    
-    insights = []
-    optimal_ranges = get_optimal_ranges()
-    
-    # Get the most recent entry
-    latest = df.iloc[-1]
-    
-    for param, (min_val, max_val) in optimal_ranges.items():
-        current_value = latest[param]
-        if current_value < min_val:
-            insights.append(f"⚠️ {param.replace('_', ' ').title()} is too low ({current_value}). Optimal range: {min_val}-{max_val}.")
-        elif current_value > max_val:
-            insights.append(f"⚠️ {param.replace('_', ' ').title()} is too high ({current_value}). Optimal range: {min_val}-{max_val}.")
-    
-    # Analyze trends
-    if len(df) >= 10:
-        recent_df = df.tail(10)
-        for param in optimal_ranges.keys():
-            slope = np.polyfit(range(10), recent_df[param], 1)[0]
-            if abs(slope) > 0.5:  # Significant change
-                direction = "increasing" if slope > 0 else "decreasing"
-                insights.append(f"📈 {param.replace('_', ' ').title()} is {direction} significantly.")
+def create_trend_figure(trend_df, max_points):
+    """One subplot per sensor, each trace downsampled to max_points"""
+    fig = make_subplots(rows=9, cols=1, 
+               subplot_titles=[title for _, title, _, _ in TREND_TRACES],
+               vertical_spacing=0.02,
+               shared_xaxes=True)
     
-    # Correlation insights
-    if len(df) >= 20:
-        corr = df[list(optimal_ranges.keys())].corr()
-        high_corrs = []
-        for i, row in corr.iterrows():
-            for j, val in row.items():
-                if i != j and abs(val) > 0.7:  # Strong correlation
-                    high_corrs.append(f"🔗 Strong correlation ({val:.2f}) between {i.replace('_', ' ').title()} and {j.replace('_', ' ').title()}.")
-        insights.extend(high_corrs[:3])  # Show top 3 correlations
+    for row, (column, _, name, color) in enumerate(TREND_TRACES, start=1):
+        if column in trend_df.columns:
+            idx = downsample_indices(trend_df['timestamp'], trend_df[column], max_points, DOWNSAMPLE_METHOD)
+            fig.add_trace(go.Scatter(
+                x=trend_df['timestamp'].iloc[idx], y=trend_df[column].iloc[idx],
+                name=name, line=dict(color=color)
+            ), row=row, col=1)
     
-    return insights if insights else "All parameters are within optimal ranges."
+    fig.update_layout(height=1800, showlegend=True, 
+             legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1))
+    return fig
+
+def frame_key(df):
+    """Cheap identity of a frame's rows for the figure caches: row count and first and last timestamp"""
+    if len(df) == 0:
+        return (0,)
+    return (len(df), df['timestamp'].iloc[0].value, df['timestamp'].iloc[-1].value)
+
+# The figure builders below are memoized on the data key (selection and frame_key) and their
+# settings; the frame itself (_df) is not hashed
+@st.cache_resource(max_entries=FIGURE_CACHE_ENTRIES, show_spinner=False)
+def moving_average_figure(_df, data_key, param, window_size, max_points):
+    """param over time with its moving average, each trace downsampled to max_points"""
+    title = param.replace('_', ' ').title()
+    moving_avg = _df[param].rolling(window=window_size).mean()
+    fig = go.Figure()
+    for values, name in [(_df[param], title), (moving_avg, f'{window_size}-point Moving Average')]:
+        idx = downsample_indices(_df['timestamp'], values, max_points, DOWNSAMPLE_METHOD)
+        fig.add_trace(go.Scatter(x=_df['timestamp'].iloc[idx], y=values.iloc[idx], mode='lines', name=name))
+    fig.update_layout(title=f"{title} Over Time with Moving Average", xaxis_title='Time', yaxis_title='value',
+                      legend_title_text='', height=500)
+    return fig
+
+@st.cache_resource(max_entries=FIGURE_CACHE_ENTRIES, show_spinner=False)
+def distribution_figure(_df, data_key, param):
+    """Histogram of param with a box plot above it, binned on the server for large frames"""
+    title = f"Distribution of {param.replace('_', ' ').title()}"
+    values = _df[param].dropna().to_numpy(dtype=np.float64)
+    if len(values) <= ANALYSIS_MAX_ROWS:
+        return px.histogram(_df, x=param, nbins=20, marginal="box", title=title)
+
+    counts, edges = np.histogram(values, bins=20)
+    q1, median, q3 = np.percentile(values, [25, 50, 75])
+    lower_fence = values[values >= q1 - 1.5 * (q3 - q1)].min()
+    upper_fence = values[values <= q3 + 1.5 * (q3 - q1)].max()
+    fig = make_subplots(rows=2, cols=1, shared_xaxes=True, row_heights=[0.2, 0.8], vertical_spacing=0.02)
+    fig.add_trace(go.Box(y=[param], q1=[q1], median=[median], q3=[q3], lowerfence=[lower_fence],
+                         upperfence=[upper_fence], orientation='h', name=param), row=1, col=1)
+    fig.add_trace(go.Bar(x=(edges[:-1] + edges[1:]) / 2, y=counts, width=np.diff(edges), name=param), row=2, col=1)
+    fig.update_layout(title=title, showlegend=False, bargap=0)
+    fig.update_yaxes(showticklabels=False, row=1, col=1)
+    fig.update_xaxes(title_text=param, row=2, col=1)
+    fig.update_yaxes(title_text="count", row=2, col=1)
+    return fig
+
+@st.cache_resource(max_entries=FIGURE_CACHE_ENTRIES, show_spinner=False)
+def scatter_matrix_figure(_df, data_key, params):
+    """Scatter plot matrix of params; for large frames, 2D histograms (and histograms on the diagonal)"""
+    params = list(params)
+    if len(_df) <= ANALYSIS_MAX_ROWS:
+        fig = px.scatter_matrix(_df[params], dimensions=params, title="Scatter Plot Matrix")
+        fig.update_layout(height=600)
+        return fig
+
+    values = _df[params].dropna().to_numpy(dtype=np.float64)
+    k = len(params)
+    fig = make_subplots(rows=k, cols=k, horizontal_spacing=0.02, vertical_spacing=0.02)
+    for i, y_param in enumerate(params):
+        for j, x_param in enumerate(params):
+            if i == j:
+                counts, edges = np.histogram(values[:, j], bins=ANALYSIS_BINS)
+                fig.add_trace(go.Bar(x=(edges[:-1] + edges[1:]) / 2, y=counts, width=np.diff(edges),
+                                     marker_color="#4caf50", name=x_param), row=i + 1, col=j + 1)
+            else:
+                counts, x_edges, y_edges = np.histogram2d(values[:, j], values[:, i], bins=ANALYSIS_BINS)
+                fig.add_trace(go.Heatmap(x=(x_edges[:-1] + x_edges[1:]) / 2, y=(y_edges[:-1] + y_edges[1:]) / 2,
+                                         z=np.where(counts.T > 0, counts.T, np.nan), coloraxis="coloraxis",
+                                         name=f"{x_param} / {y_param}"), row=i + 1, col=j + 1)
+            if i == k - 1:
+                fig.update_xaxes(title_text=x_param, row=i + 1, col=j + 1)
+            if j == 0:
+                fig.update_yaxes(title_text=y_param, row=i + 1, col=j + 1)
+    fig.update_layout(title=f"Scatter Plot Matrix (binned, {len(values):,} readings)", height=600, showlegend=False,
+                      bargap=0, coloraxis=dict(colorscale="Viridis", colorbar=dict(title="readings")))
+    return fig
+
+def latest_reading(df):
+    """Most recent row, with float32 sensor values turned back into the decimals the sensor sent
+    (6.7 rather than 6.699999809265137)"""
+    latest = df.iloc[-1].copy()
+    for column in SENSOR_COLUMNS:
+        if column in latest.index and pd.notna(latest[column]):
+            latest[column] = float(str(np.float32(latest[column])))
+    return latest
+
+def generate_insights(df, moments_by_crop=None):
+    """Alerts for the latest readings of every device in df, most severe first (see insight_rules).
+    moments_by_crop: statistics of each crop's sensor columns, for the correlation rules"""
+    if df is None or len(df) < 10:
+        return "Not enough data to generate insights."
+    alerts = evaluate_rules(df, moments_by_crop if len(df) >= 20 else None)
+    return alerts if len(alerts) else "All parameters are within optimal ranges."
+
+def crop_moments(df, timeframe, crop_number, apply_interpolation):
+    """window_moments of each crop in df. Returns: {crop number: Moments} (key None without a crop column)"""
+    if 'crop_number' not in df.columns:
+        return {None: window_moments(df, timeframe, "All", apply_interpolation)}
+    crops = [int(crop_number)] if crop_number != "All" else sorted(int(c) for c in df['crop_number'].dropna().unique())
+    return {crop: window_moments(df, timeframe, crop, apply_interpolation) for crop in crops}
+
+# Profile this script run when enabled in the sidebar's Profiling section (or via AGRI_DASHBOARD_PROFILE);
+# the toggles are drawn further down, so their values are read from the session state here
+profile_cprofile = st.session_state.get("profile_cprofile", PROFILE_MODE == "cprofile")
+profile_enabled = profile_cprofile or st.session_state.get("profile_stages", PROFILE_MODE not in ("", "0"))
+stop_active()
+run_profiler = RunProfiler("page run", cprofile=profile_cprofile).start() if profile_enabled else None
 
 # Sidebar
 # st.sidebar.markdown('<h1 class="main-header" style="text-align: center;">🌱 Agri Sensor Dashboard</h1>', unsafe_allow_html=True)
@@ -217,19 +614,22 @@ enable_interpolation = st.sidebar.checkbox("Clean data (interpolate outliers)",
 auto_refresh = st.sidebar.checkbox("Auto-refresh", value=True)
 if auto_refresh:
     refresh_interval = st.sidebar.slider("Refresh interval (seconds)", 5, 60, REFRESH_INTERVAL)
-    st.sidebar.write(f"Refreshing every {refresh_interval} seconds")
+    if FRAGMENTS_AVAILABLE:
+        st.sidebar.write(f"Live readings refresh every {refresh_interval} seconds")
+    else:
+        st.sidebar.write(f"Refreshing every {refresh_interval} seconds")
 
 # Data timeframe
 
-# Determine effective refresh interval
-effective_refresh_interval = refresh_interval if auto_refresh else REFRESH_INTERVAL
-
 # Load data early for crop list (raw, no interpolation needed just for options)
-_df_for_crops = load_data(apply_interpolation=False, refresh_interval=effective_refresh_interval)
-if _df_for_crops is not None and "crop_number" in _df_for_crops.columns:
-    crop_values = sorted(set(_df_for_crops["crop_number"].dropna()))
+if STORAGE_BACKEND == "sqlite":
+    crop_values = get_sqlite_store().crop_numbers() if os.path.exists(SQLITE_FILE) else []
 else:
-    crop_values = []
+    _df_for_crops = load_data(apply_interpolation=False)
+    if _df_for_crops is not None and "crop_number" in _df_for_crops.columns:
+        crop_values = sorted(set(_df_for_crops["crop_number"].dropna()))
+    else:
+        crop_values = []
 
 # Crop number filter
 crop_number = st.sidebar.selectbox(
@@ -246,47 +646,17 @@ sensor_type = st.sidebar.selectbox(
 st.sidebar.subheader("Data Timeframe")
 timeframe = st.sidebar.selectbox(
     "Select timeframe", 
-    ["Live (Last 5 min)", "Last hour", "Last 6 hours", "Last day", "Last week", "Last month", "Last quarter", "Last 6 months", "Last year","All data"]
+    list(TIMEFRAMES.keys())
 )
 
-# Load data (respect interpolation toggle and dynamic refresh interval)
-df = load_data(apply_interpolation=enable_interpolation, refresh_interval=effective_refresh_interval)
-
-# Filter data based on selected timeframe
-if df is not None and len(df) > 0:
-    now = datetime.now(pk_tz)
-    if df['timestamp'].dtype == 'datetime64[ns]':
-        df['timestamp'] = df['timestamp'].dt.tz_localize('UTC').dt.tz_convert(pk_tz)
-    else:
-        df['timestamp'] = pd.to_datetime(df['timestamp'], utc=True).dt.tz_convert(pk_tz)
-
-    # Timeframe filter
-    if timeframe == "Live (Last 5 min)":
-        df = df[df['timestamp'] > (now - timedelta(minutes=5))]
-    elif timeframe == "Last hour":
-        df = df[df['timestamp'] > (now - timedelta(hours=1))]
-    elif timeframe == "Last 6 hours":
-        df = df[df['timestamp'] > (now - timedelta(hours=6))]
-    elif timeframe == "Last day":
-        df = df[df['timestamp'] > (now - timedelta(days=1))]
-    elif timeframe == "Last week":
-        df = df[df['timestamp'] > (now - timedelta(weeks=1))]
-    elif timeframe == "Last month":
-        df = df[df['timestamp'] > (now - timedelta(days=30))]
-    elif timeframe == "Last quarter":
-        df = df[df['timestamp'] > (now - timedelta(days=90))]
-    elif timeframe == "Last 6 months":
-        df = df[df['timestamp'] > (now - timedelta(days=182))]
-    elif timeframe == "Last year":
-        df = df[df['timestamp'] > (now - timedelta(days=365))]
-
-    # Crop number filter
-    if crop_number != "All":
-        df = df[df["crop_number"] == int(crop_number)]
+with st.sidebar.expander("Profiling"):
+    st.checkbox("Time each stage", value=PROFILE_MODE not in ("", "0"), key="profile_stages",
+                help="Show how long loading, cleaning, filtering, figures and insights take on each run")
+    st.checkbox("Save cProfile output", value=PROFILE_MODE == "cprofile", key="profile_cprofile",
+                help=f"Write one .prof file per run to {PROFILE_DIR}/ for offline analysis")
 
-    # Sensor type filter
-    if sensor_type != "All":
-        df = df[["timestamp", sensor_type]]
+# Load data (respect interpolation toggle)
+df = load_filtered_data(timeframe, crop_number, sensor_type, enable_interpolation)
 
 # Dashboard Page
 if page == "Dashboard":
@@ -300,171 +670,181 @@ if page == "Dashboard":
     unsafe_allow_html=True,
     )
     
-    if df is not None and len(df) > 0:
+    # Downsample each trace to the point budget before it is sent to the browser
+    max_points = st.sidebar.slider("Max chart points per trace", 200, 5000, MAX_CHART_POINTS, step=100,
+                                   help="Longer series are downsampled; spikes are preserved")
+
+    def live_readings(timeframe, crop_number, sensor_type, enable_interpolation, max_points, rollup_granularity):
+        """Latest readings and, unless it is drawn from rollups, the trend chart"""
+        # Gauges and metrics come from the listener's latest-reading snapshot; the history
+        # is only loaded for the trend chart (or when there is no snapshot)
+        df = None
+        with profile_stage("gauges"):
+            readings = device_readings(timeframe, crop_number, enable_interpolation)
+        if readings is None:
+            df = load_filtered_data(timeframe, crop_number, sensor_type, enable_interpolation)
+            readings = recent_readings(df, 1)[0] if df is not None else None
+        if readings is None or len(readings) == 0:
+            st.warning("No data available to display. Please check if the MQTT listener is running.")
+            return
+
         # Top metrics section
-        latest = df.iloc[-1]
-        timestamp = latest['timestamp']
-
-        if isinstance(timestamp, (float, int)):
-            utc_dt = datetime.utcfromtimestamp(timestamp).replace(tzinfo=pytz.utc)
-        elif isinstance(timestamp, datetime):
-            if timestamp.tzinfo is None:
-                utc_dt = timestamp.replace(tzinfo=pytz.utc)
+        with profile_stage("gauges"):
+            # Gauges show the device that reported last, or the one picked here
+            keys = [col for col in ('mac_address', 'crop_number') if col in readings.columns]
+            readings = readings.reset_index(drop=True)
+            selected = len(readings) - 1
+            if len(readings) > 1:
+                labels = readings[keys].astype(str).agg(" / crop ".join, axis=1)
+                device = st.selectbox("Device", ["Latest reading"] + sorted(labels), key="gauge_device")
+                if device != "Latest reading":
+                    selected = int(np.flatnonzero(labels == device)[0])
+            latest = latest_reading(readings.iloc[[selected]])
+            timestamp = latest['timestamp']
+
+            if isinstance(timestamp, (float, int)):
+                utc_dt = datetime.utcfromtimestamp(timestamp).replace(tzinfo=pytz.utc)
+            elif isinstance(timestamp, datetime):
+                if timestamp.tzinfo is None:
+                    utc_dt = timestamp.replace(tzinfo=pytz.utc)
+                else:
+                    utc_dt = timestamp.astimezone(pytz.utc)
             else:
-                utc_dt = timestamp.astimezone(pytz.utc)
-        else:
-            try:
-                # If it's a pandas Timestamp without tzinfo
-                utc_dt = timestamp.tz_localize('UTC')
-            except:
-                utc_dt = datetime.utcnow().replace(tzinfo=pytz.utc)
+                try:
+                    # If it's a pandas Timestamp without tzinfo
+                    utc_dt = timestamp.tz_localize('UTC')
+                except:
+                    utc_dt = datetime.utcnow().replace(tzinfo=pytz.utc)
 
-        # Convert to Pakistan Time
-        pkt = pytz.timezone("Asia/Karachi")
-        last_update = utc_dt.astimezone(pkt).strftime("%Y-%m-%d %H:%M:%S")
+            # Convert to Pakistan Time
+            pkt = pytz.timezone("Asia/Karachi")
+            last_update = utc_dt.astimezone(pkt).strftime("%Y-%m-%d %H:%M:%S")
 
-        st.write(f"🕒 Last updated (PKT): {last_update}")
+            st.write(f"🕒 Last updated (PKT): {last_update}")
 
 
-        # latest = df.iloc[-1]
-        # last_update = latest['timestamp'].strftime("%Y-%m-%d %H:%M:%S")
-        # st.write(f"Last updated: {last_update}")
-        
-        # Key metrics in 3 columns
-        col1, col2, col3 = st.columns(3)
-        
-        with col1:
-            # st.markdown('<div class="card">', unsafe_allow_html=True)
-            st.markdown("### Soil Moisture")
-            st.plotly_chart(create_gauge(
-                latest['soil_moisture'], "Moisture %", 0, 100, 30, 70
-            ), use_container_width=True)
-            st.markdown("</div>", unsafe_allow_html=True)
-        
-        with col2:
-            # st.markdown('<div class="card">', unsafe_allow_html=True)
-            st.markdown("### Soil pH")
-            st.plotly_chart(create_gauge(
-                latest['soil_ph'], "pH Level", 4, 9, 6.0, 7.5
-            ), use_container_width=True)
-            st.markdown("</div>", unsafe_allow_html=True)
-            
-        with col3:
-            # st.markdown('<div class="card">', unsafe_allow_html=True)
-            st.markdown("### Air Temperature")
-            st.plotly_chart(create_gauge(
-                latest['air_temperature'], "°C", 0, 50, 20, 35
-            ), use_container_width=True)
-            st.markdown("</div>", unsafe_allow_html=True)
-            
-        # Second row of metrics
-        col1, col2, col3, col4 = st.columns(4)
-        
-        with col1:
-            # st.markdown('<div class="card">', unsafe_allow_html=True)
-            st.metric("Soil Nitrogen", f"{latest['soil_nitrogen']} mg/kg")
-            st.markdown("</div>", unsafe_allow_html=True)
-            
-        with col2:
-            # st.markdown('<div class="card">', unsafe_allow_html=True)
-            st.metric("Soil Phosphorus", f"{latest['soil_phosphorus']} mg/kg")
-            st.markdown("</div>", unsafe_allow_html=True)
-            
-        with col3:
-            # st.markdown('<div class="card">', unsafe_allow_html=True)
-            st.metric("Soil Potassium", f"{latest['soil_potassium']} mg/kg")
-            st.markdown("</div>", unsafe_allow_html=True)
-            
-        with col4:
-            # st.markdown('<div class="card">', unsafe_allow_html=True)
-            st.metric("Air Humidity", f"{latest['air_humidity']}%")
-            st.markdown("</div>", unsafe_allow_html=True)
-        
-        # Main visualizations
+            # latest = df.iloc[-1]
+            # last_update = latest['timestamp'].strftime("%Y-%m-%d %H:%M:%S")
+            # st.write(f"Last updated: {last_update}")
+
+            # Key metrics in 3 columns
+            col1, col2, col3 = st.columns(3)
+
+            with col1:
+                # st.markdown('<div class="card">', unsafe_allow_html=True)
+                st.markdown("### Soil Moisture")
+                st.plotly_chart(create_gauge(
+                    latest['soil_moisture'], "Moisture %", 0, 100, 30, 70
+                ), use_container_width=True)
+                st.markdown("</div>", unsafe_allow_html=True)
+
+            with col2:
+                # st.markdown('<div class="card">', unsafe_allow_html=True)
+                st.markdown("### Soil pH")
+                st.plotly_chart(create_gauge(
+                    latest['soil_ph'], "pH Level", 4, 9, 6.0, 7.5
+                ), use_container_width=True)
+                st.markdown("</div>", unsafe_allow_html=True)
+
+            with col3:
+                # st.markdown('<div class="card">', unsafe_allow_html=True)
+                st.markdown("### Air Temperature")
+                st.plotly_chart(create_gauge(
+                    latest['air_temperature'], "°C", 0, 50, 20, 35
+                ), use_container_width=True)
+                st.markdown("</div>", unsafe_allow_html=True)
+
+            # Second row of metrics
+            col1, col2, col3, col4 = st.columns(4)
+
+            with col1:
+                # st.markdown('<div class="card">', unsafe_allow_html=True)
+                st.metric("Soil Nitrogen", f"{latest['soil_nitrogen']} mg/kg")
+                st.markdown("</div>", unsafe_allow_html=True)
+
+            with col2:
+                # st.markdown('<div class="card">', unsafe_allow_html=True)
+                st.metric("Soil Phosphorus", f"{latest['soil_phosphorus']} mg/kg")
+                st.markdown("</div>", unsafe_allow_html=True)
+
+            with col3:
+                # st.markdown('<div class="card">', unsafe_allow_html=True)
+                st.metric("Soil Potassium", f"{latest['soil_potassium']} mg/kg")
+                st.markdown("</div>", unsafe_allow_html=True)
+
+            with col4:
+                # st.markdown('<div class="card">', unsafe_allow_html=True)
+                st.metric("Air Humidity", f"{latest['air_humidity']}%")
+                st.markdown("</div>", unsafe_allow_html=True)
+
+            # Current values of every device
+            if len(readings) > 1:
+                st.markdown('<h2 class="sub-header">All Devices</h2>', unsafe_allow_html=True)
+                columns = [col for col in SENSOR_COLUMNS if col in readings.columns]
+                grid = readings.sort_values(keys)
+                grid = grid.assign(
+                    timestamp=grid['timestamp'].dt.strftime("%Y-%m-%d %H:%M:%S"),
+                    **{col: grid[col].to_numpy().astype(str).astype(np.float64) for col in columns},
+                )
+                st.dataframe(grid[[*keys, 'timestamp', *columns]].rename(
+                    columns={'timestamp': 'last reading (PKT)'}), hide_index=True, use_container_width=True)
+
+
+        # Raw-data trend charts follow the live readings
+        if not rollup_granularity:
+            if df is None:
+                df = load_filtered_data(timeframe, crop_number, sensor_type, enable_interpolation)
+                if df is None or len(df) == 0:
+                    return
+            st.markdown('<h2 class="sub-header">Sensor Data Trends</h2>', unsafe_allow_html=True)
+            with profile_stage("trend chart"):
+                st.plotly_chart(create_trend_figure(df, max_points), use_container_width=True)
+
+    @live_fragment(run_every=refresh_interval if auto_refresh else None)
+    def live_dashboard(timeframe, crop_number, sensor_type, enable_interpolation, max_points, rollup_granularity):
+        """The live section of the page. With auto-refresh on, only this function reruns on
+        the timer, and those reruns are profiled on their own."""
+        if not profile_enabled or (run_profiler is not None and run_profiler.running):
+            live_readings(timeframe, crop_number, sensor_type, enable_interpolation, max_points, rollup_granularity)
+            return
+        with RunProfiler("live section rerun", cprofile=profile_cprofile) as fragment_profiler:
+            live_readings(timeframe, crop_number, sensor_type, enable_interpolation, max_points, rollup_granularity)
+        show_profile(fragment_profiler)
+
+    # Long timeframes are plotted from the listener's rollups instead of every raw reading;
+    # rollups only change once an hour, so that chart is drawn with the page, not the live section
+    rollup_granularity = ROLLUP_TREND_GRANULARITY.get(timeframe)
+    if not (rollup_granularity and enable_interpolation and rollups_available()):
+        rollup_granularity = None
+
+    live_dashboard(timeframe, crop_number, sensor_type, enable_interpolation, max_points, rollup_granularity)
+
+    if rollup_granularity and df is not None and len(df) > 0:
         st.markdown('<h2 class="sub-header">Sensor Data Trends</h2>', unsafe_allow_html=True)
-        
-        # Soil Moisture
-        fig = make_subplots(rows=9, cols=1, 
-                   subplot_titles=("Soil Moisture", 
-                          "Soil Temperature", 
-                          "Soil Conductivity",
-                          "Soil Nitrogen",
-                          "Soil Phosphorus",
-                          "Soil Potassium",
-                          "Soil pH",
-                          "Air Temperature",
-                          "Air Humidity"),
-                   vertical_spacing=0.02,
-                   shared_xaxes=True)
-        
-        # Soil Moisture
-        fig.add_trace(go.Scatter(
-            x=df['timestamp'], y=df['soil_moisture'],
-            name="Soil Moisture", line=dict(color="blue")
-        ), row=1, col=1)
-        
-        # Soil Temperature
-        fig.add_trace(go.Scatter(
-            x=df['timestamp'], y=df['soil_temperature'],
-            name="Soil Temperature", line=dict(color="red")
-        ), row=2, col=1)
-        
-        # Soil Humidity
-        fig.add_trace(go.Scatter(
-            x=df['timestamp'], y=df['soil_conductivity'],
-            name="Soil Conductivity", line=dict(color="purple")
-        ), row=3, col=1)
-        
-        # Soil Nitrogen
-        fig.add_trace(go.Scatter(
-            x=df['timestamp'], y=df['soil_nitrogen'],
-            name="Nitrogen", line=dict(color="green")
-        ), row=4, col=1)
-        
-        # Soil Phosphorus
-        fig.add_trace(go.Scatter(
-            x=df['timestamp'], y=df['soil_phosphorus'],
-            name="Phosphorus", line=dict(color="orange")
-        ), row=5, col=1)
-        
-        # Soil Potassium
-        fig.add_trace(go.Scatter(
-            x=df['timestamp'], y=df['soil_potassium'],
-            name="Potassium", line=dict(color="brown")
-        ), row=6, col=1)
-        
-        # Soil pH
-        fig.add_trace(go.Scatter(
-            x=df['timestamp'], y=df['soil_ph'],
-            name="Soil pH", line=dict(color="darkgreen")
-        ), row=7, col=1)
-        
-        # Air Temperature
-        fig.add_trace(go.Scatter(
-            x=df['timestamp'], y=df['air_temperature'],
-            name="Air Temperature", line=dict(color="crimson")
-        ), row=8, col=1)
-        
-        # Air Humidity
-        fig.add_trace(go.Scatter(
-            x=df['timestamp'], y=df['air_humidity'],
-            name="Air Humidity", line=dict(color="skyblue")
-        ), row=9, col=1)
-        
-        fig.update_layout(height=1800, showlegend=True, 
-                 legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1))
-        st.plotly_chart(fig, use_container_width=True)
-        
+        window = TIMEFRAMES[timeframe]
+        with profile_stage("rollups"):
+            trend_df = load_rollup_means(
+                rollup_granularity,
+                start=time.time() - window.total_seconds() if window is not None else None,
+                crop=None if crop_number == "All" else crop_number,
+            )
+        st.caption(f"Showing {'hourly' if rollup_granularity == 'hour' else 'daily'} averages")
+        with profile_stage("trend chart"):
+            st.plotly_chart(create_trend_figure(trend_df, max_points), use_container_width=True)
+
+    if df is not None and len(df) > 0:
         # Insights section
         st.markdown('<h2 class="sub-header">Insights</h2>', unsafe_allow_html=True)
-        insights = generate_insights(df)
-        if isinstance(insights, list):
-            for insight in insights:
+        with profile_stage("insights"):
+            insights = generate_insights(df, crop_moments(df, timeframe, crop_number, enable_interpolation))
+        if isinstance(insights, pd.DataFrame):
+            for insight in insights['message'].head(INSIGHTS_SHOWN):
                 st.write(insight)
-            else:
-                st.write(insights)
-    else:
-        st.warning("No data available to display. Please check if the MQTT listener is running.")
+            if len(insights) > INSIGHTS_SHOWN:
+                with st.expander(f"All {len(insights)} alerts"):
+                    st.dataframe(insights.drop(columns=['message']), hide_index=True, use_container_width=True)
+        else:
+            st.write(insights)
         
 # Detailed Analysis Page
 elif page == "Detailed Analysis":
@@ -483,7 +863,9 @@ elif page == "Detailed Analysis":
         st.subheader(f"Statistical Summary of {selected_param.replace('_', ' ').title()}")
         
         col1, col2, col3, col4 = st.columns(4)
-        stats = df[selected_param].describe()
+        with profile_stage("statistics"):
+            moments = window_moments(df, timeframe, crop_number, enable_interpolation)
+            stats = moments.describe()[selected_param]
         
         with col1:
             st.metric("Mean", f"{stats['mean']:.2f}")
@@ -494,64 +876,55 @@ elif page == "Detailed Analysis":
         with col4:
             st.metric("Standard Dev", f"{stats['std']:.2f}")
         
+        # Figures are built only when their section is shown, and reused while the data and settings are unchanged
+        data_key = (timeframe, crop_number, sensor_type, enable_interpolation, frame_key(df))
+
         # Time series with moving average
         st.subheader("Time Series Analysis")
         
-        window_size = st.slider("Moving average window size", 1, 20, 5)
-        
-        # Calculate moving average
-        df['moving_avg'] = df[selected_param].rolling(window=window_size).mean()
-        
-        # Plot time series with moving average
-        fig = px.line(df, x='timestamp', y=[selected_param, 'moving_avg'],
-                     labels={selected_param: selected_param.replace('_', ' ').title(),
-                             'moving_avg': f'{window_size}-point Moving Average',
-                             'timestamp': 'Time'},
-                     title=f"{selected_param.replace('_', ' ').title()} Over Time with Moving Average")
-        
-        fig.update_layout(legend_title_text='', height=500)
-        st.plotly_chart(fig, use_container_width=True)
+        if st.checkbox("Show time series", value=True, key="show_time_series"):
+            window_size = st.slider("Moving average window size", 1, 20, 5)
+
+            # Plot time series with moving average
+            with profile_stage("time series chart"):
+                fig = moving_average_figure(df, data_key, selected_param, window_size, MAX_CHART_POINTS)
+                st.plotly_chart(fig, use_container_width=True)
         
         # Correlation heatmap
         st.subheader("Parameter Correlations")
         
-        numeric_df = df.drop(columns=['timestamp']).select_dtypes(include='number')
-
-        # Calculate the correlation matrix
-        corr = numeric_df.corr()
+        if st.checkbox("Show correlations", value=True, key="show_correlations"):
+            with profile_stage("correlation heatmap"):
+                # Correlation matrix of the sensor parameters, from the running statistics
+                corr = moments.corr()
 
-        # Plot the correlation matrix
-        fig = px.imshow(corr, text_auto=True, aspect="auto",
-                        labels=dict(x="Parameters", y="Parameters", color="Correlation"),
-                        x=corr.columns, y=corr.columns)
-        fig.update_layout(height=600)
-        st.plotly_chart(fig, use_container_width=True)
+                # Plot the correlation matrix
+                fig = px.imshow(corr, text_auto=True, aspect="auto",
+                                labels=dict(x="Parameters", y="Parameters", color="Correlation"),
+                                x=corr.columns, y=corr.columns)
+                fig.update_layout(height=600)
+                st.plotly_chart(fig, use_container_width=True)
         
         # Distribution analysis
         st.subheader(f"Distribution Analysis of {selected_param.replace('_', ' ').title()}")
         
-        fig = px.histogram(df, x=selected_param, nbins=20, 
-                          marginal="box",
-                          title=f"Distribution of {selected_param.replace('_', ' ').title()}")
-        st.plotly_chart(fig, use_container_width=True)
+        if st.checkbox("Show distribution", value=False, key="show_distribution"):
+            with profile_stage("distribution chart"):
+                st.plotly_chart(distribution_figure(df, data_key, selected_param), use_container_width=True)
         
         # Scatter plot matrix
         st.subheader("Scatter Plot Matrix")
         
         selected_params = st.multiselect(
             "Select parameters for scatter plot matrix",
-            df.columns.drop('timestamp').tolist(),
+            [col for col in SENSOR_COLUMNS if col in df.columns],
             # default=[selected_param, 'soil_moisture', 'air_temperature']
         )
         
         if len(selected_params) >= 2:
-            fig = px.scatter_matrix(
-                df[selected_params],
-                dimensions=selected_params,
-                title="Scatter Plot Matrix"
-            )
-            fig.update_layout(height=600)
-            st.plotly_chart(fig, use_container_width=True)
+            with profile_stage("scatter matrix"):
+                fig = scatter_matrix_figure(df, data_key, tuple(selected_params))
+                st.plotly_chart(fig, use_container_width=True)
         else:
             st.warning("Please select at least 2 parameters for the scatter plot matrix.")
     else:
@@ -562,9 +935,9 @@ elif page == "Historical Data":
     st.markdown('<h1 class="main-header">Historical Data</h1>', unsafe_allow_html=True)
     
     if df is not None and len(df) > 0:
-        # Date range picker
-        min_date = df['timestamp'].min().date()
-        max_date = df['timestamp'].max().date()
+        # Date range picker (the data is sorted by time)
+        min_date = df['timestamp'].iloc[0].date()
+        max_date = df['timestamp'].iloc[-1].date()
         
         col1, col2 = st.columns(2)
         with col1:
@@ -572,9 +945,11 @@ elif page == "Historical Data":
         with col2:
             end_date = st.date_input("End date", max_date)
         
-        # Filter by date range
-        mask = (df['timestamp'].dt.date >= start_date) & (df['timestamp'].dt.date <= end_date)
-        filtered_df = df.loc[mask]
+        # Filter by date range: from midnight of the start date to midnight after the end date
+        range_start = pd.Timestamp(start_date).tz_localize(pk_tz)
+        range_end = pd.Timestamp(end_date + timedelta(days=1)).tz_localize(pk_tz)
+        with profile_stage("date filter"):
+            filtered_df = time_slice(df, start=range_start, end=range_end, assume_sorted=True)
         
         if len(filtered_df) > 0:
             st.write(f"Showing data from {start_date} to {end_date} ({len(filtered_df)} records)")
@@ -588,9 +963,10 @@ elif page == "Historical Data":
             )
             
             if params_to_compare:
-                fig = px.line(filtered_df, x='timestamp', y=params_to_compare,
-                             title="Parameter Comparison Over Time")
-                st.plotly_chart(fig, use_container_width=True)
+                with profile_stage("comparison chart"):
+                    fig = px.line(filtered_df, x='timestamp', y=params_to_compare,
+                                  title="Parameter Comparison Over Time")
+                    st.plotly_chart(fig, use_container_width=True)
             
             # Data aggregation options
             st.subheader("Data Aggregation")
@@ -600,18 +976,25 @@ elif page == "Historical Data":
             )
             
             if aggregation != "None":
-                if aggregation == "Hour":
-                    grouped_df = filtered_df.set_index('timestamp').resample('H').mean(numeric_only=True).reset_index()
-                elif aggregation == "Day":
-                    grouped_df = filtered_df.set_index('timestamp').resample('D').mean(numeric_only=True).reset_index()
-                else:  # Week
-                    grouped_df = filtered_df.set_index('timestamp').resample('W').mean(numeric_only=True).reset_index()
+                with profile_stage("aggregation"):
+                    if enable_interpolation and rollups_available():
+                        # Served from the listener's rollups, which skip the values cleaning removes
+                        grouped_df = load_rollup_means(
+                            aggregation.lower(), start=range_start.timestamp(), end=range_end.timestamp(),
+                            crop=None if crop_number == "All" else crop_number,
+                        )
+                    elif aggregation == "Hour":
+                        grouped_df = filtered_df.set_index('timestamp').resample('H').mean(numeric_only=True).reset_index()
+                    elif aggregation == "Day":
+                        grouped_df = filtered_df.set_index('timestamp').resample('D').mean(numeric_only=True).reset_index()
+                    else:  # Week
+                        grouped_df = filtered_df.set_index('timestamp').resample('W').mean(numeric_only=True).reset_index()
                 
                 # Plot aggregated data
                 if len(grouped_df) > 0:
                     st.write(f"Data aggregated by {aggregation.lower()} ({len(grouped_df)} data points)")
                     
-                    param = st.selectbox("Select parameter to visualize", filtered_df.columns.drop('timestamp').tolist())
+                    param = st.selectbox("Select parameter to visualize", grouped_df.columns.drop('timestamp').tolist())
                     
                     fig = px.line(grouped_df, x='timestamp', y=param,
                                  title=f"{param.replace('_', ' ').title()} Aggregated by {aggregation}")
@@ -619,41 +1002,33 @@ elif page == "Historical Data":
                 else:
                     st.warning("Not enough data for the selected aggregation level.")
             
-            # Export options
+            # Export options: each selection is written to disk once, in chunks, and downloaded from the file
             st.subheader("Export Data")
-            col1, col2 = st.columns(2)
+            col1, col2, col3 = st.columns(3)
             
             with col1:
-                if st.button("Export to CSV"):
-                    csv = filtered_df.to_csv(index=False).encode('utf-8')
-                    st.download_button(
-                        label="Download CSV",
-                        data=csv,
-                        file_name=f"sensor_data_{start_date}_{end_date}.csv",
-                        mime='text/csv',
-                    )
-            
+                export_format = st.selectbox("Format", export_formats(), format_func=lambda fmt: EXPORT_FORMATS[fmt][0])
             with col2:
-                if st.button("Export to JSON"):
-                    json_string = filtered_df.to_json(orient='records', date_format='iso')
+                compress = st.checkbox("Compress (gzip)", value=True, disabled=export_format == "parquet",
+                                       help="Parquet files are always compressed")
+            with col3:
+                prepare_export = st.button("Export data")
+            
+            if prepare_export:
+                export_key = (timeframe, crop_number, sensor_type, enable_interpolation, frame_key(filtered_df))
+                with st.spinner("Writing export..."), profile_stage("export"):
+                    export_path = export_file(filtered_df, export_key, export_format, compress)
+                with open(export_path, 'rb') as f:
                     st.download_button(
-                        label="Download JSON",
-                        data=json_string,
-                        file_name=f"sensor_data_{start_date}_{end_date}.json",
-                        mime='application/json',
+                        label=f"Download {EXPORT_FORMATS[export_format][0]} ({os.path.getsize(export_path) / 1e6:.1f} MB)",
+                        data=f,
+                        file_name=f"sensor_data_{start_date}_{end_date}{export_name(export_format, compress)}",
+                        mime=export_mime(export_format, compress),
                     )
             
-            # Raw data table with pagination
+            # Raw data table, paginated on the server
             st.subheader("Raw Data")
-            page_size = 20
-            total_pages = max(1, (len(filtered_df) + page_size - 1) // page_size)
-            page_number = st.number_input("Page", 1, total_pages, 1)
-            
-            start_idx = (page_number - 1) * page_size
-            end_idx = min(start_idx + page_size, len(filtered_df))
-            
-            st.write(f"Showing records {start_idx+1} to {end_idx} of {len(filtered_df)}")
-            st.dataframe(filtered_df.iloc[start_idx:end_idx].reset_index(drop=True))
+            raw_data_table(filtered_df, range_start, range_end, crop_number, enable_interpolation)
         else:
             st.warning("No data available for the selected date range.")
     else:
@@ -723,7 +1098,10 @@ st.markdown(
     """,
     unsafe_allow_html=True
 )
-# Auto refresh the page
-if auto_refresh:
+if run_profiler is not None:
+    show_profile(run_profiler.stop())
+
+# Auto refresh the page (only needed when fragments aren't available to refresh the live section)
+if auto_refresh and not FRAGMENTS_AVAILABLE:
     time.sleep(refresh_interval)
     st.rerun()
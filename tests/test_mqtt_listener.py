@@ -0,0 +1,68 @@
+import json
+import logging
+import time
+
+import pytest
+
+from mqtt_listener import CsvWriter, IngestWriter, SinkWorker, process_message
+from sensor_store import JsonlWriter
+
+
+@pytest.mark.parametrize("timestamp, stored", [
+    (None, 1700000000.5), ("", 1700000000.5), ("soon", 1700000000.5),
+    ("1699999990", 1699999990.0), (1699999990, 1699999990),
+])
+def test_records_get_the_arrival_time_without_a_usable_timestamp(timestamp, stored):
+    payload = json.dumps({"mac_address": "AA:BB:CC:DD:EE:FF", "crop_number": 1, "soil_ph": 6.5,
+                          "timestamp": timestamp}).encode("utf-8")
+    assert process_message(payload, 1700000000.5)["timestamp"] == stored
+
+
+class _FlushFailsOnce:
+    """File whose first flush stores the data and then fails, like a write cut short"""
+
+    def __init__(self, file):
+        self._file = file
+        self.failed = False
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def flush(self):
+        self._file.flush()
+        if not self.failed:
+            self.failed = True
+            raise OSError("disk full")
+
+
+@pytest.mark.parametrize("writer_class, suffix", [(CsvWriter, ".csv"), (JsonlWriter, ".jsonl")])
+def test_retried_file_write_stores_the_batch_once(tmp_path, writer_class, suffix):
+    sink = writer_class(str(tmp_path / f"sensor_data{suffix}")).open()
+    sink.write_batch([{"timestamp": 1700000000.0, "mac_address": "AA:BB:CC:DD:EE:FF"}])
+    sink._file = _FlushFailsOnce(sink._file)
+
+    batch = [{"timestamp": 1700000060.0 + i, "mac_address": "AA:BB:CC:DD:EE:FF"} for i in range(3)]
+    assert SinkWorker(sink, retries=2, retry_delay=0).write(batch)
+    sink.close()
+    assert len((tmp_path / f"sensor_data{suffix}").read_bytes().splitlines()) == 4
+
+
+class _SlowSink:
+    path = "slow sink"
+
+    def write_batch(self, records):
+        time.sleep(0.3)
+
+    def close(self):
+        pass
+
+
+def test_stop_logs_records_left_queued(caplog):
+    writer = IngestWriter([_SlowSink()])
+    writer.start()
+    for _ in range(3):
+        writer.flush([{"timestamp": 1700000000.0}] * 10)
+    with caplog.at_level(logging.ERROR):
+        writer.stop(timeout=0.1)
+    assert "still queued" in caplog.text
+    assert "slow sink: 30" in caplog.text
@@ -0,0 +1,22 @@
+import numpy as np
+import pandas as pd
+
+from sensor_processing import frame_page
+
+
+def test_frame_page_of_integer_epoch_timestamps():
+    # Integer epochs parse to datetime64[s] on pandas 2+; cursors and bounds are nanoseconds
+    df = pd.DataFrame({"timestamp": pd.to_datetime(1700000000 + 60 * np.arange(300), unit="s"),
+                       "soil_ph": np.arange(300, dtype="float32")})
+    df["timestamp"] = df["timestamp"].astype("datetime64[s]")
+
+    page, first, last = frame_page(df, 5, start=df.timestamp.iloc[100])
+    assert page["soil_ph"].tolist() == [100, 101, 102, 103, 104]
+    assert first == (pd.Timestamp(df.timestamp.iloc[100]).value, 100)
+
+    page, _, _ = frame_page(df, 5, after=last, end=df.timestamp.iloc[108])
+    assert page["soil_ph"].tolist() == [105, 106, 107]
+
+    # A cursor taken before the frame was reloaded is found by its timestamp
+    page, _, _ = frame_page(df.iloc[50:].reset_index(drop=True), 2, after=last)
+    assert page["soil_ph"].tolist() == [105, 106]
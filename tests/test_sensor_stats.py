@@ -0,0 +1,30 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from sensor_processing import SharedSensorData
+from sensor_store import SENSOR_COLUMNS
+
+
+def test_moments_of_integer_epoch_records(tmp_path):
+    # Integer epochs parse to datetime64[s] on pandas 2+, not datetime64[ns]
+    path = tmp_path / "sensor_data.jsonl"
+    start_epoch = 1700000000
+    with open(path, "w") as f:
+        for i in range(3000):
+            record = {"timestamp": start_epoch + 60 * i, "mac_address": "AA:BB:CC:DD:EE:FF", "crop_number": 1}
+            record.update({col: 20.0 + i % 7 for col in SENSOR_COLUMNS})
+            record["soil_ph"] = 6.0 + (i % 10) / 10
+            f.write(json.dumps(record) + "\n")
+    data = SharedSensorData(str(path))
+    frame = data.get(cleaned=False)
+
+    start, end = frame["timestamp"].iloc[100], frame["timestamp"].iloc[2000]
+    moments = data.moments(False, start, end)
+    expected = frame.loc[(frame["timestamp"] >= start) & (frame["timestamp"] < end), "soil_ph"]
+    column = moments.columns.index("soil_ph")
+    assert moments.n[column] == len(expected) == 1900
+    assert moments.mean[column] == pytest.approx(expected.astype(np.float64).mean())
+    assert data.moments(False).n[column] == 3000
@@ -0,0 +1,52 @@
+import json
+import logging
+
+import pytest
+
+from sensor_store import IncrementalJsonlLoader, SqliteStore, parse_jsonl_records
+
+
+def _line(ts, ph):
+    return (json.dumps({"timestamp": ts, "mac_address": "AA:BB:CC:DD:EE:FF", "crop_number": 1, "soil_ph": ph})
+            + "\n").encode("utf-8")
+
+
+def test_refresh_drops_lines_that_fail_to_parse(tmp_path, caplog):
+    path = tmp_path / "sensor_data.jsonl"
+    path.write_bytes(_line(1700000000.0, 6.5))
+    loader = IncrementalJsonlLoader(str(path))
+    assert loader.refresh() == 1
+
+    with open(path, "ab") as f:
+        f.write(b'{"timestamp": 1700000060.0, "soil_ph": \n' + _line(1700000120.0, 6.7))
+    with caplog.at_level(logging.WARNING):
+        assert loader.refresh() == 1
+    assert loader.offset == path.stat().st_size
+    assert loader.bad_lines == 1
+    assert loader.frame["soil_ph"].tolist() == pytest.approx([6.5, 6.7])
+    assert "Skipped 1 unparseable line(s)" in caplog.text
+
+    # Later refreshes don't trip over the same bytes again, and the warning is rate limited
+    caplog.clear()
+    with open(path, "ab") as f:
+        f.write(b'{"timestamp": "yesterday", "soil_ph": 6.8}\n' + _line(1700000180.0, 6.9))
+    with caplog.at_level(logging.WARNING):
+        assert loader.refresh() == 1
+    assert loader.bad_lines == 2
+    assert loader.frame["soil_ph"].tolist() == pytest.approx([6.5, 6.7, 6.9])
+    assert caplog.text == ""
+
+
+def test_parsed_timestamps_are_nanoseconds_for_integer_epochs():
+    df = parse_jsonl_records(_line(1700000000, 6.5) + _line(1700000060.5, 6.7))
+    assert df["timestamp"].dtype == "datetime64[ns]"
+    assert df["timestamp"].array.asi8.tolist() == [1700000000 * 10**9, 1700000060500000000]
+    assert parse_jsonl_records(_line(1700000000, 6.5))["timestamp"].dtype == "datetime64[ns]"
+
+
+def test_sqlite_batch_keeps_records_with_a_timestamp(tmp_path):
+    store = SqliteStore(str(tmp_path / "sensor_data.db"))
+    store.write_batch([json.loads(_line(1700000000.0, 6.5)), json.loads(_line(None, 6.6)),
+                       json.loads(_line(1700000060.0, 6.7))])
+    assert store.count() == 2
+    store.close()